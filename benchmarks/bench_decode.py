@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""Decoding benchmark: from_json / from_db_json on a Patient/Observation
+corpus.
+
+Usage: python benchmarks/bench_decode.py [--size N] [--repeat N]
+"""
+from __future__ import print_function
+import argparse
+import copy
+import os
+import sys
+import timeit
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+PROJECT_PATH = os.path.dirname(BASE_PATH)
+sys.path.append(PROJECT_PATH)
+sys.path.append(BASE_PATH)
+
+
+def main():
+    from fhir_tools import readers, resources
+    import corpus
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    repo = resources.Resources(readers.defs_from_generated())
+    data = corpus.generate(args.size)
+    db_data = []
+    for raw in data:
+        resource = repo.from_json(raw)
+        resource.to_db_format()
+        db_data.append(copy.deepcopy(resource))
+
+    def bench(name, func):
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print('{:<28} {:10.0f} resources/s'.format(name, len(data) / best))
+
+    bench('from_json', lambda: [repo.from_json(r) for r in data])
+    bench('from_db_json (no convert)',
+          lambda: [repo.from_db_json(r, False) for r in db_data])
+    bundle = corpus.bundle(data)
+    bench('Bundle.from_json', lambda: repo.from_json(bundle))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""Memory benchmark: dict-backed vs compact (`__slots__`-backed) classes.
+
+Usage: python benchmarks/bench_memory.py [--size N]
+"""
+from __future__ import print_function
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+PROJECT_PATH = os.path.dirname(BASE_PATH)
+sys.path.append(PROJECT_PATH)
+sys.path.append(BASE_PATH)
+
+
+def main():
+    from fhir_tools import readers, resources
+    import corpus
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=20000)
+    args = parser.parse_args()
+
+    definitions = readers.defs_from_generated()
+    data = corpus.generate(args.size)
+    for compact in (False, True):
+        repo = resources.Resources(definitions, compact=compact)
+        # Warm up decoders, so they are not counted
+        [repo.from_json(r) for r in data[:10]]
+        gc.collect()
+        tracemalloc.start()
+        start = time.time()
+        parsed = [repo.from_json(r) for r in data]
+        elapsed = time.time() - start
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print('{:<8} {:8.1f} MB  {:6.0f} bytes/resource  {:8.0f} '
+              'resources/s'.format('compact' if compact else 'dict',
+                                   size / 1024.0 / 1024, size / len(parsed),
+                                   len(parsed) / elapsed))
+        del parsed
+
+
+if __name__ == '__main__':
+    main()
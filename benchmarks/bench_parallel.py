@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""Parallel conversion benchmark: Resources.convert_many throughput for a
+growing number of worker processes.
+
+Usage: python benchmarks/bench_parallel.py [--size N] [--workers 1,2,4]
+"""
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+PROJECT_PATH = os.path.dirname(BASE_PATH)
+sys.path.append(PROJECT_PATH)
+sys.path.append(BASE_PATH)
+
+
+def main():
+    from fhir_tools import parallel, readers, resources
+    import corpus
+
+    cpus = multiprocessing.cpu_count()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=20000)
+    parser.add_argument('--chunk-size', type=int,
+                        default=parallel.DEFAULT_CHUNK_SIZE)
+    parser.add_argument(
+        '--workers', default=','.join(
+            str(w) for w in sorted({1, 2, 4, 8, cpus}) if w <= cpus))
+    args = parser.parse_args()
+
+    repo = resources.Resources(readers.defs_from_generated())
+    data = corpus.generate(args.size)
+    db_data = list(repo.convert_many(data, parallel.TO_DB, workers=1))
+
+    baseline = {}
+    for direction, items in ((parallel.TO_DB, data),
+                             (parallel.TO_FHIR, db_data)):
+        for workers in [int(w) for w in args.workers.split(',')]:
+            start = time.time()
+            for _ in repo.convert_many(items, direction, workers=workers,
+                                       chunk_size=args.chunk_size):
+                pass
+            rate = len(items) / (time.time() - start)
+            baseline.setdefault(direction, rate)
+            print('{:<8} workers={:<3} {:10.0f} resources/s  x{:.2f}'.format(
+                direction, workers, rate, rate / baseline[direction]))
+
+
+if __name__ == '__main__':
+    main()
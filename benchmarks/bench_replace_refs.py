@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""Reference rewriting benchmark: `urn:uuid:` placeholders of a transaction
+Bundle replaced one by one (`replace_refs`) vs in a single pass
+(`replace_bundle_refs`).
+
+Replacing references one by one is quadratic, so it is measured for a
+sample of the mapping and extrapolated to the whole Bundle.
+
+Usage: python benchmarks/bench_replace_refs.py [--size N] [--sample N]
+"""
+from __future__ import print_function, division
+import argparse
+import os
+import sys
+import time
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+PROJECT_PATH = os.path.dirname(BASE_PATH)
+sys.path.append(PROJECT_PATH)
+sys.path.append(BASE_PATH)
+
+
+def to_placeholders(bundle):
+    """Make a transaction Bundle refer to its entries by placeholders
+
+    :param bundle: Bundle (raw JSON), modified in place
+    :return: mapping of placeholders to server references
+    """
+    placeholders = {}
+    for index, entry in enumerate(bundle['entry']):
+        resource = entry['resource']
+        reference = '{}/{}'.format(resource['resourceType'], resource['id'])
+        placeholders[reference] = 'urn:uuid:{:032x}'.format(index)
+    for entry in bundle['entry']:
+        resource = entry['resource']
+        reference = '{}/{}'.format(resource['resourceType'], resource['id'])
+        entry['fullUrl'] = placeholders[reference]
+        del resource['id']
+        subject = resource.get('subject')
+        if subject is not None:
+            subject['reference'] = placeholders[subject['reference']]
+    return {v: k for k, v in placeholders.items()}
+
+
+def main():
+    from fhir_tools import readers, resources
+    import corpus
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=5000,
+                        help='number of entries in the Bundle')
+    parser.add_argument('--sample', type=int, default=20,
+                        help='number of mapping entries replaced one by one')
+    args = parser.parse_args()
+
+    repo = resources.Resources(readers.defs_from_generated())
+    raw = corpus.bundle(corpus.generate(args.size), 'transaction')
+    mapping = to_placeholders(raw)
+    bundle = repo.from_json(raw)
+
+    sample = sorted(mapping)[:args.sample]
+    start = time.time()
+    for old in sample:
+        for entry in bundle.entry:
+            entry.resource.replace_refs(old, mapping[old])
+    one_by_one = (time.time() - start) / len(sample) * len(mapping)
+
+    bundle = repo.from_json(raw)
+    start = time.time()
+    _, replaced = repo.replace_bundle_refs(bundle, mapping)
+    single_pass = time.time() - start
+
+    print('{} entries, {} placeholders, {} references replaced'.format(
+        len(bundle.entry), len(mapping), replaced))
+    print('{:<24} {:10.3f} s (extrapolated from {} placeholders)'.format(
+        'replace_refs', one_by_one, len(sample)))
+    print('{:<24} {:10.3f} s'.format('replace_bundle_refs', single_pass))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""Serialization benchmark: `json.dumps` vs `to_json_bytes` and
+`NDJSONWriter` with every available backend.
+
+Usage: python benchmarks/bench_serialize.py [--size N] [--repeat N]
+"""
+from __future__ import print_function
+import argparse
+import io
+import json
+import os
+import sys
+import timeit
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+PROJECT_PATH = os.path.dirname(BASE_PATH)
+sys.path.append(PROJECT_PATH)
+sys.path.append(BASE_PATH)
+
+
+def main():
+    from fhir_tools import readers, resources, serialization
+    import corpus
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    repo = resources.Resources(readers.defs_from_generated())
+    data = [repo.from_json(r) for r in corpus.generate(args.size)]
+    backends = [serialization.JSON]
+    if serialization.orjson is not None:
+        backends.append(serialization.ORJSON)
+
+    def bench(name, func):
+        best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+        print('{:<32} {:10.0f} resources/s'.format(name, len(data) / best))
+
+    def write_ndjson(backend):
+        with serialization.NDJSONWriter(io.BytesIO(),
+                                        backend=backend) as writer:
+            writer.write_many(data)
+
+    bench('json.dumps', lambda: [json.dumps(r).encode('utf-8')
+                                 for r in data])
+    for backend in backends:
+        bench('to_json_bytes ({})'.format(backend),
+              lambda: [serialization.to_json_bytes(r, backend)
+                       for r in data])
+        bench('NDJSONWriter ({})'.format(backend),
+              lambda: write_ndjson(backend))
+
+
+if __name__ == '__main__':
+    main()
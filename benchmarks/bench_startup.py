@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""Start-up benchmark: eager vs lazy class generation.
+
+Every measurement is done in a fresh interpreter, so numbers reflect the
+cold start of a worker process.
+
+Usage: python benchmarks/bench_startup.py [--runs N]
+"""
+from __future__ import print_function
+import argparse
+import os
+import subprocess
+import sys
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+PROJECT_PATH = os.path.dirname(BASE_PATH)
+
+USED_RESOURCES = [
+    'Patient', 'Observation', 'Encounter', 'Condition', 'Practitioner',
+    'Organization', 'MedicationRequest', 'Procedure', 'DiagnosticReport',
+    'Bundle'
+]
+
+CHILD = """
+import sys, time
+sys.path.insert(0, {project!r})
+from fhir_tools import readers, resources
+definitions = readers.defs_from_generated()
+start = time.time()
+repo = resources.Resources(definitions, lazy={lazy!r})
+created = time.time()
+for name in {names!r}:
+    repo.get(name)
+done = time.time()
+print(created - start, done - start)
+"""
+
+
+def run_child(lazy):
+    code = CHILD.format(project=PROJECT_PATH, lazy=lazy, names=USED_RESOURCES)
+    output = subprocess.check_output([sys.executable, '-c', code])
+    init, total = output.split()
+    return float(init), float(total)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    for lazy in (False, True):
+        results = [run_child(lazy) for _ in range(args.runs)]
+        init = sorted(r[0] for r in results)[len(results) // 2]
+        total = sorted(r[1] for r in results)[len(results) // 2]
+        print('{:<6} init: {:8.2f} ms   init + {} resources: {:8.2f} ms'.format(
+            'lazy' if lazy else 'eager', init * 1000, len(USED_RESOURCES),
+            total * 1000))
+
+
+if __name__ == '__main__':
+    main()
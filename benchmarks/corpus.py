@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""Synthetic, deterministic FHIR corpus used by benchmarks."""
+from __future__ import unicode_literals
+import random
+
+GIVEN = ['John', 'Jane', 'Alex', 'Maria', 'Peter', 'Olga', 'Ivan', 'Anna']
+FAMILY = ['Doe', 'Smith', 'Ivanov', 'Garcia', 'Miller', 'Novak', 'Kim']
+LOINC = [
+    ('8867-4', 'Heart rate', '/min'),
+    ('8310-5', 'Body temperature', 'Cel'),
+    ('29463-7', 'Body weight', 'kg'),
+    ('8302-2', 'Body height', 'cm'),
+    ('2339-0', 'Glucose', 'mg/dL'),
+]
+
+
+def patient(index, rnd):
+    return {
+        'resourceType': 'Patient',
+        'id': 'patient-{}'.format(index),
+        'meta': {
+            'versionId': '1',
+            'lastUpdated': '2019-01-01T00:00:00Z'
+        },
+        'identifier': [{
+            'use': 'usual',
+            'system': 'urn:oid:1.2.36.146.595.217.0.1',
+            'value': '{:08d}'.format(index),
+            'period': {
+                'start': '2001-05-06'
+            },
+            'assigner': {
+                'reference': 'Organization/1',
+                'display': 'Acme Healthcare'
+            }
+        }],
+        'active': True,
+        'name': [{
+            'use': 'official',
+            'family': rnd.choice(FAMILY),
+            'given': [rnd.choice(GIVEN), rnd.choice(GIVEN)]
+        }],
+        'telecom': [{
+            'system': 'phone',
+            'value': '(03) 5555 {:04d}'.format(index % 10000),
+            'use': 'work',
+            'rank': 1
+        }],
+        'gender': rnd.choice(['male', 'female']),
+        'birthDate': '19{:02d}-12-25'.format(rnd.randint(30, 99)),
+        'deceasedBoolean': False,
+        'address': [{
+            'use': 'home',
+            'type': 'both',
+            'line': ['534 Erewhon St'],
+            'city': 'PleasantVille',
+            'postalCode': '3999',
+            'period': {
+                'start': '1974-12-25'
+            }
+        }],
+        'contact': [{
+            'relationship': [{
+                'coding': [{
+                    'system': 'http://terminology.hl7.org/CodeSystem/v2-0131',
+                    'code': 'N'
+                }]
+            }],
+            'name': {
+                'family': rnd.choice(FAMILY),
+                'given': [rnd.choice(GIVEN)]
+            },
+            'gender': 'female',
+            'organization': {
+                'reference': 'Organization/1'
+            }
+        }],
+        'generalPractitioner': [{
+            'reference': 'Practitioner/{}'.format(index % 50)
+        }],
+        'managingOrganization': {
+            'reference': 'Organization/1'
+        }
+    }
+
+
+def observation(index, rnd, patient_id):
+    code, display, unit = rnd.choice(LOINC)
+    return {
+        'resourceType': 'Observation',
+        'id': 'observation-{}'.format(index),
+        'meta': {
+            'versionId': '1',
+            'lastUpdated': '2019-01-01T00:00:00Z'
+        },
+        'status': 'final',
+        'category': [{
+            'coding': [{
+                'system': 'http://terminology.hl7.org/'
+                          'CodeSystem/observation-category',
+                'code': 'vital-signs',
+                'display': 'Vital Signs'
+            }]
+        }],
+        'code': {
+            'coding': [{
+                'system': 'http://loinc.org',
+                'code': code,
+                'display': display
+            }],
+            'text': display
+        },
+        'subject': {
+            'reference': 'Patient/{}'.format(patient_id)
+        },
+        'encounter': {
+            'reference': 'Encounter/{}'.format(index % 100)
+        },
+        'effectiveDateTime': '2019-0{}-1{}T10:30:00Z'.format(
+            rnd.randint(1, 9), rnd.randint(0, 9)),
+        'issued': '2019-10-10T10:30:00.000Z',
+        'performer': [{
+            'reference': 'Practitioner/{}'.format(index % 50)
+        }],
+        'valueQuantity': {
+            'value': round(rnd.uniform(10, 200), 1),
+            'unit': unit,
+            'system': 'http://unitsofmeasure.org',
+            'code': unit
+        },
+        'interpretation': [{
+            'coding': [{
+                'system': 'http://terminology.hl7.org/'
+                          'CodeSystem/v3-ObservationInterpretation',
+                'code': 'N'
+            }]
+        }],
+        'referenceRange': [{
+            'low': {
+                'value': 10,
+                'unit': unit
+            },
+            'high': {
+                'value': 200,
+                'unit': unit
+            }
+        }]
+    }
+
+
+def generate(size=1000, observations_per_patient=4, seed=0):
+    """Generate a list of Patient and Observation resources (raw JSON)
+
+    :param size: total number of resources
+    :param observations_per_patient: number of observations per patient
+    :param seed: seed for random number generator
+    :return: list of resources
+    """
+    rnd = random.Random(seed)
+    result = []
+    index = 0
+    while len(result) < size:
+        result.append(patient(index, rnd))
+        for i in range(observations_per_patient):
+            if len(result) >= size:
+                break
+            result.append(observation(
+                index * observations_per_patient + i, rnd,
+                'patient-{}'.format(index)))
+        index += 1
+    return result
+
+
+def bundle(resources, bundle_type='collection'):
+    """Wrap resources into a Bundle
+
+    :param resources: list of resources (raw JSON)
+    :param bundle_type: type of the bundle
+    :return: Bundle resource (raw JSON)
+    """
+    return {
+        'resourceType': 'Bundle',
+        'type': bundle_type,
+        'entry': [{
+            'fullUrl': 'http://example.org/fhir/{}/{}'.format(
+                r['resourceType'], r['id']),
+            'resource': r
+        } for r in resources]
+    }
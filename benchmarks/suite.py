@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""Benchmark suite for the hot paths of fhir_tools.
+
+Every case runs offline against the synthetic corpus (see `corpus.py`) and
+reports throughput (ops/s), latency percentiles of a single operation and
+peak memory allocated during one round. Results can be saved as a JSON
+baseline and compared with a later run:
+
+    python benchmarks/suite.py --save baseline.json
+    python benchmarks/suite.py --compare baseline.json --threshold 10
+
+Comparison exits with status 1 if any case got slower than the threshold.
+
+Usage: python benchmarks/suite.py [--size N] [--rounds N] [--case NAME]
+                                  [--save FILE] [--compare FILE]
+"""
+from __future__ import print_function, division
+import argparse
+import copy
+import gc
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+PROJECT_PATH = os.path.dirname(BASE_PATH)
+sys.path.append(PROJECT_PATH)
+sys.path.append(BASE_PATH)
+
+from fhir_tools import diff, frozen, paths, readers, resources  # noqa: E402
+from fhir_tools import store, validation  # noqa: E402
+import corpus  # noqa: E402
+
+clock = timeit.default_timer
+
+#: Benchmark cases, filled by the `case` decorator
+CASES = []
+
+
+def case(func):
+    """Register a benchmark case
+
+    Case function is called with the benchmark context and returns a pair
+    `(prepare, operation)`: `prepare()` returns a list of arguments for
+    one round (it is not timed), `operation(argument)` is timed for every
+    argument.
+    """
+    CASES.append(func)
+    return func
+
+
+class Context(object):
+    """Data shared between benchmark cases (created once)"""
+    def __init__(self, size):
+        self.definitions = readers.defs_from_generated()
+        self.resources = resources.Resources(self.definitions)
+        self.raw = corpus.generate(size)
+        self.parsed = [self.resources.from_json(r) for r in self.raw]
+        self.db = []
+        for resource in self.parsed:
+            resource = copy.deepcopy(resource)
+            resource.to_db_format()
+            self.db.append(resource)
+        self.db_raw = [json.loads(json.dumps(r)) for r in self.db]
+        self.directory = tempfile.mkdtemp()
+        self.frozen_file = os.path.join(self.directory, 'definitions')
+        frozen.freeze(self.definitions, self.frozen_file)
+
+    def close(self):
+        """Remove temporary files"""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _once(func):
+    return lambda: [None], lambda _: func()
+
+
+@case
+def defs_from_generated(ctx):
+    return _once(readers.defs_from_generated)
+
+
+@case
+def defs_from_generated_no_cache(ctx):
+    return _once(lambda: readers.defs_from_generated(use_cache=False))
+
+
+@case
+def defs_from_frozen(ctx):
+    def operation(_):
+        definitions = frozen.FrozenDefinitions(ctx.frozen_file)
+        definitions.find('Patient.name.family')
+        definitions.close()
+    return lambda: [None], operation
+
+
+@case
+def resources_init(ctx):
+    return _once(lambda: resources.Resources(ctx.definitions))
+
+
+@case
+def resources_init_lazy(ctx):
+    return _once(lambda: resources.Resources(ctx.definitions, lazy=True))
+
+
+@case
+def from_json(ctx):
+    return lambda: ctx.raw, ctx.resources.from_json
+
+
+@case
+def wrap(ctx):
+    # Routing-like access: a few top-level fields only
+    def operation(raw):
+        resource = ctx.resources.wrap(raw)
+        return resource.id, resource.get('subject')
+    return lambda: ctx.raw, operation
+
+
+@case
+def from_db_json(ctx):
+    return lambda: ctx.db_raw, ctx.resources.from_db_json
+
+
+@case
+def to_db_format(ctx):
+    def prepare():
+        return [copy.deepcopy(r) for r in ctx.parsed]
+    return prepare, lambda r: r.to_db_format()
+
+
+@case
+def to_fhir_format(ctx):
+    def prepare():
+        return [copy.deepcopy(r) for r in ctx.db]
+    return prepare, lambda r: r.to_fhir_format()
+
+
+@case
+def replace_refs(ctx):
+    def prepare():
+        return [copy.deepcopy(r) for r in ctx.parsed]
+    return prepare, lambda r: r.replace_refs('Organization/1',
+                                             'Organization/2')
+
+
+@case
+def replace_refs_many(ctx):
+    mapping = {'Practitioner/{}'.format(i): 'Practitioner/new-{}'.format(i)
+               for i in range(50)}
+    mapping['Organization/1'] = 'Organization/2'
+
+    def prepare():
+        return [copy.deepcopy(r) for r in ctx.parsed]
+    return prepare, lambda r: r.replace_refs_many(mapping)
+
+
+@case
+def extract_references(ctx):
+    return lambda: ctx.raw, lambda r: list(
+        ctx.resources.extract_references([r]))
+
+
+@case
+def extract_columns(ctx):
+    extractor = paths.ColumnExtractor(ctx.definitions, [
+        'Observation.valueQuantity.value',
+        'Observation.effectiveDateTime',
+        'Observation.subject.reference',
+    ])
+    return lambda: ctx.raw, lambda r: extractor.extract_lists([r])
+
+
+@case
+def evaluate_path(ctx):
+    compiled = paths.PathEngine(ctx.definitions).compile(
+        "Patient.identifier.where(system='urn:oid:1.2.36.146.595.217.0.1')"
+        ".value")
+    return lambda: ctx.parsed, compiled
+
+
+@case
+def store_search(ctx):
+    resource_store = store.ResourceStore(ctx.resources)
+    resource_store.add_index('subject', 'Observation.subject',
+                             store.REFERENCE)
+    resource_store.put_many(ctx.parsed)
+
+    def prepare():
+        return ['Patient/' + r['id'] for r in ctx.raw
+                if r['resourceType'] == 'Patient']
+    return prepare, lambda ref: resource_store.search(
+        'Observation', 'subject', ref)
+
+
+@case
+def diff_versions(ctx):
+    differ = diff.Differ(ctx.definitions)
+
+    def prepare():
+        versions = []
+        for raw, resource in zip(ctx.raw, ctx.parsed):
+            new = ctx.resources.from_json(copy.deepcopy(raw))
+            new['meta'] = {'versionId': '2'}
+            versions.append((resource, new))
+        return versions
+    return prepare, lambda versions: differ.diff(*versions)
+
+
+@case
+def validate(ctx):
+    validator = validation.Validator(ctx.definitions)
+    return lambda: ctx.raw, validator.validate
+
+
+def percentile(values, percent):
+    """Get percentile of sorted values (nearest rank)
+
+    :param values: sorted list of values
+    :param percent: percentile (0-100)
+    :return: value
+    """
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def run_case(func, ctx, rounds):
+    """Run a benchmark case
+
+    :param func: case function
+    :param ctx: benchmark context
+    :param rounds: number of rounds
+    :return: dictionary with results
+    """
+    prepare, operation = func(ctx)
+    latencies = []
+    total = 0.0
+    for _ in range(rounds):
+        args = prepare()
+        gc.collect()
+        for arg in args:
+            start = clock()
+            operation(arg)
+            latencies.append(clock() - start)
+        total += sum(latencies[-len(args):])
+    latencies.sort()
+    result = {
+        'ops': len(latencies),
+        'ops_per_sec': len(latencies) / total if total else None,
+        'p50_us': percentile(latencies, 50) * 1e6,
+        'p95_us': percentile(latencies, 95) * 1e6,
+        'p99_us': percentile(latencies, 99) * 1e6,
+        'peak_kb': None,
+    }
+    if tracemalloc is not None:
+        # Separate round, tracing slows down allocations considerably.
+        # Results are kept, so peak includes everything the round created
+        args = prepare()
+        gc.collect()
+        tracemalloc.start()
+        kept = [operation(arg) for arg in args]
+        result['peak_kb'] = tracemalloc.get_traced_memory()[1] / 1024.0
+        tracemalloc.stop()
+        del kept
+    return result
+
+
+def environment():
+    """Describe the environment results were obtained in"""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=PROJECT_PATH,
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print comparison with a baseline
+
+    :param results: results of the current run
+    :param baseline: saved results
+    :param threshold: allowed slowdown (percent)
+    :return: list of regressed cases
+    """
+    regressions = []
+    print()
+    print('{:<30} {:>12} {:>12} {:>8}'.format('case', 'baseline', 'current',
+                                             'change'))
+    for name, result in sorted(results.items()):
+        old = baseline.get(name)
+        if not old or not old['ops_per_sec'] or not result['ops_per_sec']:
+            continue
+        change = (result['ops_per_sec'] / old['ops_per_sec'] - 1) * 100
+        regressed = change < -threshold
+        if regressed:
+            regressions.append(name)
+        print('{:<30} {:12.0f} {:12.0f} {:+7.1f}%{}'.format(
+            name, old['ops_per_sec'], result['ops_per_sec'], change,
+            '  REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=1000,
+                        help='number of resources in the corpus')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='number of rounds per case')
+    parser.add_argument('--case', action='append', dest='cases',
+                        help='run only selected cases (can be repeated)')
+    parser.add_argument('--save', help='save results to a JSON file')
+    parser.add_argument('--compare', help='compare with saved results')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='allowed slowdown in percent (default: 10)')
+    args = parser.parse_args()
+
+    cases = [c for c in CASES if not args.cases or c.__name__ in args.cases]
+    if not cases:
+        parser.error('No cases selected')
+
+    ctx = Context(args.size)
+    results = {}
+    print('{:<30} {:>12} {:>10} {:>10} {:>10} {:>10}'.format(
+        'case', 'ops/s', 'p50 us', 'p95 us', 'p99 us', 'peak KB'))
+    try:
+        for func in cases:
+            result = results[func.__name__] = run_case(func, ctx, args.rounds)
+            print('{:<30} {:12.0f} {:10.1f} {:10.1f} {:10.1f} {:>10}'.format(
+                func.__name__, result['ops_per_sec'], result['p50_us'],
+                result['p95_us'], result['p99_us'],
+                '-' if result['peak_kb'] is None else
+                '{:.0f}'.format(result['peak_kb'])))
+    finally:
+        ctx.close()
+
+    if args.save:
+        with open(args.save, 'w') as fp:
+            json.dump({
+                'environment': environment(),
+                'size': args.size,
+                'rounds': args.rounds,
+                'results': results,
+            }, fp, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        if baseline.get('size') != args.size:
+            print('Warning: baseline corpus size is {}'.format(
+                baseline.get('size')))
+        if compare(results, baseline['results'], args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""Reading FHIR data from asyncio streams (Python 3 only).
+
+Data is read from an :class:`asyncio.StreamReader` (or any object with a
+coroutine `read(size)` method) or an async iterable of byte chunks. Parsing
+and decoding run in an executor, so the event loop is not blocked by large
+payloads. Input is split into batches, at most `max_pending` batches are
+decoded at once: the stream is read only as fast as resources are
+consumed.
+
+Executor has to be a thread pool (the default executor of the loop is
+used if none is given): generated classes can not be pickled, so FHIR
+objects can not be returned from worker processes.
+"""
+import asyncio
+import collections
+
+from . import streaming
+
+#: Default number of lines (entries) decoded in a single batch
+DEFAULT_BATCH_SIZE = 100
+#: Default maximum number of batches being decoded at once
+DEFAULT_MAX_PENDING = 4
+#: Default size of chunks read from a stream (bytes)
+DEFAULT_READ_SIZE = 64 * 1024
+
+
+async def iter_ndjson(resources, source, db_format=False, to_db=False,
+                      resource_types=None, skip_unknown=False, on_error=None,
+                      executor=None, batch_size=DEFAULT_BATCH_SIZE,
+                      max_pending=DEFAULT_MAX_PENDING,
+                      read_size=DEFAULT_READ_SIZE):
+    """Read resources from NDJSON stream
+
+    See :meth:`fhir_tools.resources.Resources.iter_ndjson`.
+
+    :param resources: repository of FHIR classes
+                      (:class:`fhir_tools.resources.Resources`)
+    :param source: stream reader or async iterable of chunks (bytes)
+    :param db_format: resources are in a DB friendly format (they are
+                      converted to a default FHIR representation)
+    :param to_db: convert resources to a DB friendly format
+    :param resource_types: only return resources of provided types
+    :param skip_unknown: silently skip resources of unknown types
+                         (otherwise they are reported as errors)
+    :param on_error: callback for malformed lines, called (in the event loop)
+                     with :class:`fhir_tools.streaming.ParseError`
+                     (by default error is raised)
+    :param executor: thread pool executor (default executor of the loop
+                     by default)
+    :param batch_size: number of lines decoded in a single batch
+    :param max_pending: maximum number of batches being decoded at once
+    :param read_size: size of chunks read from a stream reader
+    :return: async generator object that will yield FHIR objects
+    """
+    def decode(batch):
+        # Errors are kept in order with resources and reported by the loop
+        results = []
+        lines = streaming.parse_ndjson_lines(batch, results.append)
+        for resource in resources.decode_ndjson_lines(
+                lines, db_format, resource_types, skip_unknown,
+                results.append):
+            if to_db:
+                resource.to_db_format()
+            results.append(resource)
+        return results
+
+    batches = _ndjson_batches(source, batch_size, read_size)
+    async for results in _pipeline(batches, decode, executor, max_pending):
+        for result in results:
+            if isinstance(result, streaming.ParseError):
+                streaming.report_error(result, on_error)
+            else:
+                yield result
+
+
+async def iter_bundle_entries(resources, source, db_format=False,
+                              to_db=False, executor=None,
+                              batch_size=DEFAULT_BATCH_SIZE,
+                              max_pending=DEFAULT_MAX_PENDING,
+                              read_size=DEFAULT_READ_SIZE, parser=None):
+    """Read entries of a Bundle from a stream
+
+    See :meth:`fhir_tools.resources.Resources.iter_bundle_entries`.
+
+    :param resources: repository of FHIR classes
+                      (:class:`fhir_tools.resources.Resources`)
+    :param source: stream reader or async iterable of chunks (bytes)
+    :param db_format: resources are in a DB friendly format (they are
+                      converted to a default FHIR representation)
+    :param to_db: convert resources of entries to a DB friendly format
+    :param executor: thread pool executor (default executor of the loop
+                     by default)
+    :param batch_size: number of entries decoded in a single batch
+    :param max_pending: maximum number of batches being decoded at once
+    :param read_size: size of chunks read from a stream reader
+    :param parser: :class:`fhir_tools.streaming.BundleParser` to use
+                   (can be provided to access Bundle metadata)
+    :return: async generator object that will yield `Bundle.Entry` objects
+    :raises fhir_tools.streaming.ParseError: if data is not a valid Bundle
+    """
+    entry_class = resources.get('Bundle').Entry
+
+    def decode(batch):
+        entries = []
+        for entry in batch:
+            if db_format:
+                entry = entry_class.from_db_json(entry)
+            else:
+                entry = entry_class.from_json(entry)
+            if to_db and 'resource' in entry:
+                entry.resource.to_db_format()
+            entries.append(entry)
+        return entries
+
+    if parser is None:
+        parser = streaming.BundleParser()
+    batches = _bundle_batches(source, parser, executor, batch_size,
+                              read_size)
+    async for entries in _pipeline(batches, decode, executor, max_pending):
+        for entry in entries:
+            yield entry
+
+
+async def _iter_chunks(source, read_size):
+    if hasattr(source, 'read'):
+        while True:
+            chunk = await source.read(read_size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        async for chunk in source:
+            yield chunk
+
+
+async def _ndjson_batches(source, batch_size, read_size):
+    batch = []
+    line_number = 1
+    parts = []  # Parts of an incomplete line
+    async for chunk in _iter_chunks(source, read_size):
+        lines = chunk.split(b'\n')
+        parts.append(lines[0])
+        if len(lines) == 1:
+            continue
+        lines[0] = b''.join(parts)
+        parts = [lines.pop()]
+        for line in lines:
+            batch.append((line_number, line))
+            line_number += 1
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if parts:
+        batch.append((line_number, b''.join(parts)))
+    if batch:
+        yield batch
+
+
+async def _bundle_batches(source, parser, executor, batch_size, read_size):
+    loop = asyncio.get_running_loop()
+    batch = []
+    async for chunk in _iter_chunks(source, read_size):
+        # Parser is stateful, chunks are parsed one at a time
+        batch.extend(await loop.run_in_executor(executor, parser.feed, chunk))
+        while len(batch) >= batch_size:
+            yield batch[:batch_size]
+            batch = batch[batch_size:]
+    batch.extend(await loop.run_in_executor(executor, parser.close))
+    if batch:
+        yield batch
+
+
+async def _pipeline(batches, func, executor, max_pending):
+    """Process batches in an executor
+
+    :return: async generator object that will yield results of `func` in
+             the order of batches
+    """
+    loop = asyncio.get_running_loop()
+    pending = collections.deque()
+    try:
+        async for batch in batches:
+            if len(pending) >= max_pending:
+                yield await pending.popleft()
+            pending.append(loop.run_in_executor(executor, func, batch))
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""Structural diff of FHIR objects as JSON Patch (RFC 6902).
+
+Objects are compared element by element, following element definitions:
+complex types and backbone elements are compared recursively, arrays
+(`is_array` elements) position by position and primitive values by
+equality. Subtrees that are the same object (e.g. when a new version was
+created from a shallow copy of the old one) or equal are skipped without
+walking them.
+"""
+from __future__ import unicode_literals
+import copy
+
+import six
+from six.moves import collections_abc
+
+#: Add operation
+ADD = 'add'
+#: Remove operation
+REMOVE = 'remove'
+#: Replace operation
+REPLACE = 'replace'
+#: Move operation (only applied, never generated)
+MOVE = 'move'
+#: Copy operation (only applied, never generated)
+COPY = 'copy'
+#: Test operation (only applied, never generated)
+TEST = 'test'
+
+# Element kinds
+_PRIMITIVE = 0
+_COMPLEX = 1
+_RESOURCE = 2
+
+_Mapping = collections_abc.Mapping
+_NUMBERS = six.integer_types + (float,)
+
+
+class PatchError(ValueError):
+    """Patch can not be applied"""
+
+
+def _escape(key):
+    if '~' in key or '/' in key:
+        return key.replace('~', '~0').replace('/', '~1')
+    return key
+
+
+def _unescape(token):
+    return token.replace('~1', '/').replace('~0', '~')
+
+
+class Differ(object):
+    """Generator of JSON Patches between versions of resources.
+
+    Definitions of elements are resolved once per element path and kept
+    for the lifetime of the differ.
+
+    :param definitions: definitions
+                        (:class:`fhir_tools.readers.Definitions` or
+                        :class:`fhir_tools.frozen.FrozenDefinitions`)
+    """
+    def __init__(self, definitions):
+        self.definitions = definitions
+        # (definition path, key) -> (child path, is array, kind),
+        # `None` for keys that are not elements
+        self._elements = {}
+
+    def diff(self, old, new):
+        """Compute difference between two versions of a resource
+
+        Values of generated operations are taken from the new version
+        (they are not copied).
+
+        :param old: old version (FHIR object or parsed JSON)
+        :param new: new version (FHIR object or parsed JSON)
+        :return: list of JSON Patch operations (dicts), empty if versions
+                 are equal
+        """
+        ops = []
+        if old is new:
+            return ops
+        resource_type = new.get('resourceType')
+        if resource_type is None or \
+                old.get('resourceType') != resource_type:
+            ops.append({'op': REPLACE, 'path': '', 'value': new})
+        else:
+            self._diff_object(old, new, resource_type, '', ops)
+        return ops
+
+    def _element(self, path, key):
+        try:
+            return self._elements[(path, key)]
+        except KeyError:
+            pass
+        try:
+            element = self.definitions.find('{}.{}'.format(path, key))
+        except KeyError:
+            element = None
+        if element is None or element.is_polymorphic:
+            # Unknown element, `resourceType` or extension of a primitive
+            # (`_birthDate`), compared as a whole
+            result = None
+        else:
+            _type = element.type
+            if _type.code in ('Resource', 'DomainResource'):
+                result = (None, element.is_array, _RESOURCE)
+            elif _type.is_backbone:
+                result = ('{}.{}'.format(path, key), element.is_array,
+                          _COMPLEX)
+            elif _type.is_complex:
+                result = (_type.code, element.is_array, _COMPLEX)
+            else:
+                result = (None, element.is_array, _PRIMITIVE)
+        self._elements[(path, key)] = result
+        return result
+
+    def _diff_object(self, old, new, path, pointer, ops):
+        for key in old:
+            if key not in new:
+                ops.append({'op': REMOVE,
+                            'path': pointer + '/' + _escape(key)})
+        for key, value in six.iteritems(new):
+            if key not in old:
+                ops.append({'op': ADD, 'path': pointer + '/' + _escape(key),
+                            'value': value})
+                continue
+            old_value = old[key]
+            # Equal subtrees are skipped (comparison of builtin containers
+            # is much faster than walking them)
+            if old_value is value or old_value == value:
+                continue
+            key_pointer = pointer + '/' + _escape(key)
+            element = self._element(path, key)
+            if element is None:
+                ops.append({'op': REPLACE, 'path': key_pointer,
+                            'value': value})
+                continue
+            child_path, is_array, kind = element
+            if is_array:
+                if isinstance(old_value, list) and isinstance(value, list):
+                    self._diff_array(old_value, value, child_path, kind,
+                                     key_pointer, ops)
+                else:
+                    ops.append({'op': REPLACE, 'path': key_pointer,
+                                'value': value})
+            else:
+                self._diff_value(old_value, value, child_path, kind,
+                                 key_pointer, ops)
+
+    def _diff_array(self, old, new, path, kind, pointer, ops):
+        common = min(len(old), len(new))
+        for index in range(common):
+            old_value = old[index]
+            value = new[index]
+            if old_value is value or old_value == value:
+                continue
+            index_pointer = '{}/{}'.format(pointer, index)
+            if kind == _PRIMITIVE:
+                ops.append({'op': REPLACE, 'path': index_pointer,
+                            'value': value})
+            else:
+                self._diff_value(old_value, value, path, kind,
+                                 index_pointer, ops)
+        for index in range(common, len(new)):
+            ops.append({'op': ADD, 'path': '{}/{}'.format(pointer, index),
+                        'value': new[index]})
+        # From the end, so that indexes of remaining values do not change
+        for index in range(len(old) - 1, common - 1, -1):
+            ops.append({'op': REMOVE,
+                        'path': '{}/{}'.format(pointer, index)})
+
+    def _diff_value(self, old, new, path, kind, pointer, ops):
+        # Values are known to be different
+        if kind == _RESOURCE and isinstance(old, _Mapping) and \
+                isinstance(new, _Mapping):
+            path = new.get('resourceType')
+            if path is not None and old.get('resourceType') == path:
+                self._diff_object(old, new, path, pointer, ops)
+                return
+        elif kind == _COMPLEX and isinstance(old, _Mapping) and \
+                isinstance(new, _Mapping):
+            self._diff_object(old, new, path, pointer, ops)
+            return
+        ops.append({'op': REPLACE, 'path': pointer, 'value': new})
+
+
+def _parse_pointer(pointer):
+    if pointer == '':
+        return []
+    if not pointer.startswith('/'):
+        raise PatchError('Invalid pointer: {}'.format(pointer))
+    return [_unescape(t) for t in pointer[1:].split('/')]
+
+
+def _array_index(container, token, allow_end):
+    if token == '-' and allow_end:
+        return len(container)
+    if not token.isdigit() or (token != '0' and token.startswith('0')):
+        raise PatchError('Invalid array index: {}'.format(token))
+    index = int(token)
+    if index > len(container) or (index == len(container) and
+                                  not allow_end):
+        raise PatchError('Array index out of range: {}'.format(token))
+    return index
+
+
+def _resolve(document, tokens):
+    for token in tokens:
+        try:
+            if isinstance(document, list):
+                document = document[_array_index(document, token, False)]
+            else:
+                document = document[token]
+        except (KeyError, TypeError):
+            raise PatchError('Path not found: {}'.format(token))
+    return document
+
+
+def _json_equal(a, b):
+    # RFC 6902 (4.6): values of different JSON types are never equal
+    # (`True` is not `1`), numbers are compared numerically
+    if isinstance(a, bool) or isinstance(b, bool):
+        return isinstance(a, bool) and isinstance(b, bool) and a == b
+    if isinstance(a, _NUMBERS) or isinstance(b, _NUMBERS):
+        return isinstance(a, _NUMBERS) and isinstance(b, _NUMBERS) and \
+            a == b
+    if isinstance(a, list) or isinstance(b, list):
+        return isinstance(a, list) and isinstance(b, list) and \
+            len(a) == len(b) and all(_json_equal(x, y) for x, y in zip(a, b))
+    if isinstance(a, _Mapping) or isinstance(b, _Mapping):
+        return isinstance(a, _Mapping) and isinstance(b, _Mapping) and \
+            len(a) == len(b) and \
+            all(key in b and _json_equal(value, b[key])
+                for key, value in six.iteritems(a))
+    return a == b
+
+
+def _get(document, pointer):
+    return _resolve(document, _parse_pointer(pointer))
+
+
+def _add(document, tokens, value):
+    if not tokens:
+        return value
+    parent = _resolve(document, tokens[:-1])
+    token = tokens[-1]
+    if isinstance(parent, list):
+        parent.insert(_array_index(parent, token, True), value)
+    elif isinstance(parent, collections_abc.MutableMapping):
+        try:
+            parent[token] = value
+        except (KeyError, AttributeError, TypeError):
+            # Compact FHIR objects only accept their fields
+            raise PatchError('Can not add {}'.format(token))
+    else:
+        raise PatchError('Can not add to a primitive value')
+    return document
+
+
+def _remove(document, tokens):
+    if not tokens:
+        raise PatchError('Can not remove the whole document')
+    parent = _resolve(document, tokens[:-1])
+    token = tokens[-1]
+    try:
+        if isinstance(parent, list):
+            return parent.pop(_array_index(parent, token, False))
+        return parent.pop(token)
+    except (KeyError, AttributeError, TypeError):
+        raise PatchError('Path not found: {}'.format(token))
+
+
+def apply_patch(document, patch):
+    """Apply JSON Patch to a document
+
+    Document is not modified, the patch is applied to a deep copy.
+
+    :param document: parsed JSON (or FHIR object)
+    :param patch: list of JSON Patch operations
+    :return: patched document
+    :raises PatchError: if an operation is invalid or can not be applied
+    """
+    document = copy.deepcopy(document)
+    for operation in patch:
+        try:
+            op = operation['op']
+            tokens = _parse_pointer(operation['path'])
+            if op in (ADD, REPLACE, TEST):
+                value = operation['value']
+            elif op in (MOVE, COPY):
+                source = operation['from']
+        except KeyError as exc:
+            raise PatchError('Missing member of an operation: {}'.format(
+                exc.args[0]))
+        if op == ADD:
+            document = _add(document, tokens, copy.deepcopy(value))
+        elif op == REMOVE:
+            _remove(document, tokens)
+        elif op == REPLACE:
+            if tokens:
+                _remove(document, tokens)
+            document = _add(document, tokens, copy.deepcopy(value))
+        elif op == MOVE:
+            if operation['path'].startswith(source + '/'):
+                raise PatchError('Can not move a value into itself')
+            value = _remove(document, _parse_pointer(source))
+            document = _add(document, tokens, value)
+        elif op == COPY:
+            value = copy.deepcopy(_get(document, source))
+            document = _add(document, tokens, value)
+        elif op == TEST:
+            if not _json_equal(_resolve(document, tokens), value):
+                raise PatchError('Test failed: {}'.format(operation['path']))
+        else:
+            raise PatchError('Unknown operation: {}'.format(op))
+    return document
@@ -0,0 +1,478 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""Frozen definitions: read-only, memory-mapped definitions store.
+
+Definitions are written once (:func:`freeze`) to a single file of fixed
+size records (structures, elements, types and strings, each stored only
+once) and memory-mapped by :class:`FrozenDefinitions`. Mapped pages are
+never written, so they stay shared between processes (including workers
+of a pre-fork server) and are not counted towards their private memory.
+
+Element and type definitions are decoded on first use, element tables of
+structures are not copied: they are read-only mappings that look paths up
+in the file with a binary search.
+"""
+from __future__ import unicode_literals
+import bisect
+import mmap
+import os
+import struct
+
+import six
+from six.moves import collections_abc
+
+from .readers import ElementDefinition, PathIndex, StructDefinition, Type
+
+#: Version of the frozen definitions format
+FORMAT_VERSION = 1
+
+_MAGIC = b'FHIRDEFS'
+_NONE = 0xFFFFFFFF
+_UNLIMITED = -1
+_SUMMARY = {None: 0, False: 1, True: 2}
+_SUMMARY_VALUES = (None, False, True)
+
+# Sections of the file, in order
+_SECTIONS = (
+    'string_offsets',  # uint32, offsets of strings in `strings` (+ end)
+    'strings',         # UTF-8 encoded strings
+    'types',           # _TYPE records
+    'targets',         # uint32, string indexes of reference targets
+    'elements',        # _ELEMENT records
+    'element_types',   # uint32, type indexes of elements
+    'structs',         # _STRUCT records
+    'entries',         # _ENTRY records (elements of structures, in order)
+    'sorted_entries',  # uint32, entry indexes sorted by path (per struct)
+    'res_names',       # uint32, resource structure indexes sorted by name
+    'type_names',      # uint32, complex type structure indexes sorted by name
+)
+_HEADER = struct.Struct('<8sI' + 'II' * len(_SECTIONS))
+_INDEX = struct.Struct('<I')
+# code, first target, number of targets (-1 if `targets` is missing)
+_TYPE = struct.Struct('<IIi')
+# min, max (-1 if unlimited), isSummary, first type, number of types
+_ELEMENT = struct.Struct('<IiBII')
+# name, base, abstract, first entry, number of entries, number of elements
+# (entries that are not single type variants of polymorphic elements)
+_STRUCT = struct.Struct('<IIBIII')
+# path, element, is single type variant
+_ENTRY = struct.Struct('<IIB')
+
+
+def freeze(definitions, path):
+    """Write definitions to a frozen definitions file
+
+    File is replaced atomically, so it can be rebuilt while other
+    processes have it mapped.
+
+    :param definitions: definitions (:class:`~fhir_tools.readers.Definitions`)
+    :param path: path to the frozen definitions file
+    """
+    writer = _Writer()
+    data = writer.build(definitions)
+    tmp_file = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_file, 'wb') as fp:
+            fp.write(data)
+        os.rename(tmp_file, path)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+class _Writer(object):
+    def __init__(self):
+        self.strings = []
+        self.string_index = {}
+        self.type_index = {}
+        self.element_index = {}
+        self.sections = {name: bytearray() for name in _SECTIONS}
+
+    def string(self, value):
+        try:
+            return self.string_index[value]
+        except KeyError:
+            index = self.string_index[value] = len(self.strings)
+            self.strings.append(value.encode('utf-8'))
+            return index
+
+    def type(self, _type):
+        key = (_type.code, None if _type.to is None else tuple(_type.to))
+        try:
+            return self.type_index[key]
+        except KeyError:
+            pass
+        targets = self.sections['targets']
+        start = len(targets) // _INDEX.size
+        if _type.to is None:
+            count = -1
+        else:
+            count = len(_type.to)
+            for target in _type.to:
+                targets += _INDEX.pack(self.string(target))
+        index = self.type_index[key] = len(self.type_index)
+        self.sections['types'] += _TYPE.pack(self.string(_type.code), start,
+                                             count)
+        return index
+
+    def element(self, element):
+        types = tuple(self.type(t) for t in element.types)
+        _max = _UNLIMITED if element.max is None else element.max
+        summary = _SUMMARY[element.is_summary]
+        key = (element.min, _max, summary, types)
+        try:
+            return self.element_index[key]
+        except KeyError:
+            pass
+        element_types = self.sections['element_types']
+        start = len(element_types) // _INDEX.size
+        for index in types:
+            element_types += _INDEX.pack(index)
+        index = self.element_index[key] = len(self.element_index)
+        self.sections['elements'] += _ELEMENT.pack(
+            element.min, _max, summary, start, len(types))
+        return index
+
+    def build(self, definitions):
+        sections = self.sections
+        index = PathIndex(definitions)
+        # Names are looked up with a binary search over encoded names
+        structs = []
+        for defs in (definitions.res_defs, definitions.type_defs):
+            structs.extend(sorted(six.iteritems(defs),
+                                  key=lambda item: item[0].encode('utf-8')))
+        res_count = len(definitions.res_defs)
+        for name, definition in structs:
+            elements = definition.elements
+            flat = index.elements(name)
+            # Single type variants of polymorphic elements are stored after
+            # elements, they are only visible to `find`
+            paths = list(elements)
+            paths.extend(p for p in flat if p not in elements)
+            start = len(sections['entries']) // _ENTRY.size
+            keys = []
+            for position, path in enumerate(paths):
+                sections['entries'] += _ENTRY.pack(
+                    self.string(path), self.element(flat[path]),
+                    path not in elements)
+                keys.append((path.encode('utf-8'), start + position))
+            for _, entry in sorted(keys):
+                sections['sorted_entries'] += _INDEX.pack(entry)
+            base = _NONE if definition.base is None else self.string(
+                definition.base)
+            sections['structs'] += _STRUCT.pack(
+                self.string(name), base, definition.abstract, start,
+                len(paths), len(elements))
+        for section, first, last in (('res_names', 0, res_count),
+                                     ('type_names', res_count, len(structs))):
+            for position in range(first, last):
+                sections[section] += _INDEX.pack(position)
+
+        offset = 0
+        for value in self.strings:
+            sections['string_offsets'] += _INDEX.pack(offset)
+            offset += len(value)
+        sections['string_offsets'] += _INDEX.pack(offset)
+        sections['strings'] += b''.join(self.strings)
+
+        layout = []
+        offset = _HEADER.size
+        for name in _SECTIONS:
+            # Sections are aligned to 8 bytes
+            offset += -offset % 8
+            layout.extend((offset, len(sections[name])))
+            offset += len(sections[name])
+        data = bytearray(_HEADER.pack(_MAGIC, FORMAT_VERSION, *layout))
+        for name in _SECTIONS:
+            data += b'\0' * (-len(data) % 8)
+            data += sections[name]
+        return bytes(data)
+
+
+class FrozenDefinitions(object):
+    """Definitions backed by a memory-mapped frozen definitions file.
+
+    Has the same interface as :class:`~fhir_tools.readers.Definitions`
+    (`res_defs`, `type_defs`, `get_def`, `find`, `types_from_path`) and can
+    be used to create :class:`~fhir_tools.resources.Resources`.
+
+    Mapping is opened read-only, so definitions opened before `fork` are
+    shared by all child processes. Frozen definitions can be pickled (file
+    is mapped again by the receiving process).
+
+    :param path: path to a file created by :func:`freeze`
+    :param cache_size: number of resolved paths kept by `find`
+    :raises ValueError: if file is not a frozen definitions file (or was
+                        written by a different version)
+    """
+    def __init__(self, path, cache_size=PathIndex.CACHE_SIZE):
+        self.path = path
+        self._cache_size = cache_size
+        with open(path, 'rb') as fp:
+            self._data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        header = None
+        if len(self._data) >= _HEADER.size:
+            header = _HEADER.unpack_from(self._data, 0)
+        if header is None or header[0] != _MAGIC or \
+                header[1] != FORMAT_VERSION:
+            self._data.close()
+            raise ValueError('Not a frozen definitions file: {}'.format(path))
+        sections = {}
+        for position, name in enumerate(_SECTIONS):
+            offset, size = header[2 + position * 2:4 + position * 2]
+            sections[name] = (offset, size)
+        self._offsets = {name: offset
+                         for name, (offset, _) in six.iteritems(sections)}
+        # Decoded definitions (there are only a few hundred of distinct
+        # ones, they are shared by all structures)
+        self._types = {}
+        self._elements = {}
+        self._structs = {}
+        self.res_defs = _Structs(
+            self, 'res_names', sections['res_names'][1] // _INDEX.size)
+        self.type_defs = _Structs(
+            self, 'type_names', sections['type_names'][1] // _INDEX.size)
+        self._path_index = _FrozenPathIndex(self, cache_size)
+
+    def __reduce__(self):
+        return type(self), (self.path, self._cache_size)
+
+    def close(self):
+        """Unmap the file"""
+        self._data.close()
+
+    def types_from_path(self, path):
+        """Get element types
+
+        :param path: point-separated path to the element (can start with a
+                     resource or complex type)
+        :return: type definitions for provided path
+        """
+        element = self.find(path)
+        if element.is_struct_def:
+            raise ValueError('Path does not point to an element')
+        return element.types
+
+    def find(self, path):
+        """Find definition for provided path
+
+        See :meth:`fhir_tools.readers.Definitions.find`.
+
+        :param path: point-separated path to the element or resource
+        :return: Either resource definition or element definition,
+                 depending on the path
+        :raises KeyError: if path can not be resolved
+        """
+        return self._path_index.find(path)
+
+    def get_def(self, name):
+        """Get resource or complex type definition.
+
+        :param name: resource or complex type name
+        :return: resource or complex type definition
+        :raises KeyError: if definition is not found
+        """
+        try:
+            return self.res_defs[name]
+        except KeyError:
+            return self.type_defs[name]
+
+    def _index(self, section, position):
+        return _INDEX.unpack_from(
+            self._data, self._offsets[section] + position * _INDEX.size)[0]
+
+    def _string_bytes(self, index):
+        offset = self._offsets['string_offsets'] + index * _INDEX.size
+        start, end = struct.unpack_from('<II', self._data, offset)
+        strings = self._offsets['strings']
+        return self._data[strings + start:strings + end]
+
+    def _string(self, index):
+        return self._string_bytes(index).decode('utf-8')
+
+    def _type(self, index):
+        try:
+            return self._types[index]
+        except KeyError:
+            pass
+        code, start, count = _TYPE.unpack_from(
+            self._data, self._offsets['types'] + index * _TYPE.size)
+        _json = {'code': self._string(code)}
+        if count >= 0:
+            _json['targets'] = [
+                self._string(self._index('targets', start + position))
+                for position in range(count)]
+        _type = self._types[index] = Type(_json, self.type_defs)
+        return _type
+
+    def _element(self, index):
+        try:
+            return self._elements[index]
+        except KeyError:
+            pass
+        _min, _max, summary, start, count = _ELEMENT.unpack_from(
+            self._data, self._offsets['elements'] + index * _ELEMENT.size)
+        element = ElementDefinition({
+            'min': _min,
+            'max': '*' if _max == _UNLIMITED else six.text_type(_max),
+            'isSummary': _SUMMARY_VALUES[summary],
+            'types': []
+        }, {})
+        element.types = [self._type(self._index('element_types', position))
+                         for position in range(start, start + count)]
+        self._elements[index] = element
+        return element
+
+    def _struct(self, index):
+        try:
+            return self._structs[index]
+        except KeyError:
+            pass
+        name, base, abstract, start, count, length = _STRUCT.unpack_from(
+            self._data, self._offsets['structs'] + index * _STRUCT.size)
+        definition = object.__new__(StructDefinition)
+        definition.is_struct_def = True
+        definition.abstract = bool(abstract)
+        definition.base = None if base == _NONE else self._string(base)
+        definition.name = self._string(name)
+        definition.elements = _Elements(self, start, count, length, False)
+        # Elements with single type variants of polymorphic elements
+        definition._flat_elements = _Elements(self, start, count, count, True)
+        self._structs[index] = definition
+        return definition
+
+    def _entry(self, position):
+        return _ENTRY.unpack_from(
+            self._data, self._offsets['entries'] + position * _ENTRY.size)
+
+
+class _FrozenPathIndex(PathIndex):
+    def elements(self, name):
+        # Flattened elements are stored in the file, no need to copy them
+        return self.definitions.get_def(name)._flat_elements
+
+
+class _Sorted(object):
+    """Sequence of keys of a sorted index section (for `bisect`)"""
+    def __init__(self, store, section, start, count, key):
+        self._store = store
+        self._section = section
+        self._start = start
+        self._count = count
+        self._key = key
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, position):
+        return self._key(self._store._index(self._section,
+                                            self._start + position))
+
+
+class _Structs(collections_abc.Mapping):
+    """Read-only mapping of structure definitions by name"""
+    def __init__(self, store, section, count):
+        self._store = store
+        self._section = section
+        self._count = count
+        self._names = _Sorted(store, self._section, 0, self._count,
+                              self._name_bytes)
+
+    def _name_bytes(self, index):
+        offset = self._store._offsets['structs'] + index * _STRUCT.size
+        return self._store._string_bytes(
+            _STRUCT.unpack_from(self._store._data, offset)[0])
+
+    def _find(self, name):
+        if not isinstance(name, six.string_types):
+            return None
+        key = name.encode('utf-8')
+        position = bisect.bisect_left(self._names, key)
+        if position < self._count and self._names[position] == key:
+            return self._store._index(self._section, position)
+        return None
+
+    def __getitem__(self, name):
+        index = self._find(name)
+        if index is None:
+            raise KeyError(name)
+        return self._store._struct(index)
+
+    def __contains__(self, name):
+        return self._find(name) is not None
+
+    def __iter__(self):
+        for position in range(self._count):
+            yield self._names[position].decode('utf-8')
+
+    def __len__(self):
+        return self._count
+
+
+class _Elements(collections_abc.Mapping):
+    """Read-only mapping of element definitions of a structure by path"""
+    def __init__(self, store, start, count, length, flat):
+        self._store = store
+        self._start = start
+        self._count = count
+        self._length = length
+        self._flat = flat
+        self._paths = _Sorted(store, 'sorted_entries', start, count,
+                              self._path_bytes)
+
+    def _path_bytes(self, entry):
+        return self._store._string_bytes(self._store._entry(entry)[0])
+
+    def __getitem__(self, path):
+        if isinstance(path, six.string_types):
+            key = path.encode('utf-8')
+            position = bisect.bisect_left(self._paths, key)
+            if position < self._count and self._paths[position] == key:
+                entry = self._store._index('sorted_entries',
+                                           self._start + position)
+                _, element, is_variant = self._store._entry(entry)
+                if self._flat or not is_variant:
+                    return self._store._element(element)
+        raise KeyError(path)
+
+    def _iter_entries(self):
+        store = self._store
+        # Variants are stored after elements
+        for position in range(self._start, self._start + self._length):
+            yield store._entry(position)
+
+    def __iter__(self):
+        for path, _, _ in self._iter_entries():
+            yield self._store._string(path)
+
+    def __len__(self):
+        return self._length
+
+    def _iter_items(self):
+        store = self._store
+        for path, element, _ in self._iter_entries():
+            yield store._string(path), store._element(element)
+
+    def _iter_values(self):
+        for _, element, _ in self._iter_entries():
+            yield self._store._element(element)
+
+    def items(self):
+        return _ItemsView(self)
+
+    def values(self):
+        return _ValuesView(self)
+
+    if six.PY2:
+        iteritems = _iter_items
+        itervalues = _iter_values
+
+
+class _ItemsView(collections_abc.ItemsView):
+    def __iter__(self):
+        return self._mapping._iter_items()
+
+
+class _ValuesView(collections_abc.ValuesView):
+    def __iter__(self):
+        return self._mapping._iter_values()
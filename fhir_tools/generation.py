@@ -2,9 +2,14 @@
 # Copyright (c) 2019 Pavel 'Blane' Tuchin
 
 from __future__ import unicode_literals, absolute_import
+import collections
+import hashlib
+import itertools
 import json
+import multiprocessing
 import os
 
+from . import streaming
 from . import utils
 
 
@@ -12,63 +17,187 @@ GENERATED_PATH = os.path.join(utils.V4_DEF_PATH, 'generated')
 DEFAULT_RESOURCE_DEFS_FILE_NAME = os.path.join(GENERATED_PATH, 'resources.json')
 DEFAULT_TYPE_DEFS_FILE_NAME = os.path.join(GENERATED_PATH, 'types.json')
 
+#: Version of the transformation, generated files are rebuilt when it changes
+GENERATOR_VERSION = 1
+#: Suffix of the file that records the source of a generated file
+SOURCE_INFO_SUFFIX = '.source'
+#: Number of definitions sent to a worker at once
+CHUNK_SIZE = 8
+#: Number of windows of definitions (`CHUNK_SIZE` per worker) submitted to
+#: the pool at once
+MAX_PENDING_WINDOWS = 2
+
 
 def generate_resource_definitions_to_file(
         input_file='profiles-resources.json',
-        output_file=DEFAULT_RESOURCE_DEFS_FILE_NAME):
-    transformed = generate_resource_definitions(input_file)
-    with open(output_file, 'w') as out_fp:
-        json.dump(transformed, out_fp, indent=2)
+        output_file=DEFAULT_RESOURCE_DEFS_FILE_NAME, workers=1, force=False):
+    """Generate resource definitions file from official profiles
+
+    Generation is skipped if output was generated from the same input
+    (by the same version of the generator).
+
+    :param input_file: official profiles (`profiles-resources.json`)
+    :param output_file: path to the generated file
+    :param workers: number of worker processes (`None` for number of CPUs)
+    :param force: generate even if input has not changed
+    :return: `True` if file was generated, `False` if it is up to date
+    """
+    return _generate_to_file(generate_resource_definitions, input_file,
+                             output_file, workers, force)
 
 
 def generate_type_definitions_to_file(
         input_file='profiles-types.json',
-        output_file=DEFAULT_TYPE_DEFS_FILE_NAME):
-    transformed = generate_type_definitions(input_file)
+        output_file=DEFAULT_TYPE_DEFS_FILE_NAME, workers=1, force=False):
+    """Generate type definitions file from official profiles
+
+    See :func:`generate_resource_definitions_to_file`.
+
+    :param input_file: official profiles (`profiles-types.json`)
+    :param output_file: path to the generated file
+    :param workers: number of worker processes (`None` for number of CPUs)
+    :param force: generate even if input has not changed
+    :return: `True` if file was generated, `False` if it is up to date
+    """
+    return _generate_to_file(generate_type_definitions, input_file,
+                             output_file, workers, force)
+
+
+def _generate_to_file(generate, input_file, output_file, workers, force):
+    source_info = {
+        'sha1': _file_hash(utils.official_definitions_path(input_file)),
+        'version': GENERATOR_VERSION,
+    }
+    info_file = output_file + SOURCE_INFO_SUFFIX
+    if not force and os.path.exists(output_file):
+        try:
+            with open(info_file) as fp:
+                if json.load(fp) == source_info:
+                    return False
+        except (IOError, OSError, ValueError):
+            pass
+    transformed = generate(input_file, workers)
     with open(output_file, 'w') as out_fp:
         json.dump(transformed, out_fp, indent=2)
+    with open(info_file, 'w') as fp:
+        json.dump(source_info, fp)
+    return True
+
+
+def _file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(streaming.DEFAULT_BUFFER_SIZE),
+                          b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def generate_resource_definitions(input_file='profiles-resources.json',
+                                  workers=1):
+    definitions = iter_structure_definitions(input_file)
+    return transform_definitions_parallel(definitions, workers)
 
 
-def generate_resource_definitions(input_file='profiles-resources.json'):
-    bundle = utils.read_resource_definitions(input_file)
-    entries = utils.get_bundle_entries(bundle)
-    definitions = utils.filter_structure_definitions(entries)
-    transformed = transform_definitions(definitions)
-    return transformed
+def generate_type_definitions(input_file='profiles-types.json', workers=1):
+    definitions = iter_structure_definitions(input_file)
+    definitions = filter_primitive_types(definitions)
+    return transform_definitions_parallel(definitions, workers)
 
 
-def generate_type_definitions(input_file='profiles-types.json'):
-    bundle = utils.read_resource_definitions(input_file)
-    entries = utils.get_bundle_entries(bundle)
-    entries = utils.filter_structure_definitions(entries)
-    definitions = filter_primitive_types(entries)
-    transformed = transform_definitions(definitions)
-    return transformed
+def iter_structure_definitions(input_file):
+    """Read StructureDefinition resources from a Bundle of profiles
+
+    Bundle is read incrementally, only a single entry is kept in memory.
+
+    :param input_file: official profiles (file name or absolute path)
+    :return: generator object that will yield StructureDefinition resources
+    """
+    path = utils.official_definitions_path(input_file)
+    entries = streaming.iter_bundle_entries(path)
+    resources = (e['resource'] for e in entries if 'resource' in e)
+    return utils.filter_structure_definitions(resources)
 
 
 def transform_definitions(definitions):
     result = {}
     for definition in definitions:
-        status = definition.get('status')
-        if status != 'active' and status != 'draft':
-            continue  # We only care about active ones or draft
+        transformed = transform_definition(definition)
+        if transformed is not None:
+            result[transformed['name']] = transformed
+    return result
 
-        if 'baseDefinition' in definition:
-            base = utils.resource_from_url(definition['baseDefinition'])
-        else:
-            base = None
-        name = definition['name']
-        abstract = definition['abstract']
-        elements = definition['snapshot']['element']
-        result[name] = {
-            'name': name,
-            'abstract': abstract,
-            'base': base,
-            'elements': transform_elements(elements)
-        }
+
+def transform_definitions_parallel(definitions, workers=None):
+    """Transform definitions in a pool of worker processes
+
+    Result is the same as of :func:`transform_definitions`. Definitions
+    are submitted in windows (:data:`CHUNK_SIZE` definitions per worker),
+    at most :data:`MAX_PENDING_WINDOWS` windows are in flight, so a
+    streamed input is not read ahead of the workers.
+
+    :param definitions: StructureDefinition resources (iterable)
+    :param workers: number of worker processes (`None` for number of
+                    CPUs), with a single worker definitions are transformed
+                    in the current process
+    :return: dictionary of transformed definitions
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        return transform_definitions(definitions)
+    result = {}
+    definitions = iter(definitions)
+    window = workers * CHUNK_SIZE
+    pending = collections.deque()
+    pool = multiprocessing.Pool(workers)
+    try:
+        while True:
+            batch = list(itertools.islice(definitions, window))
+            if batch:
+                pending.append(pool.map_async(transform_definition, batch,
+                                              CHUNK_SIZE))
+                if len(pending) < MAX_PENDING_WINDOWS:
+                    continue
+            if not pending:
+                break
+            # Results are collected in the order of input
+            for transformed in pending.popleft().get():
+                if transformed is not None:
+                    result[transformed['name']] = transformed
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
     return result
 
 
+def transform_definition(definition):
+    """Transform StructureDefinition
+
+    :param definition: StructureDefinition resource
+    :return: transformed definition or `None` if definition is not active
+             (or draft)
+    """
+    status = definition.get('status')
+    if status != 'active' and status != 'draft':
+        return None  # We only care about active ones or draft
+
+    if 'baseDefinition' in definition:
+        base = utils.resource_from_url(definition['baseDefinition'])
+    else:
+        base = None
+    name = definition['name']
+    abstract = definition['abstract']
+    elements = definition['snapshot']['element']
+    return {
+        'name': name,
+        'abstract': abstract,
+        'base': base,
+        'elements': transform_elements(elements)
+    }
+
+
 def transform_elements(elements):
     results = {}
     for element in elements:
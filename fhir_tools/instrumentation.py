@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""Instrumentation of operations on FHIR objects.
+
+Instrumentation is opt-in and enabled per repository
+(:meth:`fhir_tools.resources.Resources.instrument`): generated resource
+classes get instrumented variants of their methods. Classes of a
+repository without instrumentation are not modified, so there is no
+overhead at all when it is disabled.
+
+Operations are recorded per resource type. Nested operations (e.g.
+`to_db_format` of contained resources or resources of Bundle entries)
+are part of the outermost one and are not recorded separately.
+"""
+from __future__ import unicode_literals
+import collections
+import sys
+import threading
+import timeit
+
+import six
+
+#: Creation of a resource from JSON (`from_json`)
+FROM_JSON = 'from_json'
+#: Creation of a resource from JSON in a DB friendly format (`from_db_json`)
+FROM_DB_JSON = 'from_db_json'
+#: Conversion to a DB friendly format (`to_db_format`)
+TO_DB_FORMAT = 'to_db_format'
+#: Conversion to a default FHIR representation (`to_fhir_format`)
+TO_FHIR_FORMAT = 'to_fhir_format'
+#: Replacement of references (`replace_refs`, `replace_refs_many`)
+REPLACE_REFS = 'replace_refs'
+
+# Instrumented methods: name -> (operation, is class method)
+_METHODS = {
+    'from_json': (FROM_JSON, True),
+    'from_db_json': (FROM_DB_JSON, True),
+    'to_db_format': (TO_DB_FORMAT, False),
+    'to_fhir_format': (TO_FHIR_FORMAT, False),
+    # `replace_refs` is implemented with `replace_refs_many`
+    'replace_refs_many': (REPLACE_REFS, False),
+}
+
+clock = timeit.default_timer
+
+# Not available in Python 2
+_allocated_blocks = getattr(sys, 'getallocatedblocks', None)
+
+
+class OperationStats(collections.namedtuple(
+        'OperationStats', 'calls errors time blocks')):
+    """Statistics of an operation on a resource type.
+
+    :ivar calls: number of calls
+    :ivar errors: number of calls that raised an exception
+    :ivar time: cumulative time (seconds)
+    :ivar blocks: net number of allocated memory blocks (objects, buffers,
+                  etc. that were allocated and not released, by the
+                  whole process), `None` if allocations are not tracked
+    """
+    __slots__ = ()
+
+
+class Instrumentation(object):
+    """Collector of operation statistics.
+
+    Statistics are cumulative, they are kept per operation and resource
+    type. Hooks are called after every operation and can be used to feed
+    a metrics exporter.
+
+    Instrumentation is thread-safe and can be shared by several
+    repositories.
+
+    :param allocations: track allocated memory blocks (requires Python 3,
+                        makes operations noticeably slower). Blocks are
+                        counted for the whole process, numbers include
+                        allocations of other threads running at the same
+                        time
+    """
+    def __init__(self, allocations=False):
+        if allocations and _allocated_blocks is None:
+            raise ValueError('Allocation tracking is not available')
+        self.allocations = allocations
+        self._stats = {}
+        self._hooks = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def add_hook(self, hook):
+        """Add a hook
+
+        :param hook: callable, called with operation, resource type,
+                     duration (seconds), number of allocated blocks
+                     (`None` if allocations are not tracked) and exception
+                     (`None` if operation was successful). Exceptions
+                     raised by hooks are ignored
+        """
+        with self._lock:
+            self._hooks = self._hooks + [hook]
+
+    def remove_hook(self, hook):
+        """Remove a hook
+
+        :param hook: previously added hook
+        """
+        with self._lock:
+            hooks = list(self._hooks)
+            hooks.remove(hook)
+            self._hooks = hooks
+
+    def stats(self):
+        """Get statistics collected so far
+
+        :return: dictionary ((operation, resource type) -> OperationStats)
+        """
+        with self._lock:
+            return {key: OperationStats(*value)
+                    for key, value in six.iteritems(self._stats)}
+
+    def totals(self):
+        """Get statistics of operations summed over resource types
+
+        :return: dictionary (operation -> OperationStats)
+        """
+        totals = {}
+        for (operation, _), stats in six.iteritems(self.stats()):
+            total = totals.get(operation)
+            if total is not None:
+                blocks = None if stats.blocks is None else \
+                    total.blocks + stats.blocks
+                stats = OperationStats(total.calls + stats.calls,
+                                       total.errors + stats.errors,
+                                       total.time + stats.time, blocks)
+            totals[operation] = stats
+        return totals
+
+    def reset(self):
+        """Discard collected statistics"""
+        with self._lock:
+            self._stats = {}
+
+    def record(self, operation, resource_type, duration, blocks=None,
+               error=None):
+        """Record an operation
+
+        :param operation: name of the operation
+        :param resource_type: resource type
+        :param duration: duration of the operation (seconds)
+        :param blocks: number of allocated memory blocks
+        :param error: exception raised by the operation
+        """
+        key = (operation, resource_type)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = [
+                    0, 0, 0.0, None if blocks is None else 0]
+            stats[0] += 1
+            if error is not None:
+                stats[1] += 1
+            stats[2] += duration
+            if blocks is not None:
+                stats[3] += blocks
+            hooks = self._hooks
+        for hook in hooks:
+            try:
+                hook(operation, resource_type, duration, blocks, error)
+            except Exception:
+                # Failing hook must not break instrumented operations
+                pass
+
+    def _wrap(self, func, operation, resource_type):
+        local = self._local
+        record = self.record
+        allocations = self.allocations
+
+        def wrapper(*args, **kwargs):
+            if getattr(local, 'active', False):
+                # Nested operation, part of the outer one
+                return func(*args, **kwargs)
+            local.active = True
+            error = None
+            blocks = _allocated_blocks() if allocations else None
+            start = clock()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                error = sys.exc_info()
+            finally:
+                local.active = False
+            duration = clock() - start
+            if allocations:
+                blocks = _allocated_blocks() - blocks
+            # Recorded outside of the `try` block, so that the result or
+            # exception of the operation can not be replaced
+            record(operation, resource_type, duration, blocks,
+                   None if error is None else error[1])
+            if error is not None:
+                try:
+                    six.reraise(*error)
+                finally:
+                    error = None
+            return result
+
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+
+def instrument_class(_class, instrumentation):
+    """Install instrumented methods into a generated resource class
+
+    :param _class: generated resource class
+    :param instrumentation: :class:`Instrumentation`
+    """
+    resource_type = _class._fhir_resource_type
+    uninstrument_class(_class)
+    for name, (operation, is_classmethod) in six.iteritems(_METHODS):
+        method = getattr(_class, name)
+        if is_classmethod:
+            func = instrumentation._wrap(method.__func__, operation,
+                                         resource_type)
+            setattr(_class, name, classmethod(func))
+        else:
+            func = six.get_unbound_function(method)
+            setattr(_class, name, instrumentation._wrap(func, operation,
+                                                        resource_type))
+    _class._fhir_instrumentation = instrumentation
+
+
+def uninstrument_class(_class):
+    """Remove instrumented methods from a generated resource class
+
+    :param _class: generated resource class
+    """
+    if _class.__dict__.get('_fhir_instrumentation') is None:
+        return
+    for name in _METHODS:
+        delattr(_class, name)
+    del _class._fhir_instrumentation
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""Bulk conversion of resources in a pool of worker processes"""
+from __future__ import unicode_literals
+import collections
+import itertools
+import multiprocessing
+
+import six
+from six.moves import collections_abc
+
+#: Convert resources from default FHIR representation to DB friendly format
+TO_DB = 'to_db'
+#: Convert resources from DB friendly format to default FHIR representation
+TO_FHIR = 'to_fhir'
+
+#: Default number of resources sent to a worker at once
+DEFAULT_CHUNK_SIZE = 200
+
+# Repository of the worker process, created once by `_init_worker`
+_worker_resources = None
+
+
+def _to_db(resources, json):
+    resource = resources.from_json(json)
+    resource.to_db_format()
+    return resource
+
+
+def _to_fhir(resources, json):
+    return resources.from_db_json(json)
+
+
+_CONVERTERS = {
+    TO_DB: _to_db,
+    TO_FHIR: _to_fhir,
+}
+
+
+def to_builtin(value):
+    """Convert FHIR objects to builtin types (dict, list, etc.)
+
+    Generated classes can not be pickled, so FHIR objects have to be
+    converted before they are passed between processes.
+
+    :param value: FHIR object, or a list or a primitive value
+    :return: value consisting only of builtin types
+    """
+    if isinstance(value, list):
+        return [to_builtin(v) for v in value]
+    if isinstance(value, collections_abc.Mapping):
+        return {k: to_builtin(v) for k, v in six.iteritems(value)}
+    return value
+
+
+def _init_worker(resources_class, definitions):
+    global _worker_resources
+    # Workers typically need only a few classes, generate them on demand
+    _worker_resources = resources_class(definitions, lazy=True)
+
+
+def _convert_chunk(direction, chunk):
+    convert = _CONVERTERS[direction]
+    return [to_builtin(convert(_worker_resources, json)) for json in chunk]
+
+
+def _chunks(iterable, chunk_size):
+    iterator = iter(iterable)
+    while True:
+        chunk = [json if type(json) is dict else to_builtin(json)
+                 for json in itertools.islice(iterator, chunk_size)]
+        if not chunk:
+            return
+        yield chunk
+
+
+def convert_many(resources, iterable, direction, workers=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE, max_pending=None):
+    """Convert resources between FHIR and DB formats in parallel
+
+    Input is split into chunks that are converted in a pool of worker
+    processes, every worker builds its own repository once. Results are
+    returned in the order of input. At most `max_pending` chunks are
+    submitted to the pool at once, input is consumed only as fast as
+    results are.
+
+    :param resources: repository of FHIR classes
+                      (:class:`fhir_tools.resources.Resources`)
+    :param iterable: resources to convert (parsed JSON or FHIR objects)
+    :param direction: :data:`TO_DB` or :data:`TO_FHIR`
+    :param workers: number of worker processes (number of CPUs by
+                    default), with a single worker conversion is done in
+                    the current process
+    :param chunk_size: number of resources sent to a worker at once
+    :param max_pending: maximum number of chunks being converted at once
+                        (twice the number of workers by default)
+    :return: generator object that will yield converted resources
+             (parsed JSON)
+    """
+    if direction not in _CONVERTERS:
+        raise ValueError('Invalid direction: {}'.format(direction))
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        return _convert_inline(resources, iterable, direction)
+    if max_pending is None:
+        max_pending = 2 * workers
+    return _convert_parallel(resources, iterable, direction, workers,
+                             chunk_size, max_pending)
+
+
+def _convert_inline(resources, iterable, direction):
+    convert = _CONVERTERS[direction]
+    for json in iterable:
+        if type(json) is not dict:
+            json = to_builtin(json)
+        yield to_builtin(convert(resources, json))
+
+
+def _convert_parallel(resources, iterable, direction, workers, chunk_size,
+                      max_pending):
+    pool = multiprocessing.Pool(workers, _init_worker,
+                                (type(resources), resources._definitions))
+    try:
+        pending = collections.deque()
+        for chunk in _chunks(iterable, chunk_size):
+            if len(pending) >= max_pending:
+                for json in pending.popleft().get():
+                    yield json
+            pending.append(
+                pool.apply_async(_convert_chunk, (direction, chunk)))
+        while pending:
+            for json in pending.popleft().get():
+                yield json
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
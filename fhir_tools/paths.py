@@ -0,0 +1,637 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""Extraction of element values from many resources.
+
+:class:`ColumnExtractor` collects values of several elements
+(`Observation.valueQuantity.value`, `Observation.subject.reference`, etc.)
+from resources into columns in a single pass. Paths are checked against
+definitions and compiled once: values are read from FHIR objects or
+directly from parsed JSON (objects are never created for NDJSON input).
+
+Columns can be converted to `NumPy <https://numpy.org>`_ arrays with null
+masks (NumPy is an optional dependency).
+
+:class:`PathEngine` evaluates FHIRPath-like expressions with filters
+(`Patient.identifier.where(system='...').value`), compiled once and
+cached.
+"""
+from __future__ import unicode_literals
+import collections
+import datetime
+import re
+
+import six
+
+from . import streaming
+from . import utils
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_DATE_TIME = re.compile(
+    r'^(\d{4})(?:-(\d{2})(?:-(\d{2})'
+    r'(?:T(\d{2}):(\d{2})(?::(\d{2})(?:\.(\d+))?)?'
+    r'(Z|[+-]\d{2}:\d{2})?)?)?)?$')
+
+
+def _to_float(value):
+    if isinstance(value, (float, six.integer_types)) and \
+            not isinstance(value, bool):
+        try:
+            return float(value)
+        except OverflowError:
+            # Integer beyond the range of floats (as `1e400` in JSON)
+            return float('inf') if value > 0 else float('-inf')
+    return None
+
+
+def _to_int(value):
+    if isinstance(value, six.integer_types) and not isinstance(value, bool):
+        return value
+    return None
+
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    return None
+
+
+def _to_string(value):
+    if isinstance(value, six.string_types):
+        return value
+    return None
+
+
+def parse_datetime(value):
+    """Parse FHIR date, dateTime or instant
+
+    Partial dates refer to the beginning of a period (`2019-05` is
+    May 1st, 2019). Values with a time zone are converted to UTC.
+
+    :param value: value of an element (str)
+    :return: naive `datetime.datetime` (`None` if value is not valid)
+    """
+    if not isinstance(value, six.string_types):
+        return None
+    match = _DATE_TIME.match(value)
+    if match is None:
+        return None
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    try:
+        result = datetime.datetime(
+            int(year), int(month or 1), int(day or 1), int(hour or 0),
+            int(minute or 0), int(second or 0),
+            int((fraction or '0')[:6].ljust(6, '0')))
+    except ValueError:
+        return None
+    if zone and zone != 'Z':
+        offset = datetime.timedelta(hours=int(zone[1:3]),
+                                    minutes=int(zone[4:6]))
+        result = result - offset if zone[0] == '+' else result + offset
+    return result
+
+
+# Primitive type -> (kind of column, converter)
+_FLOAT = 'float'
+_INT = 'int'
+_BOOL = 'bool'
+_DATETIME = 'datetime'
+_OBJECT = 'object'
+
+_CONVERTERS = {
+    'decimal': (_FLOAT, _to_float),
+    'integer': (_INT, _to_int),
+    'positiveInt': (_INT, _to_int),
+    'unsignedInt': (_INT, _to_int),
+    'integer64': (_INT, _to_int),
+    'boolean': (_BOOL, _to_bool),
+    'date': (_DATETIME, parse_datetime),
+    'dateTime': (_DATETIME, parse_datetime),
+    'instant': (_DATETIME, parse_datetime),
+}
+
+# Kind of column -> (NumPy type, value of missing elements)
+_NUMPY_TYPES = {
+    _FLOAT: ('float64', float('nan')),
+    _INT: ('int64', 0),
+    _BOOL: ('bool', False),
+    _DATETIME: ('datetime64[us]', None),
+    _OBJECT: ('object', None),
+}
+
+
+class Column(collections.namedtuple('Column', 'values mask')):
+    """Column of values.
+
+    :ivar values: NumPy array of values (missing values are filled with
+                  NaN, 0, `False`, NaT or `None` depending on the type)
+    :ivar mask: NumPy array of booleans, `True` where value is missing
+    """
+    __slots__ = ()
+
+
+def compile_getter(definitions, path):
+    """Compile a function that gets value of an element
+
+    Path has to point to a primitive element. Arrays along the path
+    (including the element itself) contribute their first value.
+
+    :param definitions: resource and complex type definitions
+    :param path: point-separated path to the element, starting with a
+                 resource type (`Observation.valueQuantity.value`)
+    :return: pair (primitive type code, function (json or FHIR object ->
+             value or `None`))
+    :raises KeyError: if path can not be resolved
+    :raises ValueError: if path does not point to a primitive element
+    """
+    segments = path.split('.')
+    if len(segments) < 2:
+        raise ValueError('Path does not point to an element: {}'.format(
+            path))
+    steps = []
+    element = None
+    for position in range(1, len(segments)):
+        element = definitions.find('.'.join(segments[:position + 1]))
+        if element.is_polymorphic:
+            raise ValueError(
+                'Type of a choice element has to be selected: {}'.format(
+                    path))
+        steps.append((segments[position], element.is_array))
+    _type = element.type
+    if _type.is_complex or _type.is_backbone or _type.is_resource:
+        raise ValueError('Path does not point to a primitive element: '
+                         '{}'.format(path))
+    steps = tuple(steps)
+
+    def get(obj):
+        value = obj
+        for key, is_array in steps:
+            try:
+                value = value.get(key)
+            except AttributeError:
+                return None  # Malformed data
+            if value is None:
+                return None
+            if is_array:
+                if not isinstance(value, list) or not value:
+                    return None
+                value = value[0]
+        return value
+
+    return _type.code, get
+
+
+class ColumnExtractor(object):
+    """Extractor of element values into columns.
+
+    All paths have to start with the same resource type, resources of
+    other types are skipped. Paths have to point to primitive elements,
+    values of choice elements are selected by type
+    (`Observation.valueQuantity.value`, `Observation.effectiveDateTime`).
+    Arrays along the path contribute their first value.
+
+    Values are converted according to element types: decimals to `float`,
+    integers to `int`, dates, date-times and instants to naive UTC
+    `datetime.datetime`, other values are kept as strings. Values of a
+    wrong type are treated as missing. In NumPy arrays integer columns
+    are `int64`, columns with values beyond its range are `object`.
+
+    :param definitions: resource and complex type definitions
+    :param paths: paths to elements
+    :raises KeyError: if a path can not be resolved
+    :raises ValueError: if paths are not valid
+    :ivar resource_type: type of resources values are extracted from
+    :ivar paths: paths to elements (names of columns)
+    """
+    def __init__(self, definitions, paths):
+        self.paths = tuple(paths)
+        if not self.paths:
+            raise ValueError('No paths provided')
+        types = {path.split('.', 1)[0] for path in self.paths}
+        if len(types) != 1:
+            raise ValueError('Paths have to start with the same resource '
+                             'type: {}'.format(', '.join(sorted(types))))
+        self.resource_type = types.pop()
+        if self.resource_type not in definitions.res_defs:
+            raise ValueError('Unknown resource type: {}'.format(
+                self.resource_type))
+        self._getters = []
+        self._kinds = []
+        for path in self.paths:
+            code, get = compile_getter(definitions, path)
+            kind, convert = _CONVERTERS.get(code, (_OBJECT, _to_string))
+            self._kinds.append(kind)
+            self._getters.append(_converted(get, convert))
+
+    def extract_lists(self, iterable):
+        """Extract values into lists
+
+        :param iterable: resources (FHIR objects or parsed JSON)
+        :return: dictionary (path -> list of values, `None` for missing
+                 values)
+        """
+        columns = tuple([] for _ in self.paths)
+        getters = tuple(zip(self._getters, columns))
+        resource_type = self.resource_type
+        for resource in iterable:
+            if resource.get('resourceType') != resource_type:
+                continue
+            for get, column in getters:
+                column.append(get(resource))
+        return dict(zip(self.paths, columns))
+
+    def extract(self, iterable):
+        """Extract values into NumPy arrays
+
+        :param iterable: resources (FHIR objects or parsed JSON)
+        :return: dictionary (path -> :class:`Column`)
+        :raises ImportError: if NumPy is not installed
+        """
+        if numpy is None:
+            raise ImportError('NumPy is required for columnar extraction')
+        lists = self.extract_lists(iterable)
+        return {path: _to_column(lists[path], kind)
+                for path, kind in zip(self.paths, self._kinds)}
+
+    def extract_ndjson(self, source, buffer_size=streaming.DEFAULT_BUFFER_SIZE,
+                       on_error=None):
+        """Extract values from NDJSON into NumPy arrays
+
+        Values are read from parsed JSON, FHIR objects are not created.
+
+        :param source: path to a file or a file object
+        :param buffer_size: size of the read buffer
+        :param on_error: callback for malformed lines, called with
+                         :class:`fhir_tools.streaming.ParseError`
+                         (by default error is raised)
+        :return: dictionary (path -> :class:`Column`)
+        :raises ImportError: if NumPy is not installed
+        """
+        lines = streaming.iter_ndjson(source, buffer_size, on_error)
+        return self.extract(value for _, _, value in lines
+                            if isinstance(value, dict))
+
+
+def _converted(get, convert):
+    def get_converted(obj):
+        value = get(obj)
+        if value is None:
+            return None
+        return convert(value)
+    return get_converted
+
+
+def _to_column(values, kind):
+    dtype, fill = _NUMPY_TYPES[kind]
+    mask = numpy.fromiter((v is None for v in values), dtype='bool',
+                          count=len(values))
+    if kind != _OBJECT:
+        filled = values
+        if fill is not None and mask.any():
+            filled = [fill if v is None else v for v in values]
+        try:
+            return Column(numpy.array(filled, dtype=dtype), mask)
+        except OverflowError:
+            pass  # Integers beyond the range of int64 are kept as objects
+    array = numpy.empty(len(values), dtype='object')
+    array[:] = values
+    return Column(array, mask)
+
+
+class ExpressionError(ValueError):
+    """Invalid path expression (syntax error, unknown element, etc.)"""
+
+
+_TOKEN = re.compile(r'''
+    \s*(?:
+        (?P<string>'(?:[^'\\]|\\.)*')
+      | (?P<number>-?\d+(?:\.\d+)?)
+      | (?P<name>[A-Za-z_][A-Za-z0-9_]*)
+      | (?P<op>!=|=|\.|\(|\)|,)
+    )''', re.VERBOSE)
+_ESCAPES = re.compile(r'\\(.)')
+_LITERALS = {'true': True, 'false': False}
+
+
+def _tokenize(expression):
+    tokens = []
+    pos = 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        match = _TOKEN.match(expression, pos)
+        if match is None:
+            raise ExpressionError('Unexpected character at {}: {}'.format(
+                pos, expression))
+        kind = match.lastgroup
+        text = match.group(kind)
+        if kind == 'string':
+            value = _ESCAPES.sub(r'\1', text[1:-1])
+        elif kind == 'number':
+            value = float(text) if '.' in text else int(text)
+        else:
+            value = text
+        tokens.append((kind, value, match.start(kind)))
+        pos = match.end()
+    tokens.append(('end', None, pos))
+    return tokens
+
+
+def _make_field_step(keys, is_array):
+    if len(keys) == 1 and not is_array:
+        key = keys[0]
+
+        def step(items):
+            result = []
+            for item in items:
+                value = item.get(key)
+                if value is not None:
+                    result.append(value)
+            return result
+        return step
+
+    def step(items):
+        result = []
+        for item in items:
+            for key in keys:
+                value = item.get(key)
+                if value is None:
+                    continue
+                if isinstance(value, list):
+                    result.extend(v for v in value if v is not None)
+                else:
+                    result.append(value)
+        return result
+    return step
+
+
+def _make_where_step(conditions):
+    def step(items):
+        return [item for item in items
+                if all(condition(item) for condition in conditions)]
+    return step
+
+
+def _first_step(items):
+    return items[:1]
+
+
+def _make_condition(steps, literal, negate):
+    def condition(item):
+        values = [item]
+        for step in steps:
+            values = step(values)
+        # Collection equals a literal if any of its values does
+        return (literal in values) != negate
+    return condition
+
+
+class _Compiler(object):
+    def __init__(self, definitions, expression):
+        self.definitions = definitions
+        self.expression = expression
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+
+    def error(self, message):
+        position = self.tokens[self.pos][2]
+        return ExpressionError('{} at {}: {}'.format(message, position,
+                                                     self.expression))
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def take(self, kind, value=None):
+        token = self.tokens[self.pos]
+        if token[0] != kind or (value is not None and token[1] != value):
+            raise self.error('Expected {}'.format(value or kind))
+        self.pos += 1
+        return token[1]
+
+    def compile(self):
+        root = self.take('name')
+        try:
+            self.definitions.get_def(root)
+        except KeyError:
+            raise ExpressionError('Unknown type: {}'.format(root))
+        steps, path, choice = self.path(root, functions=True)
+        self.take('end')
+        if choice is not None:
+            types = tuple(t.code for t in choice[1].types)
+        elif path == root:
+            types = (root,)
+        else:
+            types = tuple(t.code for t in self.definitions.find(path).types)
+        return root, steps, types
+
+    def path(self, path, functions, relative=False):
+        """Compile navigation steps
+
+        :param path: definition path of the context
+        :param functions: allow function calls
+        :param relative: path starts with an element name (not with '.')
+        :return: steps, definition path of the result and choice element
+                 (pair (base path, element) if result is a choice element)
+        """
+        steps = []
+        choice = None
+        while True:
+            if relative:
+                relative = False
+            elif self.peek()[:2] == ('op', '.'):
+                self.pos += 1
+            else:
+                break
+            name = self.take('name')
+            if self.peek()[:2] == ('op', '('):
+                if not functions:
+                    raise self.error('Functions are not allowed')
+                path, choice = self.function(name, path, choice, steps)
+                continue
+            if choice is not None:
+                raise self.error('Type of a choice element has to be '
+                                 'selected with ofType')
+            path, choice, keys, is_array = self.element(path, name)
+            steps.append(_make_field_step(keys, is_array))
+        return steps, path, choice
+
+    def element(self, path, name):
+        candidate = '{}.{}'.format(path, name)
+        try:
+            element = self.definitions.find(candidate)
+        except KeyError:
+            pass
+        else:
+            if element.is_polymorphic:
+                raise self.error('Invalid element {}'.format(name))
+            return candidate, None, (name,), element.is_array
+        try:
+            element = self.definitions.find(candidate + '[x]')
+        except KeyError:
+            raise self.error('Unknown element {}'.format(candidate))
+        keys = tuple(name + utils.to_camel_case(t.code)
+                     for t in element.types)
+        return candidate, (candidate, element), keys, element.is_array
+
+    def function(self, name, path, choice, steps):
+        self.take('op', '(')
+        if name == 'where':
+            if choice is not None:
+                raise self.error('where is not supported for choice '
+                                 'elements')
+            conditions = [self.condition(path)]
+            while self.peek()[:2] == ('name', 'and'):
+                self.pos += 1
+                conditions.append(self.condition(path))
+            steps.append(_make_where_step(conditions))
+        elif name == 'first':
+            steps.append(_first_step)
+        elif name == 'ofType':
+            if choice is None:
+                raise self.error('ofType is only supported for choice '
+                                 'elements')
+            code = self.take('name')
+            base, element = choice
+            for _type in element.types:
+                if _type.code == code:
+                    break
+            else:
+                raise self.error('Invalid type {}'.format(code))
+            # Replace the step of the choice element
+            key = base.rsplit('.', 1)[1] + utils.to_camel_case(code)
+            steps[-1] = _make_field_step((key,), element.is_array)
+            path, choice = base.rsplit('.', 1)[0] + '.' + key, None
+        else:
+            raise self.error('Unknown function {}'.format(name))
+        self.take('op', ')')
+        return path, choice
+
+    def condition(self, path):
+        steps, _, choice = self.path(path, functions=False, relative=True)
+        if choice is not None:
+            raise self.error('Type of a choice element has to be selected')
+        kind, operator, _ = self.peek()
+        if kind != 'op' or operator not in ('=', '!='):
+            raise self.error('Expected = or !=')
+        self.pos += 1
+        kind, literal, _ = self.peek()
+        if kind == 'name' and literal in _LITERALS:
+            literal = _LITERALS[literal]
+        elif kind not in ('string', 'number'):
+            raise self.error('Expected a literal')
+        self.pos += 1
+        return _make_condition(steps, literal, operator == '!=')
+
+
+class CompiledPath(object):
+    """Compiled path expression (see :class:`PathEngine`)
+
+    :ivar expression: source of the expression
+    :ivar root: resource or complex type the expression starts with
+    :ivar types: possible types of values (type codes)
+    """
+    def __init__(self, definitions, expression):
+        self.expression = expression
+        self.root, self._steps, self.types = _Compiler(
+            definitions, expression).compile()
+        self._is_resource = self.root in definitions.res_defs
+
+    def __call__(self, obj):
+        """Evaluate expression
+
+        :param obj: resource or complex type value (FHIR object or parsed
+                    JSON), resources of other types give no values
+        :return: list of values
+        """
+        if self._is_resource and obj.get('resourceType') != self.root:
+            return []
+        values = [obj]
+        for step in self._steps:
+            if not values:
+                break
+            values = step(values)
+        return values
+
+    def evaluate_many(self, iterable):
+        """Evaluate expression for many objects
+
+        :param iterable: FHIR objects or parsed JSON
+        :return: generator object that will yield lists of values
+        """
+        steps = self._steps
+        root = self.root if self._is_resource else None
+        for obj in iterable:
+            if root is not None and obj.get('resourceType') != root:
+                yield []
+                continue
+            values = [obj]
+            for step in steps:
+                if not values:
+                    break
+                values = step(values)
+            yield values
+
+
+class PathEngine(object):
+    """Evaluator of simple FHIRPath-like path expressions.
+
+    Expressions are dot-separated paths starting with a resource or a
+    complex type (`Observation.subject.reference`) and can use following
+    functions:
+
+    * `where(<path> = <literal> and ...)` - filter values, relative path
+      equals a literal (string, number, `true` or `false`) if any of its
+      values does, `!=` is supported as well
+    * `first()` - first value only
+    * `ofType(<type>)` - value of a choice element of a type
+      (`Observation.value.ofType(Quantity)`)
+
+    Choice elements are referred to by their name (`Observation.value`) or
+    by the name of a single type (`Observation.valueQuantity`). Result of
+    an expression is a list of all matching values, arrays are flattened.
+
+    Expressions are compiled once (elements and types are resolved against
+    definitions at compile time) and kept in a bounded cache.
+
+    :param definitions: resource and complex type definitions
+    :param cache_size: number of compiled expressions kept in the cache
+    """
+    #: Default number of compiled expressions kept in the cache
+    CACHE_SIZE = 1024
+
+    def __init__(self, definitions, cache_size=CACHE_SIZE):
+        self.definitions = definitions
+        self._cache = utils.LRUCache(cache_size)
+
+    def compile(self, expression):
+        """Compile an expression (or get it from the cache)
+
+        :param expression: path expression
+        :return: :class:`CompiledPath`
+        :raises ExpressionError: if expression is not valid
+        """
+        compiled = self._cache.get(expression)
+        if compiled is None:
+            compiled = CompiledPath(self.definitions, expression)
+            self._cache[expression] = compiled
+        return compiled
+
+    def evaluate(self, expression, obj):
+        """Evaluate an expression
+
+        :param expression: path expression
+        :param obj: FHIR object or parsed JSON
+        :return: list of values
+        """
+        return self.compile(expression)(obj)
+
+    def evaluate_many(self, expression, iterable):
+        """Evaluate an expression for many objects
+
+        :param expression: path expression
+        :param iterable: FHIR objects or parsed JSON
+        :return: generator object that will yield lists of values
+        """
+        return self.compile(expression).evaluate_many(iterable)
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2019 Pavel 'Blane' Tuchin
 from __future__ import unicode_literals
+import hashlib
 import json
+import marshal
+import os
+import sys
 import six
 from . import generation
 from . import utils
@@ -10,19 +14,90 @@ from . import utils
 RES_DEFS = generation.DEFAULT_RESOURCE_DEFS_FILE_NAME
 TYPE_DEFS = generation.DEFAULT_TYPE_DEFS_FILE_NAME
 
+#: Name of the compiled definitions cache (stored next to resource definitions)
+CACHE_FILE_NAME = 'definitions.cache'
+#: Version of the compiled definitions cache format
+CACHE_VERSION = 1
 
-def defs_from_generated(resources_file=RES_DEFS, types_file=TYPE_DEFS):
+# Overwrites existing files on Windows as well (not available in Python 2)
+_replace = getattr(os, 'replace', os.rename)
+
+
+def defs_from_generated(resources_file=RES_DEFS, types_file=TYPE_DEFS,
+                        use_cache=True):
     """Create definitions from pre-generated resource and type definitions
 
+    Unless `use_cache` is `False`, definitions are loaded from a compiled
+    cache stored next to `resources_file`. Cache is keyed by the hash of
+    both definition files and is rebuilt automatically when it is missing
+    or stale.
+
     :param resources_file: path to pre-generated resource definitions file
     :param types_file: path to pre-generated type definitions file
+    :param use_cache: use compiled definitions cache
     :return:
     """
-    with open(resources_file) as res_fp, \
-            open(types_file) as types_fp:
-        res_defs = json.load(res_fp)
-        type_defs = json.load(types_fp)
-        return Definitions(res_defs, type_defs)
+    with open(resources_file, 'rb') as res_fp, \
+            open(types_file, 'rb') as types_fp:
+        res_data = res_fp.read()
+        types_data = types_fp.read()
+
+    if use_cache:
+        cache_file = cache_path(resources_file)
+        key = _cache_key(res_data, types_data)
+        definitions = _read_cache(cache_file, key)
+        if definitions is not None:
+            return definitions
+
+    res_defs = json.loads(res_data.decode('utf-8'))
+    type_defs = json.loads(types_data.decode('utf-8'))
+    definitions = Definitions(res_defs, type_defs)
+    if use_cache:
+        _write_cache(cache_file, key, definitions)
+    return definitions
+
+
+def cache_path(resources_file=RES_DEFS):
+    """Get path to compiled definitions cache
+
+    :param resources_file: path to pre-generated resource definitions file
+    :return: path to the cache file
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(resources_file)),
+                        CACHE_FILE_NAME)
+
+
+def _cache_key(res_data, types_data):
+    digest = hashlib.sha1(res_data)
+    digest.update(types_data)
+    # marshal format is specific to the interpreter version
+    return (CACHE_VERSION, tuple(sys.version_info[:2]),
+            digest.hexdigest())
+
+
+def _read_cache(cache_file, key):
+    try:
+        with open(cache_file, 'rb') as fp:
+            cache_key, snapshot = marshal.loads(fp.read())
+        if cache_key != key:
+            return None
+        return Definitions.from_snapshot(snapshot)
+    except (IOError, OSError, EOFError, ValueError, TypeError, KeyError,
+            IndexError):
+        return None
+
+
+def _write_cache(cache_file, key, definitions):
+    tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    try:
+        with open(tmp_file, 'wb') as fp:
+            marshal.dump((key, definitions.to_snapshot()), fp)
+        _replace(tmp_file, cache_file)
+    except (IOError, OSError):
+        pass  # Read-only installation, cache is just an optimization
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
 
 
 def defs_from_raw(resources_file='profiles-resources.json', types_file='profiles-types.json'):
@@ -44,8 +119,136 @@ class Definitions(object):
     :ivar res_defs: dictionary of Resource definitions
     """
     def __init__(self, res_defs, type_defs):
-        self.type_defs = {k: StructDefinition(v, type_defs) for k, v in type_defs.items()}
-        self.res_defs = {k: StructDefinition(v, type_defs) for k, v in res_defs.items()}
+        # Identical types and elements are shared between all definitions
+        pool = DefinitionsPool(type_defs)
+        self.type_defs = {k: StructDefinition(v, type_defs, pool) for k, v in type_defs.items()}
+        self.res_defs = {k: StructDefinition(v, type_defs, pool) for k, v in res_defs.items()}
+
+    def memory_report(self):
+        """Report memory used by definitions
+
+        Sizes are approximate: they include definition objects, their
+        attribute dictionaries and containers, but not strings (names and
+        paths are shared with the source JSON).
+
+        :return: dictionary with number of structure definitions
+                 (`structs`), element paths (`elements`), distinct element
+                 and type definitions (`unique_elements`, `unique_types`)
+                 and total size in bytes (`size`)
+        """
+        seen = set()
+
+        def _size(obj):
+            if id(obj) in seen:
+                return 0
+            seen.add(id(obj))
+            size = sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                size += sum(_size(v) for v in obj.values())
+            elif isinstance(obj, (list, tuple)):
+                size += sum(_size(v) for v in obj)
+            elif hasattr(obj, '__dict__'):
+                size += _size(obj.__dict__)
+            return size
+
+        structs = list(self.res_defs.values()) + list(self.type_defs.values())
+        elements = [e for s in structs for e in s.elements.values()]
+        types = [t for e in elements for t in e.types]
+        size = _size(self.res_defs) + _size(self.type_defs)
+        return {
+            'structs': len(structs),
+            'elements': len(elements),
+            'unique_elements': len({id(e) for e in elements}),
+            'unique_types': len({id(t) for t in types}),
+            'size': size,
+        }
+
+    def to_snapshot(self):
+        """Convert definitions to a compact snapshot.
+
+        Snapshot consists only of builtin types (and can be serialized with
+        `marshal`), identical types and element definitions are stored
+        only once.
+
+        :return: snapshot of definitions
+        """
+        types = []
+        type_index = {}
+        elements = []
+        element_index = {}
+
+        def _type_ref(_type):
+            attrs = tuple(sorted(six.iteritems(_type.__dict__)))
+            key = tuple((k, tuple(v) if isinstance(v, list) else v)
+                        for k, v in attrs)
+            if key not in type_index:
+                type_index[key] = len(types)
+                types.append(attrs)
+            return type_index[key]
+
+        def _element_ref(element):
+            # Private attributes are caches, they are not stored
+            attrs = [(k, v) for k, v in six.iteritems(element.__dict__)
+                     if k != 'types' and not k.startswith('_')]
+            key = (tuple(sorted(attrs)),
+                   tuple(_type_ref(t) for t in element.types))
+            if key not in element_index:
+                element_index[key] = len(elements)
+                elements.append(key)
+            return element_index[key]
+
+        def _structs(defs):
+            result = []
+            for name, struct in six.iteritems(defs):
+                attrs = tuple(sorted(
+                    (k, v) for k, v in six.iteritems(struct.__dict__)
+                    if k != 'elements'))
+                paths = tuple(struct.elements)
+                refs = tuple(_element_ref(struct.elements[p]) for p in paths)
+                result.append((name, attrs, paths, refs))
+            return tuple(result)
+
+        res_defs = _structs(self.res_defs)
+        type_defs = _structs(self.type_defs)
+        return tuple(types), tuple(elements), res_defs, type_defs
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """Create definitions from a snapshot created by `to_snapshot`
+
+        :param snapshot: snapshot of definitions
+        :return: definitions
+        """
+        types, elements, res_defs, type_defs = snapshot
+        new = object.__new__
+
+        type_objects = []
+        for attrs in types:
+            _type = new(Type)
+            _type.__dict__.update(attrs)
+            type_objects.append(_type)
+
+        element_objects = []
+        for attrs, type_refs in elements:
+            element = new(ElementDefinition)
+            element.__dict__.update(attrs)
+            element.types = [type_objects[i] for i in type_refs]
+            element_objects.append(element)
+
+        def _structs(structs):
+            result = {}
+            for name, attrs, paths, refs in structs:
+                struct = new(StructDefinition)
+                struct.__dict__.update(attrs)
+                struct.elements = dict(
+                    zip(paths, [element_objects[i] for i in refs]))
+                result[name] = struct
+            return result
+
+        definitions = new(cls)
+        definitions.type_defs = _structs(type_defs)
+        definitions.res_defs = _structs(res_defs)
+        return definitions
 
     def types_from_path(self, path):
         """Get element types
@@ -61,14 +264,19 @@ class Definitions(object):
     def find(self, path):
         """Find definition for provided path
 
+        Path can cross complex types and backbone elements
+        (`Patient.name.family`, `Patient.contact.name.given`) and refer to
+        a single type of a polymorphic element
+        (`Observation.valueQuantity.value`).
+
         :param path: point-separated path to the element or resource
         :return: Either resource definition or element definition, depending on the path
+        :raises KeyError: if path can not be resolved
         """
-        name = utils.resource_from_path(path)
-        resource = self.get_def(name)
-        if name == path:
-            return resource
-        return resource[path]
+        index = self.__dict__.get('_path_index')
+        if index is None:
+            index = self._path_index = PathIndex(self)
+        return index.find(path)
 
     def get_def(self, name):
         """Get resource or complex type definition.
@@ -84,12 +292,93 @@ class Definitions(object):
             return self.type_defs[name]
 
 
+class PathIndex(object):
+    """Resolver of deep paths to element definitions.
+
+    Elements of every structure (including single type variants of
+    polymorphic elements) are indexed by path once, on first use.
+    Resolved paths are kept in a bounded cache.
+
+    :ivar definitions: definitions (any object with `get_def` method)
+    """
+    #: Default number of resolved paths kept in the cache
+    CACHE_SIZE = 4096
+
+    def __init__(self, definitions, cache_size=CACHE_SIZE):
+        self.definitions = definitions
+        self._structs = {}
+        self._cache = utils.LRUCache(cache_size)
+
+    def find(self, path):
+        """Find definition for provided path
+
+        :param path: point-separated path to the element or resource
+        :return: Either resource definition or element definition
+        :raises KeyError: if path can not be resolved
+        """
+        result = self._cache.get(path)
+        if result is None:
+            result = self._resolve(path)
+            self._cache[path] = result
+        return result
+
+    def elements(self, name):
+        """Get flattened elements of a structure
+
+        :param name: resource or complex type name
+        :return: dictionary of element definitions by path, with entries
+                 for every type of polymorphic elements
+                 (`Observation.valueQuantity`)
+        """
+        try:
+            return self._structs[name]
+        except KeyError:
+            pass
+        struct = self.definitions.get_def(name)
+        elements = dict(struct.elements)
+        for path, element in six.iteritems(struct.elements):
+            if not path.endswith('[x]'):
+                continue
+            prefix = path[:-3]
+            for _type in element.types:
+                variant = prefix + utils.to_camel_case(_type.code)
+                elements.setdefault(variant, element.to_single_type(_type))
+        self._structs[name] = elements
+        return elements
+
+    def _resolve(self, path):
+        segments = path.split('.')
+        name = segments[0]
+        if len(segments) == 1:
+            return self.definitions.get_def(name)
+        elements = self.elements(name)
+        prefix = name
+        element = None
+        for segment in segments[1:]:
+            if element is not None:
+                # Step into the type of the previous element
+                if element.is_polymorphic:
+                    raise KeyError(path)
+                _type = element.type
+                if not _type.is_backbone:
+                    if not _type.is_complex:
+                        raise KeyError(path)
+                    prefix = _type.code
+                    elements = self.elements(prefix)
+            prefix = '{}.{}'.format(prefix, segment)
+            try:
+                element = elements[prefix]
+            except KeyError:
+                raise KeyError(path)
+        return element
+
+
 class StructDefinition(object):
     """Structure definition.
 
     Used to define a Resource or a Complex Type
     """
-    def __init__(self, _json, type_defs):
+    def __init__(self, _json, type_defs, pool=None):
         #: Is this a structure definition (yes, it is)
         self.is_struct_def = True
         #: Is this definition abstract
@@ -100,7 +389,52 @@ class StructDefinition(object):
         self.name = _json['name']
         elements = _json['elements']
         #: Dictionary of elements present in this definition
-        self.elements = {k: ElementDefinition(v, type_defs) for k, v in elements.items()}
+        if pool is None:
+            pool = DefinitionsPool(type_defs)
+        self.elements = {k: pool.element(v) for k, v in elements.items()}
+
+
+class DefinitionsPool(object):
+    """Pool of shared type and element definitions.
+
+    Definitions are immutable, so identical types (same code and targets)
+    and elements (same cardinality, summary flag and types) are created
+    only once and shared.
+    """
+    def __init__(self, type_defs):
+        self.type_defs = type_defs
+        self.types = {}
+        self.elements = {}
+
+    def type(self, _json):
+        """Get shared type definition
+
+        :param _json: type definition JSON
+        :return: type definition
+        """
+        targets = _json.get('targets')
+        key = (_json['code'], None if targets is None else tuple(targets))
+        try:
+            return self.types[key]
+        except KeyError:
+            _type = self.types[key] = Type(_json, self.type_defs)
+            return _type
+
+    def element(self, _json):
+        """Get shared element definition
+
+        :param _json: element definition JSON
+        :return: element definition
+        """
+        types = [self.type(t) for t in _json['types']]
+        key = (_json['min'], _json['max'], _json.get('isSummary'),
+               tuple(id(t) for t in types))
+        try:
+            return self.elements[key]
+        except KeyError:
+            element = ElementDefinition(_json, self.type_defs, self)
+            self.elements[key] = element
+            return element
 
 
 class ElementDefinition(object):
@@ -113,7 +447,7 @@ class ElementDefinition(object):
     :ivar is_array: is this element an array (opposite to `is_single`)
     :ivar types: types that are allowed in this element
     """
-    def __init__(self, _json, type_defs):
+    def __init__(self, _json, type_defs, pool=None):
         #: Is this a structure definition (no, it is not)
         self.is_struct_def = False
         
@@ -133,7 +467,10 @@ class ElementDefinition(object):
         self.is_single = self.max == 1
         self.is_array = not self.is_single
 
-        self.types = [Type(t, type_defs) for t in _json['types']]
+        if pool is None:
+            self.types = [Type(t, type_defs) for t in _json['types']]
+        else:
+            self.types = [pool.type(t) for t in _json['types']]
 
     @property
     def is_polymorphic(self):
@@ -162,12 +499,20 @@ class ElementDefinition(object):
         """
         if _type not in self.types:
             raise ValueError('Invalid Type')
+        # Element definitions are shared, so are their single type variants
+        cache = self.__dict__.setdefault('_single_types', {})
+        try:
+            return cache[id(_type)]
+        except KeyError:
+            pass
         new_def = ElementDefinition({
             'min': self.min,
             'max': '*' if self.is_unlimited else six.text_type(self.max),
+            'isSummary': self.is_summary,
             'types': []
         }, {})
         new_def.types = [_type]
+        cache[id(_type)] = new_def
         return new_def
 
 
@@ -1,62 +1,169 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2019 Pavel 'Blane' Tuchin
+import copy
+import threading
+
 import six
+from six.moves import collections_abc
+
+from . import instrumentation
+from . import parallel
+from . import serialization
+from . import streaming
+from . import utils
+from .utils import to_camel_case
+
+#: Maximum number of compiled `_elements` projections kept per repository
+PROJECTION_CACHE_SIZE = 1024
 
 
 class Resources(object):
     """Repository of generated classed for Resources, Complex Types and
     Backbone Elements
 
+    By default all classes are generated when repository is created. With
+    `lazy=True` a class (together with its Backbone Elements) is generated
+    on first access instead, which makes start-up considerably cheaper when
+    only a handful of resources is actually used.
+
+    With `compact=True` generated classes are based on
+    :class:`CompactFHIRObject` (`__slots__`-backed) instead of
+    :class:`FHIRObject` (dict-backed), which reduces memory consumption.
+
+    :param definitions: resource and complex type definitions
+    :param lazy: generate classes on first access
+    :param compact: generate `__slots__`-backed classes
     """
 
-    def __init__(self, definitions):
+    def __init__(self, definitions, lazy=False, compact=False):
         self._definitions = definitions
+        self._compact = compact
         self._types = {}
         self._resources = {}
-        for _type, definition in six.iteritems(definitions.type_defs):
-            self._types[_type] = self._create_type(_type, definition)
-        for resource, definition in six.iteritems(definitions.res_defs):
-            self._resources[resource] = self._create_resource(
-                resource, definition)
+        self._lock = threading.RLock()
+        self._pending_decoders = {}
+        self._containers = None
+        self._summary = None
+        self._projections = utils.LRUCache(PROJECTION_CACHE_SIZE)
+        self._instrumentation = None
+        if not lazy:
+            self.preload()
+
+    def preload(self, names=None):
+        """Generate classes ahead of time.
+
+        Useful for warming up a lazy repository before serving requests.
+
+        :param names: names of Resources and Complex Types to generate
+                      (all of them if omitted)
+        """
+        if names is None:
+            names = list(self._definitions.type_defs)
+            names.extend(self._definitions.res_defs)
+        for name in names:
+            self.get(name)
+
+    def instrument(self, collector):
+        """Enable or disable instrumentation of resource operations
+
+        Calls of `from_json`, `from_db_json`, `to_db_format`,
+        `to_fhir_format` and `replace_refs` on resources of this repository
+        are recorded (see :mod:`fhir_tools.instrumentation`). Without
+        instrumentation operations have no overhead.
+
+        :param collector:
+            :class:`fhir_tools.instrumentation.Instrumentation` or `None`
+            to disable instrumentation
+        """
+        with self._lock:
+            self._instrumentation = collector
+            for _class in six.itervalues(self._resources):
+                if collector is None:
+                    instrumentation.uninstrument_class(_class)
+                else:
+                    instrumentation.instrument_class(_class, collector)
+
+    @property
+    def instrumentation(self):
+        """Instrumentation of this repository (`None` if disabled)"""
+        return self._instrumentation
+
+    def _build(self, name):
+        with self._lock:
+            # Another thread might have built the class while we were waiting
+            if name in self._resources:
+                return self._resources[name]
+            if name in self._types:
+                return self._types[name]
+            definitions = self._definitions
+            if name in definitions.res_defs:
+                _class = self._create_resource(name, definitions.res_defs[name])
+                self._resources[name] = _class
+                return _class
+            if name in definitions.type_defs:
+                _class = self._create_type(name, definitions.type_defs[name])
+                self._types[name] = _class
+                return _class
+        raise KeyError('Class not found')
 
     def _create_type(self, name, definition):
-        fields, polymorphic, backbones = self._create_fields(
-            definition.elements)
-        attrs = {
-            '_fhir_resources': self,
-            '_fhir_fields': fields,
-            '_fhir_polymorphic': polymorphic
-        }
-        attrs.update({k: v for k, v in six.iteritems(backbones)})
-        if six.PY2:
-            return type(bytes(name), (Type, ), attrs)
-        return type(name, (Type, ), attrs)
+        return self._create_class(name, Type, definition.elements)
 
     def _create_resource(self, name, definition):
-        fields, polymorphic, backbones = self._create_fields(
-            definition.elements)
-        attrs = {
-            '_fhir_resources': self,
-            '_fhir_fields': fields,
-            '_fhir_polymorphic': polymorphic,
-            '_fhir_resource_type': name
-        }
-        attrs.update({k: v for k, v in six.iteritems(backbones)})
-        if six.PY2:
-            return type(bytes(name), (Resource, ), attrs)
-        return type(name, (Resource, ), attrs)
+        _class = self._create_class(name, Resource, definition.elements,
+                                    _fhir_resource_type=name)
+        if self._instrumentation is not None:
+            instrumentation.instrument_class(_class, self._instrumentation)
+        return _class
 
     def _create_backbone(self, name, elements):
+        return self._create_class(name, Backbone, elements)
+
+    def _create_class(self, name, base, elements, **extra):
         fields, polymorphic, backbones = self._create_fields(elements)
         attrs = {
             '_fhir_resources': self,
             '_fhir_fields': fields,
             '_fhir_polymorphic': polymorphic,
+            '_fhir_plan': self._create_plan(fields, backbones),
+            # Compiled on first use, see `_decoder`
+            '_fhir_json_decoder': None,
+            '_fhir_db_json_decoder': None,
+            # Created on first use, see `_lazy_class`
+            '_fhir_lazy_class': None,
         }
+        attrs.update(extra)
         attrs.update({k: v for k, v in six.iteritems(backbones)})
+        if self._compact:
+            base = _COMPACT_BASES[base]
+            attrs.update(self._create_slots(base, fields, polymorphic))
         if six.PY2:
-            return type(bytes(name), (Backbone, ), attrs)
-        return type(name, (Backbone, ), attrs)
+            return type(bytes(name), (base, ), attrs)
+        return type(name, (base, ), attrs)
+
+    @staticmethod
+    def _create_slots(base, fields, polymorphic):
+        slot_of = {}
+        shared = set()
+        for field, poly_fields in six.iteritems(polymorphic):
+            slot_of[field] = field  # DB format
+            shared.add(field)
+            for name in poly_fields:
+                slot_of[name] = field
+                shared.add(name)
+        for field in fields:
+            slot_of.setdefault(field, field)
+        if base is CompactResource:
+            slot_of['resourceType'] = 'resourceType'
+        slots = sorted(set(slot_of.values()))
+        if six.PY2:
+            slots = [bytes(slot) for slot in slots]
+        return {
+            '__slots__': tuple(slots),
+            '_fhir_slot_of': slot_of,
+            '_fhir_key_sets': {},
+            '_fhir_shared_slots': frozenset(shared),
+        }
 
     def _create_fields(self, elements):
         fields = {}
@@ -88,6 +195,151 @@ class Resources(object):
             backbone_types[name] = self._create_backbone(name, elements)
         return fields, polymorphic, backbone_types
 
+    def _create_plan(self, fields, backbones):
+        """Create traversal plan of a class.
+
+        Plan lists only fields that can contain references or polymorphic
+        values (directly or in nested objects), so traversals (DB format
+        conversions, reference replacement) skip everything else.
+
+        :param fields: fields of the class (name -> element definition)
+        :param backbones: backbone classes of the class (by class name)
+        :return: dictionary (field -> (kind, is_array))
+        """
+        containers = self._reference_containers()
+        plan = {}
+        for field, element in six.iteritems(fields):
+            if not element.types:
+                continue  # Content reference, stored as raw JSON
+            _type = element.type
+            if _type.is_reference:
+                kind = _REFERENCE
+            elif _type.is_backbone:
+                backbone = backbones[to_camel_case(field)]
+                if not backbone._fhir_plan and not backbone._fhir_polymorphic:
+                    continue
+                kind = _NESTED
+            elif _type.is_complex:
+                if _type.code not in containers:
+                    continue
+                kind = _NESTED
+            elif _type.is_resource:
+                kind = _RESOURCE
+            else:
+                continue
+            plan[field] = (kind, element.is_array)
+        return plan
+
+    def _reference_containers(self):
+        """Get names of complex types that can contain references or
+        polymorphic values (directly or in nested objects)
+
+        :return: set of complex type names
+        """
+        if self._containers is not None:
+            return self._containers
+        type_defs = self._definitions.type_defs
+        containers = set()
+        changed = True
+        while changed:
+            changed = False
+            for name, definition in six.iteritems(type_defs):
+                if name in containers:
+                    continue
+                for element in six.itervalues(definition.elements):
+                    if element.is_polymorphic or any(
+                            t.is_reference or t.code in containers
+                            for t in element.types):
+                        containers.add(name)
+                        changed = True
+                        break
+        self._containers = frozenset(containers)
+        return self._containers
+
+    def _has_summary(self):
+        """Check if definitions mark summary elements (`isSummary`)
+
+        Definitions generated by older versions do not have summary flags.
+
+        :return: `True` if at least one element is marked as summary
+        """
+        if self._summary is not None:
+            return self._summary
+        definitions = self._definitions
+        self._summary = any(
+            element.is_summary
+            for defs in (definitions.res_defs, definitions.type_defs)
+            for definition in six.itervalues(defs)
+            for element in six.itervalues(definition.elements))
+        return self._summary
+
+    def _decoder(self, _class, db_format):
+        """Get decoder function specialized for a class.
+
+        Decoder is compiled on first use: dispatch table (field -> converter)
+        is built once and all target classes are bound in it, so decoding
+        does not need to inspect element definitions.
+
+        :param _class: generated class
+        :param db_format: decoder for DB friendly format
+        :return: decoder function (json -> FHIR object)
+        """
+        attr = '_fhir_db_json_decoder' if db_format else '_fhir_json_decoder'
+        with self._lock:
+            decoder = getattr(_class, attr)
+            if decoder is not None:
+                return decoder
+            key = (_class, db_format)
+            if key in self._pending_decoders:
+                # Recursive type (e.g. Extension.extension), table of this
+                # decoder is being filled further up the stack
+                return self._pending_decoders[key]
+            outermost = not self._pending_decoders
+            try:
+                converters = {}
+                decoder = _make_decoder(_class, converters)
+                self._pending_decoders[key] = decoder
+                for field, element in six.iteritems(_class._fhir_fields):
+                    converter = self._converter(_class, field, element,
+                                                db_format)
+                    converters[field] = converter
+                if db_format:
+                    for field in _class._fhir_polymorphic:
+                        converters[field] = _POLYMORPHIC
+                if outermost:
+                    # Publish decoders only when all tables are complete,
+                    # so other threads never see a partially filled one
+                    for (pending_class, pending_db), pending in six.iteritems(
+                            self._pending_decoders):
+                        setattr(pending_class,
+                                '_fhir_db_json_decoder'
+                                if pending_db else '_fhir_json_decoder',
+                                staticmethod(pending))
+            finally:
+                if outermost:
+                    self._pending_decoders.clear()
+            return decoder
+
+    def _converter(self, _class, field, element, db_format):
+        if not element.types:
+            # Content reference (no type information), stored as is
+            return None
+        _type = element.type
+        if not _type.is_complex and not _type.is_backbone:
+            if not _type.is_resource:
+                return None  # Primitive value, stored as is
+            decoder = self.from_db_json if db_format else self.from_json
+        elif _type.is_backbone:
+            decoder = self._decoder(getattr(_class, to_camel_case(field)),
+                                    db_format)
+        elif db_format and _type.is_reference:
+            decoder = DBReference.from_db_json
+        else:
+            decoder = self._decoder(self.get(_type.code), db_format)
+        if element.is_array:
+            return _array_converter(decoder)
+        return decoder
+
     @staticmethod
     def _iter_elements(elements):
         for path, element_def in six.iteritems(elements):
@@ -107,12 +359,80 @@ class Resources(object):
             return self._resources[name]
         if name in self._types:
             return self._types[name]
-        raise KeyError('Class not found')
+        return self._build(name)
 
     def from_json(self, json):
         _class = self.get(json['resourceType'])
         return _class.from_json(json)
 
+    def wrap(self, json):
+        """Create a lazy view of a resource
+
+        Unlike :meth:`from_json`, nested objects are not created up front:
+        view keeps values of parsed JSON and converts complex, backbone and
+        resource values to FHIR objects (lazy views as well) on first
+        access. Converted values replace raw ones, so conversion is done
+        only once. Views are instances of generated classes and support
+        the same operations (`to_db_format`, `replace_refs`, etc.),
+        operations that go through all values convert them.
+
+        Views are not thread-safe. In compact mode resources are decoded
+        eagerly, as with :meth:`from_json`.
+
+        :param json: parsed JSON of a resource (FHIR format), top-level
+                     dictionary is not modified
+        :return: FHIR object
+        """
+        _class = self.get(json['resourceType'])
+        if self._compact:
+            return _class.from_json(json)
+        return self._lazy_class(_class)._fhir_wrap(json)
+
+    def _lazy_class(self, _class):
+        """Get lazy variant of a generated class (see :meth:`wrap`)
+
+        :param _class: generated class
+        :return: subclass of `_class` based on :class:`LazyFHIRObject`
+        """
+        lazy_class = _class._fhir_lazy_class
+        if lazy_class is not None:
+            return lazy_class
+        with self._lock:
+            if _class._fhir_lazy_class is not None:
+                return _class._fhir_lazy_class
+            converters = {
+                field: self._lazy_converter(_class, field, element)
+                for field, element in six.iteritems(_class._fhir_fields)
+            }
+            attrs = {'_fhir_lazy_converters': converters}
+            name = _class.__name__
+            lazy_class = type(name, (LazyFHIRObject, _class), attrs)
+            lazy_class._fhir_lazy_class = lazy_class
+            _class._fhir_lazy_class = lazy_class
+            return lazy_class
+
+    def _lazy_converter(self, _class, field, element):
+        if not element.types:
+            return None  # Content reference, stored as is
+        _type = element.type
+        if _type.is_resource:
+            convert = self.wrap
+        elif _type.is_backbone or _type.is_complex:
+            if _type.is_backbone:
+                target = getattr(_class, to_camel_case(field))
+            else:
+                target = self.get(_type.code)
+
+            def convert(value):
+                # Lazy classes of nested objects are resolved on first use,
+                # types can be recursive (e.g. Extension.extension)
+                return self._lazy_class(target)._fhir_wrap(value)
+        else:
+            return None  # Primitive value, stored as is
+        if element.is_array:
+            return _array_converter(convert)
+        return convert
+
     def from_db_json(self, json, convert_to_fhir=True):
         _class = self.get(json['resourceType'])
         resource = _class.from_db_json(json)
@@ -120,22 +440,289 @@ class Resources(object):
             resource.to_fhir_format()
         return resource
 
+    def iter_ndjson(self, source, db_format=False, resource_types=None,
+                    skip_unknown=False, on_error=None,
+                    buffer_size=streaming.DEFAULT_BUFFER_SIZE):
+        """Read resources from NDJSON (e.g. FHIR Bulk Data export)
+
+        Resources are decoded and returned one by one, so memory
+        consumption does not depend on the size of the input.
+
+        :param source: path to a file or a file object
+        :param db_format: resources are in a DB friendly format (they are
+                          converted to a default FHIR representation)
+        :param resource_types: only return resources of provided types
+        :param skip_unknown: silently skip resources of unknown types
+                             (otherwise they are reported as errors)
+        :param on_error: callback for malformed lines, called with
+                         :class:`fhir_tools.streaming.ParseError`
+                         (by default error is raised)
+        :param buffer_size: size of the read buffer
+        :return: generator object that will yield FHIR objects
+        """
+        lines = streaming.iter_ndjson(source, buffer_size, on_error)
+        return self.decode_ndjson_lines(lines, db_format, resource_types,
+                                        skip_unknown, on_error)
+
+    def decode_ndjson_lines(self, lines, db_format=False, resource_types=None,
+                            skip_unknown=False, on_error=None):
+        """Decode parsed lines of NDJSON
+
+        :param lines: triples (line number, line, value) as returned by
+                      :func:`fhir_tools.streaming.parse_ndjson_lines`
+        :param db_format: resources are in a DB friendly format (they are
+                          converted to a default FHIR representation)
+        :param resource_types: only return resources of provided types
+        :param skip_unknown: silently skip resources of unknown types
+                             (otherwise they are reported as errors)
+        :param on_error: callback for malformed lines, called with
+                         :class:`fhir_tools.streaming.ParseError`
+                         (by default error is raised)
+        :return: generator object that will yield FHIR objects
+        """
+        if resource_types is not None:
+            resource_types = frozenset(resource_types)
+        for line_number, line, value in lines:
+            try:
+                resource_type = value['resourceType']
+            except (KeyError, TypeError):
+                streaming.report_error(
+                    streaming.ParseError('Missing resourceType', line_number,
+                                         line), on_error)
+                continue
+            if resource_types is not None and \
+                    resource_type not in resource_types:
+                continue
+            try:
+                _class = self.get(resource_type)
+            except KeyError:
+                if not skip_unknown:
+                    streaming.report_error(
+                        streaming.ParseError(
+                            'Unknown resource type: {}'.format(resource_type),
+                            line_number, line), on_error)
+                continue
+            try:
+                if db_format:
+                    resource = _class.from_db_json(value)
+                    resource.to_fhir_format()
+                else:
+                    resource = _class.from_json(value)
+            except (AttributeError, KeyError, TypeError, ValueError) as exc:
+                streaming.report_error(
+                    streaming.ParseError(
+                        'Invalid resource: {!r}'.format(exc), line_number,
+                        line), on_error)
+                continue
+            yield resource
+
+    def iter_bundle_entries(self, source, db_format=False,
+                            buffer_size=streaming.DEFAULT_BUFFER_SIZE,
+                            parser=None):
+        """Read entries of a Bundle incrementally
+
+        Bundle is never loaded into memory as a whole: entries are parsed
+        and decoded one by one as the source is read.
+
+        :param source: path to a file or a file object with Bundle JSON
+        :param db_format: resources are in a DB friendly format (they are
+                          converted to a default FHIR representation)
+        :param buffer_size: size of chunks read from the source
+        :param parser: :class:`fhir_tools.streaming.BundleParser` to use
+                       (can be provided to access Bundle metadata)
+        :return: generator object that will yield `Bundle.Entry` objects
+                 (with `resource`, `fullUrl`, `request`, etc.)
+        """
+        entry_class = self.get('Bundle').Entry
+        decode = entry_class.from_db_json if db_format else \
+            entry_class.from_json
+        for entry in streaming.iter_bundle_entries(source, buffer_size,
+                                                   parser):
+            yield decode(entry)
+
+    def replace_bundle_refs(self, bundle, mapping):
+        """Replace references in all entries of a Bundle in a single pass
+
+        Typical use is rewriting `urn:uuid:` placeholders of a transaction
+        Bundle into server ids.
+
+        :param bundle: Bundle (FHIR object or parsed JSON, which is decoded)
+        :param mapping: dictionary (old reference -> new reference) or a
+                        callable, see :meth:`BaseFHIRObject.replace_refs_many`
+        :return: pair (Bundle object, number of replaced references)
+        """
+        if not isinstance(bundle, BaseFHIRObject):
+            bundle = self.from_json(bundle)
+        if isinstance(mapping, collections_abc.Mapping):
+            lookup = mapping.get
+        else:
+            lookup = mapping
+        replaced = 0
+        for entry in bundle.get('entry', ()):
+            resource = entry.get('resource')
+            if resource is not None:
+                replaced += _replace_refs(resource, lookup)
+        return bundle, replaced
+
+    def extract_references(self, iterable):
+        """Extract references from resources as graph edges
+
+        Resources are walked according to their traversal plans, so fields
+        that can not contain references are never scanned. Parsed JSON is
+        walked as is, without creating FHIR objects. Target type is taken
+        from the reference (`Patient/1`, absolute URLs and version specific
+        references are supported); for other references (contained
+        `#id`, `urn:uuid:`, etc.) it is taken from `Reference.type` or
+        from the element definition when the element allows only one
+        target type (`None` otherwise). References without
+        `Reference.reference` (logical references) are skipped.
+
+        :param iterable: resources (FHIR objects or parsed JSON)
+        :return: generator object that will yield tuples
+                 (source_type, source_id, path, target_type, target_id)
+        """
+        for resource in iterable:
+            if isinstance(resource, BaseFHIRObject):
+                _class = type(resource)
+            else:
+                _class = self.get(resource['resourceType'])
+            source_type = resource['resourceType']
+            source_id = resource.get('id')
+            for path, reference, targets in _iter_references(
+                    _class, resource, ''):
+                target = reference_target(reference, targets)
+                if target is not None:
+                    yield (source_type, source_id, path) + target
+
+    def _projection(self, _class, elements=None):
+        """Get projection function of a class
+
+        Sets of fields to keep are computed once per class (and list of
+        elements) from element definitions.
+
+        :param _class: generated class
+        :param elements: paths of elements to keep (`frozenset`), `None`
+                         for summary
+        :return: function (FHIR object -> FHIR object)
+        """
+        key = (_class, elements)
+        projection = self._projections.get(key)
+        if projection is None:
+            with self._lock:
+                projection = self._compile_projection(_class, elements)
+            self._projections[key] = projection
+        return projection
+
+    def _compile_projection(self, _class, elements):
+        fields = set()
+        nested = {}
+        is_resource = getattr(_class, '_fhir_resource_type', None) is not None
+        if is_resource:
+            # Always returned, even if not requested
+            fields.update(('resourceType', 'id', 'meta'))
+        for field, element in six.iteritems(_class._fhir_fields):
+            # Mandatory elements are always in summary and returned
+            if element.is_required or (elements is None and
+                                       element.is_summary):
+                fields.add(field)
+        if elements is None:
+            for field in list(fields):
+                element = _class._fhir_fields.get(field)
+                if element is not None and element.types and \
+                        element.type.is_backbone:
+                    nested[field] = self._projection(
+                        getattr(_class, to_camel_case(field)))
+        else:
+            children = {}
+            for path in elements:
+                name, _, rest = path.partition('.')
+                children.setdefault(name, set())
+                if rest:
+                    children[name].add(rest)
+            for name, paths in six.iteritems(children):
+                names = _class._fhir_polymorphic.get(name, (name, ))
+                for field in names:
+                    element = _class._fhir_fields.get(field)
+                    if element is None:
+                        continue
+                    fields.add(field)
+                    if not paths or not element.types:
+                        continue
+                    _type = element.type
+                    if _type.is_backbone:
+                        target = getattr(_class, to_camel_case(field))
+                    elif _type.is_complex:
+                        target = self.get(_type.code)
+                    else:
+                        continue
+                    nested[field] = self._projection(target,
+                                                     frozenset(paths))
+        for poly_field, names in six.iteritems(_class._fhir_polymorphic):
+            if fields.intersection(names):
+                fields.add(poly_field)  # DB format
+        return _make_projection(frozenset(fields), nested)
+
+    def _child_class(self, _class, field, value):
+        """Get class of a nested value (which can be parsed JSON)"""
+        if isinstance(value, BaseFHIRObject):
+            return type(value)
+        _type = _class._fhir_fields[field].type
+        if _type.is_resource:
+            return self.get(value['resourceType'])
+        if _type.is_backbone:
+            return getattr(_class, to_camel_case(field))
+        return self.get(_type.code)
+
+    def convert_many(self, iterable, direction, workers=None,
+                     chunk_size=parallel.DEFAULT_CHUNK_SIZE,
+                     max_pending=None):
+        """Convert resources between FHIR and DB formats in parallel
+
+        See :func:`fhir_tools.parallel.convert_many` for details.
+
+        :param iterable: resources to convert (parsed JSON or FHIR objects)
+        :param direction: :data:`fhir_tools.parallel.TO_DB` or
+                          :data:`fhir_tools.parallel.TO_FHIR`
+        :param workers: number of worker processes (number of CPUs by
+                        default)
+        :param chunk_size: number of resources sent to a worker at once
+        :param max_pending: maximum number of chunks being converted at once
+        :return: generator object that will yield converted resources
+                 (parsed JSON), in the order of input
+        """
+        return parallel.convert_many(self, iterable, direction, workers,
+                                     chunk_size, max_pending)
+
     def __getattr__(self, name):
+        if name.startswith('__'):
+            # Special attributes looked up by Python itself (copy, pickle,
+            # abc, etc.) are never classes
+            raise AttributeError(name)
         return self.get(name)
 
 
-class FHIRObject(dict):
+class BaseFHIRObject(object):
+    """Behaviour shared by FHIR objects regardless of how values are stored.
+
+    Values are accessed through the mapping interface, see
+    :class:`FHIRObject` (dict-backed) and :class:`CompactFHIRObject`
+    (`__slots__`-backed).
+    """
+    __slots__ = ()
+
     _fhir_resources = None
     _fhir_fields = {}
     _fhir_polymorphic = {}
+    _fhir_plan = {}
+    _fhir_json_decoder = None
+    _fhir_db_json_decoder = None
+    #: Is this a lazy view (see :class:`LazyFHIRObject`)
+    _fhir_lazy = False
 
-    def __init__(self, **kwargs):
-        initial = {
-            k: v
-            for k, v in six.iteritems(kwargs) if (k in self._fhir_fields) and (
-                v is not None) and not (isinstance(v, list) and not v)
-        }
-        dict.__init__(self, **initial)
+    @staticmethod
+    def _fhir_initial(kwargs):
+        return [(k, v) for k, v in six.iteritems(kwargs) if v is not None and
+                not (isinstance(v, list) and not v)]
 
     def __getattr__(self, name):
         if name in self._fhir_polymorphic:
@@ -173,27 +760,10 @@ class FHIRObject(dict):
         :param json: parsed JSON (dict)
         :return: FHIR object created from JSON
         """
-        kwargs = {}
-        for field, value in six.iteritems(json):
-            if field not in cls._fhir_fields:
-                continue
-            element = cls._fhir_fields[field]
-            if not element.type.is_complex and not element.type.is_backbone:
-                if element.type.is_resource:
-                    kwargs[field] = cls._fhir_resources.from_json(value)
-                else:
-                    kwargs[field] = value
-            else:
-                if element.type.is_backbone:
-                    _class = getattr(cls, to_camel_case(field))
-                else:
-                    _class = cls._fhir_resources.get(element.type.code)
-                if element.is_array:
-                    kwargs[field] = [_class.from_json(v) for v in value]
-                else:
-                    kwargs[field] = _class.from_json(value)
-
-        return cls(**kwargs)
+        decoder = cls._fhir_json_decoder
+        if decoder is None:
+            decoder = cls._fhir_resources._decoder(cls, False)
+        return decoder(json)
 
     @classmethod
     def from_db_json(cls, json):
@@ -206,55 +776,29 @@ class FHIRObject(dict):
         :param json: parsed JSON (dict)
         :return: FHIR object created from JSON
         """
-        kwargs = {}
-        poly_fields = {}
-        for field, value in six.iteritems(json):
-            if field in cls._fhir_polymorphic:
-                # Leave polymorphic types unchanged when converting from DB
-                # format
-                poly_fields[field] = value
-            if field not in cls._fhir_fields:
-                continue
-            element = cls._fhir_fields[field]
-            if not element.type.is_complex and not element.type.is_backbone:
-                if element.type.is_resource:
-                    kwargs[field] = cls._fhir_resources.from_db_json(value)
-                else:
-                    kwargs[field] = value
-            else:
-                if element.type.is_backbone:
-                    _class = getattr(cls, to_camel_case(field))
-                else:
-                    if element.type.is_reference:
-                        _class = DBReference
-                    else:
-                        _class = cls._fhir_resources.get(element.type.code)
-                if element.is_array:
-                    kwargs[field] = [_class.from_db_json(v) for v in value]
-                else:
-                    kwargs[field] = _class.from_db_json(value)
-
-        resource = cls(**kwargs)
-        resource.update(poly_fields)
-        return resource
+        decoder = cls._fhir_db_json_decoder
+        if decoder is None:
+            decoder = cls._fhir_resources._decoder(cls, True)
+        return decoder(json)
 
     def to_db_format(self):
         """Convert FHIR Object to a DB friendly format."""
         converted = {}
+        plan = self._fhir_plan
         for field, value in six.iteritems(self):
-            if field not in self._fhir_fields:
+            try:
+                kind, is_array = plan[field]
+            except KeyError:
                 continue
-            element = self._fhir_fields[field]
-            if element.type.is_reference:
-                if element.is_array:
+            if kind is _REFERENCE:
+                if is_array:
                     converted[field] = [
                         DBReference.from_reference(r) for r in value
                     ]
                 else:
-                    db_ref = DBReference.from_reference(value)
-                    converted[field] = db_ref
-            elif element.type.is_backbone or element.type.is_complex:
-                if element.is_array:
+                    converted[field] = DBReference.from_reference(value)
+            elif kind is _NESTED:
+                if is_array:
                     [v.to_db_format() for v in value]
                 else:
                     value.to_db_format()
@@ -280,17 +824,19 @@ class FHIRObject(dict):
             return ref
 
         converted = {}
+        plan = self._fhir_plan
         for field, value in six.iteritems(self):
-            if field not in self._fhir_fields:
+            try:
+                kind, is_array = plan[field]
+            except KeyError:
                 continue
-            element = self._fhir_fields[field]
-            if element.type.is_reference:
-                if element.is_array:
+            if kind is _REFERENCE:
+                if is_array:
                     converted[field] = [_convert_ref(r) for r in value]
                 else:
                     converted[field] = _convert_ref(value)
-            elif element.type.is_backbone or element.type.is_complex:
-                if element.is_array:
+            elif kind is _NESTED:
+                if is_array:
                     [v.to_fhir_format() for v in value]
                 else:
                     value.to_fhir_format()
@@ -298,7 +844,8 @@ class FHIRObject(dict):
             if poly_field not in self:
                 continue
             value = self.pop(poly_field)
-            type_code, value = value.popitem()
+            # Do not modify value in place, it can be shared with input JSON
+            type_code, value = next(six.iteritems(value))
             field_name = poly_field + to_camel_case(type_code)
             try:
                 _class = self._fhir_resources.get(type_code)
@@ -310,24 +857,257 @@ class FHIRObject(dict):
         self.update(converted)
 
     def replace_refs(self, old, new):
-        def _convert_ref(val):
-            if 'reference' in val and val.reference == old:
-                val.reference = new
+        """Replace reference in this object and all nested objects
 
-        for field, value in six.iteritems(self):
-            if field not in self._fhir_fields:
+        :param old: reference to replace (e.g. `Patient/1`)
+        :param new: new reference
+        """
+        self.replace_refs_many({old: new})
+
+    def replace_refs_many(self, mapping):
+        """Replace many references in a single pass
+
+        Every `Reference.reference` in this object, nested objects and
+        contained resources is looked up in `mapping` once.
+
+        :param mapping: dictionary (old reference -> new reference) or a
+                        callable that gets old reference and returns a new
+                        one (or `None` to keep old reference)
+        :return: number of replaced references
+        """
+        if isinstance(mapping, collections_abc.Mapping):
+            lookup = mapping.get
+        else:
+            lookup = mapping
+        return _replace_refs(self, lookup)
+
+    def to_summary(self):
+        """Get summary of this object (as with `_summary=true`)
+
+        Summary contains elements marked as summary in definitions,
+        mandatory elements, `id` and `meta`. Backbone elements are
+        summarized as well. Values are not copied: they are shared with
+        this object, the object itself is returned if nothing is left out.
+
+        :return: FHIR object of the same class
+        :raises ValueError: if definitions do not mark summary elements
+                            (generated without `isSummary`)
+        """
+        resources = self._fhir_resources
+        if not resources._has_summary():
+            raise ValueError('Definitions do not mark summary elements, '
+                             'regenerate them with isSummary')
+        return resources._projection(type(self))(self)
+
+    def project(self, elements):
+        """Get object with selected elements only (as with `_elements`)
+
+        Mandatory elements, `id` and `meta` are always included. Choice
+        elements can be selected by their name (`value`) or by the name
+        of a single type (`valueQuantity`), elements of nested objects by
+        a dot-separated path (`contact.name`). Unknown elements are
+        ignored. Values are not copied: they are shared with this object.
+
+        :param elements: names or paths of elements
+        :return: FHIR object of the same class
+        """
+        return self._fhir_resources._projection(
+            type(self), frozenset(elements))(self)
+
+    def to_json_bytes(self, backend=None):
+        """Serialize object to compact UTF-8 encoded JSON
+
+        See :func:`fhir_tools.serialization.to_json_bytes` for details.
+
+        :param backend: JSON backend (the fastest available by default)
+        :return: JSON (bytes)
+        """
+        return serialization.to_json_bytes(self, backend)
+
+    def iter_references(self):
+        """Find all references in this object, nested objects and contained
+        resources
+
+        Only fields that can contain references are visited. References
+        in polymorphic fields in a DB friendly format are not reported.
+
+        :return: generator object that will yield pairs (path, reference),
+                 where path is dot-separated path to the element relative
+                 to this object (e.g. `contact.organization`) and reference
+                 is a `Reference` (or :class:`DBReference`) object
+        """
+        for path, reference, _ in _iter_references(type(self), self, ''):
+            yield path, reference
+
+
+class FHIRObject(BaseFHIRObject, dict):
+    """FHIR object backed by a dictionary"""
+
+    def __init__(self, **kwargs):
+        initial = {
+            k: v
+            for k, v in self._fhir_initial(kwargs) if k in self._fhir_fields
+        }
+        dict.__init__(self, **initial)
+
+    @classmethod
+    def _fhir_build(cls, items):
+        obj = dict.__new__(cls)
+        dict.update(obj, items)
+        return obj
+
+
+class LazyFHIRObject(FHIRObject):
+    """Lazy view of a parsed JSON, see :meth:`Resources.wrap`.
+
+    Lazy classes derive from this class and a generated class. Fields that
+    are not converted yet are tracked in `_fhir_pending`, every method that
+    returns values converts them first. Code that reads the dictionary
+    directly (e.g. `orjson`) has to call :meth:`_fhir_materialize_deep`
+    first, raw values may contain unknown elements.
+    """
+    _fhir_lazy_converters = {}
+    _fhir_lazy = True
+
+    @classmethod
+    def _fhir_build(cls, items):
+        obj = super(LazyFHIRObject, cls)._fhir_build(items)
+        object.__setattr__(obj, '_fhir_pending', set())
+        return obj
+
+    @classmethod
+    def _fhir_wrap(cls, json):
+        converters = cls._fhir_lazy_converters
+        obj = dict.__new__(cls)
+        pending = set()
+        for field, value in json.items():
+            converter = converters.get(field, _MISSING)
+            if converter is _MISSING:
                 continue
-            element = self._fhir_fields[field]
-            if element.type.is_reference:
-                if element.is_array:
-                    [_convert_ref(r) for r in value]
-                else:
-                    _convert_ref(value)
-            elif element.type.is_backbone or element.type.is_complex:
-                if element.is_array:
-                    [v.replace_refs(old, new) for v in value]
-                else:
-                    value.replace_refs(old, new)
+            if value is None or (isinstance(value, list) and not value):
+                continue
+            if converter is not None:
+                pending.add(field)
+            dict.__setitem__(obj, field, value)
+        resource_type = getattr(cls, '_fhir_resource_type', None)
+        if resource_type is not None:
+            dict.__setitem__(obj, 'resourceType', resource_type)
+        object.__setattr__(obj, '_fhir_pending', pending)
+        return obj
+
+    def _fhir_materialize(self, field):
+        self._fhir_pending.discard(field)
+        value = self._fhir_lazy_converters[field](dict.__getitem__(self, field))
+        dict.__setitem__(self, field, value)
+        return value
+
+    def _fhir_materialize_all(self):
+        for field in list(self._fhir_pending):
+            self._fhir_materialize(field)
+
+    def _fhir_materialize_deep(self):
+        """Convert pending values of this view and of nested views"""
+        self._fhir_materialize_all()
+        for value in dict.values(self):
+            if isinstance(value, list):
+                for item in value:
+                    if isinstance(item, LazyFHIRObject):
+                        item._fhir_materialize_deep()
+            elif isinstance(value, LazyFHIRObject):
+                value._fhir_materialize_deep()
+
+    def __getitem__(self, key):
+        if key in self._fhir_pending:
+            return self._fhir_materialize(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key in self._fhir_pending:
+            return self._fhir_materialize(key)
+        return dict.get(self, key, default)
+
+    def setdefault(self, key, default=None):
+        if key in self._fhir_pending:
+            return self._fhir_materialize(key)
+        return dict.setdefault(self, key, default)
+
+    def pop(self, key, *args):
+        if key in self._fhir_pending:
+            self._fhir_materialize(key)
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        self._fhir_materialize_all()
+        return dict.popitem(self)
+
+    def __setitem__(self, key, value):
+        self._fhir_pending.discard(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._fhir_pending.discard(key)
+        dict.__delitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        self._fhir_pending.difference_update(other)
+        dict.update(self, other)
+
+    def clear(self):
+        self._fhir_pending.clear()
+        dict.clear(self)
+
+    def copy(self):
+        self._fhir_materialize_all()
+        return dict.copy(self)
+
+    def items(self):
+        self._fhir_materialize_all()
+        return dict.items(self)
+
+    def values(self):
+        self._fhir_materialize_all()
+        return dict.values(self)
+
+    if six.PY2:
+        def iteritems(self):
+            self._fhir_materialize_all()
+            return dict.iteritems(self)
+
+        def itervalues(self):
+            self._fhir_materialize_all()
+            return dict.itervalues(self)
+
+        def viewitems(self):
+            self._fhir_materialize_all()
+            return dict.viewitems(self)
+
+        def viewvalues(self):
+            self._fhir_materialize_all()
+            return dict.viewvalues(self)
+
+    def __iter__(self):
+        # Overridden, so that `dict(view)` and `dict.update` do not copy
+        # pending (raw) values, they go through `__getitem__` instead
+        return dict.__iter__(self)
+
+    def __eq__(self, other):
+        self._fhir_materialize_all()
+        if isinstance(other, LazyFHIRObject):
+            other._fhir_materialize_all()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __reduce_ex__(self, protocol):
+        self._fhir_materialize_all()
+        return super(LazyFHIRObject, self).__reduce_ex__(protocol)
 
 
 class Type(FHIRObject):
@@ -346,6 +1126,160 @@ class Resource(FHIRObject):
         self['resourceType'] = self._fhir_resource_type
 
 
+class CompactFHIRObject(BaseFHIRObject, collections_abc.MutableMapping):
+    """FHIR object backed by `__slots__`
+
+    Uses considerably less memory than :class:`FHIRObject`, while keeping the
+    same attribute and mapping interface. It is not a `dict` though.
+
+    Each generated class has a slot per field, all types of a polymorphic
+    field share a single slot (named after the field). Names of the fields
+    that are set are kept in insertion order in a tuple, which is shared
+    between objects with the same set of fields.
+    """
+    __slots__ = ('_fhir_keys', )
+
+    #: Field name -> name of the slot
+    _fhir_slot_of = {}
+    #: Shared tuples of field names
+    _fhir_key_sets = {}
+    #: Names of fields that share a slot (polymorphic fields)
+    _fhir_shared_slots = frozenset()
+
+    def __init__(self, **kwargs):
+        self._fhir_store([(k, v) for k, v in self._fhir_initial(kwargs)
+                          if k in self._fhir_fields])
+
+    @classmethod
+    def _fhir_build(cls, items):
+        obj = cls.__new__(cls)
+        obj._fhir_store(items)
+        return obj
+
+    def _fhir_store(self, items):
+        setattr_ = object.__setattr__
+        slot_of = self._fhir_slot_of
+        for key, value in items:
+            setattr_(self, slot_of[key], value)
+        keys = tuple([key for key, _ in items])
+        if not self._fhir_shared_slots.isdisjoint(keys):
+            # Only one type of a polymorphic field can be set (the last one)
+            slots = {slot_of[key]: key for key in keys}
+            keys = tuple(key for key in keys if slots[slot_of[key]] == key)
+        setattr_(self, '_fhir_keys',
+                 self._fhir_key_sets.setdefault(keys, keys))
+
+    def _fhir_set_keys(self, keys):
+        object.__setattr__(self, '_fhir_keys',
+                           self._fhir_key_sets.setdefault(keys, keys))
+
+    def __getitem__(self, key):
+        if key in self._fhir_keys:
+            return object.__getattribute__(self, self._fhir_slot_of[key])
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        try:
+            slot = self._fhir_slot_of[key]
+        except KeyError:
+            raise KeyError('{} has no field {}'.format(
+                type(self).__name__, key))
+        keys = self._fhir_keys
+        if key not in keys:
+            slot_of = self._fhir_slot_of
+            self._fhir_set_keys(
+                tuple(k for k in keys if slot_of[k] != slot) + (key, ))
+        object.__setattr__(self, slot, value)
+
+    def __delitem__(self, key):
+        keys = self._fhir_keys
+        if key not in keys:
+            raise KeyError(key)
+        object.__delattr__(self, self._fhir_slot_of[key])
+        self._fhir_set_keys(tuple(k for k in keys if k != key))
+
+    def __contains__(self, key):
+        return key in self._fhir_keys
+
+    def __iter__(self):
+        return iter(self._fhir_keys)
+
+    def __len__(self):
+        return len(self._fhir_keys)
+
+    def get(self, key, default=None):
+        if key in self._fhir_keys:
+            return object.__getattribute__(self, self._fhir_slot_of[key])
+        return default
+
+    def items(self):
+        getattr_ = object.__getattribute__
+        slot_of = self._fhir_slot_of
+        return [(k, getattr_(self, slot_of[k])) for k in self._fhir_keys]
+
+    def values(self):
+        getattr_ = object.__getattribute__
+        slot_of = self._fhir_slot_of
+        return [getattr_(self, slot_of[k]) for k in self._fhir_keys]
+
+    if six.PY2:
+        def iteritems(self):
+            return iter(self.items())
+
+        def itervalues(self):
+            return iter(self.values())
+
+        def iterkeys(self):
+            return iter(self._fhir_keys)
+
+    def __eq__(self, other):
+        if isinstance(other, collections_abc.Mapping):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+    def __copy__(self):
+        return self._fhir_build(self.items())
+
+    def __deepcopy__(self, memo):
+        return self._fhir_build([(k, copy.deepcopy(v, memo))
+                                 for k, v in self.items()])
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self.items()))
+
+
+class CompactType(CompactFHIRObject):
+    __slots__ = ()
+
+
+class CompactBackbone(CompactFHIRObject):
+    __slots__ = ()
+
+
+class CompactResource(CompactFHIRObject):
+    __slots__ = ()
+    _fhir_resource_type = None
+
+    def __init__(self, **kwargs):
+        CompactFHIRObject.__init__(self, **kwargs)
+        self['resourceType'] = self._fhir_resource_type
+
+
+_COMPACT_BASES = {
+    Type: CompactType,
+    Backbone: CompactBackbone,
+    Resource: CompactResource,
+}
+
+
 class DBReference(dict):
     @classmethod
     def from_json(cls, json):
@@ -392,5 +1326,158 @@ class DBReference(dict):
         self['display'] = value
 
 
-def to_camel_case(name):
-    return name[:1].capitalize() + name[1:]
+_MISSING = object()
+# Converter marker for polymorphic fields in DB format (kept unchanged)
+_POLYMORPHIC = object()
+
+# Kinds of fields in traversal plans, see `Resources._create_plan`
+_REFERENCE = 'reference'
+_NESTED = 'nested'
+_RESOURCE = 'resource'
+
+
+def _make_decoder(_class, converters):
+    build = _class._fhir_build
+    resource_type = getattr(_class, '_fhir_resource_type', None)
+
+    def decode(json):
+        items = []
+        polymorphic = None
+        for field, value in json.items():
+            converter = converters.get(field, _MISSING)
+            if converter is None:
+                pass
+            elif converter is _MISSING:
+                continue
+            elif converter is _POLYMORPHIC:
+                if polymorphic is None:
+                    polymorphic = []
+                polymorphic.append((field, value))
+                continue
+            elif value is not None:
+                value = converter(value)
+            if value is None or (isinstance(value, list) and not value):
+                continue
+            items.append((field, value))
+        if resource_type is not None:
+            items.append(('resourceType', resource_type))
+        if polymorphic is not None:
+            items.extend(polymorphic)
+        return build(items)
+
+    return decode
+
+
+def _make_projection(fields, nested):
+    def project(obj):
+        items = []
+        changed = False
+        for field in obj:
+            if field not in fields:
+                changed = True
+                continue
+            value = obj[field]
+            project_nested = nested.get(field)
+            if project_nested is not None:
+                if isinstance(value, list):
+                    projected = [project_nested(v) for v in value]
+                    if any(p is not v for p, v in zip(projected, value)):
+                        value = projected
+                        changed = True
+                else:
+                    projected = project_nested(value)
+                    if projected is not value:
+                        value = projected
+                        changed = True
+            items.append((field, value))
+        if not changed:
+            return obj
+        return type(obj)._fhir_build(items)
+
+    return project
+
+
+def _replace_refs(obj, lookup):
+    replaced = 0
+    plan = obj._fhir_plan
+    for field, value in six.iteritems(obj):
+        try:
+            kind, is_array = plan[field]
+        except KeyError:
+            continue
+        values = value if is_array else (value,)
+        if kind is _REFERENCE:
+            for ref in values:
+                old = ref.get('reference')
+                if old is None:
+                    continue
+                new = lookup(old)
+                if new is not None and new != old:
+                    ref['reference'] = new
+                    replaced += 1
+        else:
+            for v in values:
+                replaced += _replace_refs(v, lookup)
+    return replaced
+
+
+def _iter_references(_class, obj, prefix):
+    plan = _class._fhir_plan
+    for field, value in six.iteritems(obj):
+        try:
+            kind, is_array = plan[field]
+        except KeyError:
+            continue
+        path = prefix + field
+        values = value if is_array else (value,)
+        if kind is _REFERENCE:
+            targets = _class._fhir_fields[field].type.to
+            for reference in values:
+                yield path, reference, targets
+        else:
+            child_prefix = path + '.'
+            for v in values:
+                child = _class._fhir_resources._child_class(_class, field, v)
+                for item in _iter_references(child, v, child_prefix):
+                    yield item
+
+
+def reference_target(reference, targets=None):
+    """Get target of a reference
+
+    Target type is taken from the reference (`Patient/1`, absolute URLs
+    and version specific references are supported), for other references
+    (contained `#id`, `urn:uuid:`, etc.) from `Reference.type` or from
+    `targets` if there is only one.
+
+    :param reference: Reference (FHIR or DB format, FHIR object or parsed
+                      JSON)
+    :param targets: target types allowed by the element definition
+    :return: pair (target type, target id), target type is `None` if it
+             is not known; `None` for logical references
+    """
+    if 'reference' not in reference:
+        if 'resourceType' in reference and 'id' in reference:
+            # DB format
+            return reference['resourceType'], reference['id']
+        return None  # Logical reference
+    value = reference['reference']
+    if not value.startswith('#') and not value.startswith('urn:'):
+        parts = value.split('/')
+        if '_history' in parts:
+            parts = parts[:parts.index('_history')]
+        if len(parts) >= 2:
+            return parts[-2], parts[-1]
+    target_type = reference.get('type')
+    if target_type is None and targets and len(targets) == 1 and \
+            targets[0] != 'Resource':
+        target_type = targets[0]
+    return target_type, value
+
+
+def _array_converter(decoder):
+    def convert(values):
+        return [decoder(v) for v in values]
+
+    return convert
+
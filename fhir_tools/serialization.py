@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""Serialization of FHIR objects to JSON and NDJSON.
+
+Output is compact UTF-8 encoded JSON (no whitespace, non-ASCII characters
+are not escaped). If `orjson <https://github.com/ijl/orjson>`_ is
+installed, it is used to speed up serialization. Output does not depend on
+the backend: values that `orjson` formats differently from the standard
+library (floats in exponent notation, NaN and infinity) or does not
+support (integers beyond 64 bits, non-string keys) are serialized with the
+standard library.
+"""
+from __future__ import unicode_literals
+import io
+import json
+import re
+
+import six
+from six.moves import collections_abc
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#: Standard library backend
+JSON = 'json'
+#: orjson backend
+ORJSON = 'orjson'
+#: Backend used by default (the fastest available)
+DEFAULT_BACKEND = JSON if orjson is None else ORJSON
+
+#: Default size of the write buffer of :class:`NDJSONWriter` (bytes)
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+# orjson formats floats in exponent notation differently from the standard
+# library (`1e16` vs `1e+16`, `0.00001` vs `1e-05`) and writes NaN/infinity
+# as `null`. Output that may contain such values is serialized again with
+# the standard library (matches inside strings only cause an unnecessary
+# fallback).
+_EXPONENT = re.compile(br'e[-\d]')
+
+
+def _orjson_mismatch(data):
+    if b'null' in data or b'0.0000' in data:
+        return True
+    for match in _EXPONENT.finditer(data):
+        start = match.start()
+        if data[start - 1:start].isdigit():
+            return True
+    return False
+
+
+def _default(obj):
+    if isinstance(obj, collections_abc.Mapping):
+        # Compact FHIR objects are mappings, but not dictionaries
+        return dict(obj)
+    raise TypeError('Object of type {} is not JSON serializable'.format(
+        type(obj).__name__))
+
+
+_encoder = json.JSONEncoder(ensure_ascii=False, allow_nan=False,
+                            separators=(',', ':'), default=_default)
+
+
+def _dumps_json(obj):
+    text = _encoder.encode(obj)
+    if isinstance(text, six.text_type):
+        return text.encode('utf-8')
+    return text
+
+
+if orjson is not None:
+    def _dumps_orjson(obj, _dumps=orjson.dumps,
+                      _error=orjson.JSONEncodeError):
+        if getattr(obj, '_fhir_lazy', False):
+            # orjson reads dictionaries directly, pending values of lazy
+            # views have to be converted first
+            obj._fhir_materialize_deep()
+        try:
+            data = _dumps(obj, default=_default)
+        except _error:
+            return _dumps_json(obj)
+        if _orjson_mismatch(data):
+            return _dumps_json(obj)
+        return data
+else:
+    _dumps_orjson = None
+
+_BACKENDS = {
+    JSON: _dumps_json,
+    ORJSON: _dumps_orjson,
+}
+
+
+def get_dumps(backend=None):
+    """Get serialization function of a backend
+
+    :param backend: :data:`JSON`, :data:`ORJSON` or `None` for
+                    :data:`DEFAULT_BACKEND`
+    :return: function (value -> bytes)
+    :raises ValueError: if backend is unknown or not installed
+    """
+    if backend is None:
+        backend = DEFAULT_BACKEND
+    dumps = _BACKENDS.get(backend)
+    if dumps is None:
+        raise ValueError('Backend is not available: {}'.format(backend))
+    return dumps
+
+
+def to_json_bytes(obj, backend=None):
+    """Serialize FHIR object (or any JSON compatible value) to JSON
+
+    :param obj: FHIR object, parsed JSON, etc.
+    :param backend: :data:`JSON`, :data:`ORJSON` or `None` for
+                    :data:`DEFAULT_BACKEND`
+    :return: UTF-8 encoded JSON (bytes)
+    :raises ValueError: if value can not be represented in JSON (NaN,
+                        infinity)
+    :raises TypeError: if value is not JSON serializable
+    """
+    return get_dumps(backend)(obj)
+
+
+class NDJSONWriter(object):
+    """Buffered writer of NDJSON.
+
+    Serialized resources are collected in memory and written to the file
+    in large blocks.
+
+    :param target: path to a file or a binary file object (file objects
+                   are not closed)
+    :param buffer_size: size of blocks written to the file
+    :param backend: :data:`JSON`, :data:`ORJSON` or `None` for
+                    :data:`DEFAULT_BACKEND`
+    :ivar count: number of written resources
+    """
+    def __init__(self, target, buffer_size=DEFAULT_BUFFER_SIZE, backend=None):
+        if hasattr(target, 'write'):
+            self._fp = target
+            self._owned = False
+        else:
+            self._fp = io.open(target, 'wb')
+            self._owned = True
+        self._dumps = get_dumps(backend)
+        self._buffer_size = buffer_size
+        self._chunks = []
+        self._size = 0
+        self.count = 0
+
+    def write(self, obj):
+        """Write a resource
+
+        :param obj: FHIR object or parsed JSON
+        """
+        data = self._dumps(obj)
+        self._chunks.append(data)
+        self._chunks.append(b'\n')
+        self._size += len(data) + 1
+        self.count += 1
+        if self._size >= self._buffer_size:
+            self.flush()
+
+    def write_many(self, iterable):
+        """Write many resources
+
+        :param iterable: FHIR objects or parsed JSON
+        """
+        for obj in iterable:
+            self.write(obj)
+
+    def flush(self):
+        """Write buffered data to the file"""
+        if self._chunks:
+            self._fp.write(b''.join(self._chunks))
+            self._chunks = []
+            self._size = 0
+        self._fp.flush()
+
+    def close(self):
+        """Flush buffered data and close the file (if it was opened by the
+        writer)
+        """
+        self.flush()
+        if self._owned:
+            self._fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
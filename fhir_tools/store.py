@@ -0,0 +1,366 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""In-memory store of resources with secondary indexes"""
+from __future__ import unicode_literals
+import bisect
+import datetime
+import threading
+
+import six
+from six.moves import collections_abc
+
+from . import paths
+from . import resources as _resources
+
+#: Index of references (`Observation.subject`), searched by reference
+#: (`Patient/1`)
+REFERENCE = 'reference'
+#: Index of tokens (identifiers, codings, codes), searched by `code` or
+#: `system|code` (`|code` for codes without a system)
+TOKEN = 'token'
+#: Index of dates (date, dateTime, instant, start of a Period or its end
+#: if it has no start), searched by range
+DATE = 'date'
+
+_INDEX_TYPES = {
+    REFERENCE: frozenset(['Reference']),
+    TOKEN: frozenset(['Identifier', 'Coding', 'CodeableConcept',
+                      'ContactPoint', 'code', 'string', 'id', 'uri',
+                      'canonical', 'boolean']),
+    DATE: frozenset(['date', 'dateTime', 'instant', 'Period']),
+}
+
+_ANY_SYSTEM = '*'
+
+
+def _reference_keys(values):
+    keys = set()
+    for value in values:
+        if not isinstance(value, collections_abc.Mapping):
+            continue
+        target = _resources.reference_target(value)
+        if target is not None:
+            keys.add(_reference_key(*target))
+    return keys
+
+
+def _reference_key(target_type, target_id):
+    if target_type is None:
+        return target_id
+    return '{}/{}'.format(target_type, target_id)
+
+
+def _token_keys(values):
+    keys = set()
+    for value in values:
+        if isinstance(value, collections_abc.Mapping):
+            if 'coding' in value:
+                pairs = [(c.get('system'), c.get('code'))
+                         for c in value['coding']]
+            elif 'code' in value:
+                pairs = [(value.get('system'), value['code'])]
+            else:
+                pairs = [(value.get('system'), value.get('value'))]
+        else:
+            pairs = [(None, value)]
+        for system, code in pairs:
+            if code is None:
+                continue
+            if isinstance(code, bool):
+                code = 'true' if code else 'false'
+            keys.add((system, code))
+            keys.add((_ANY_SYSTEM, code))
+    return keys
+
+
+def _token_key(token):
+    if '|' not in token:
+        return _ANY_SYSTEM, token
+    system, code = token.split('|', 1)
+    return system or None, code
+
+
+def _date_keys(values):
+    keys = set()
+    for value in values:
+        if isinstance(value, collections_abc.Mapping):
+            # Period, by start (by end if it has no start)
+            value = value.get('start') or value.get('end')
+        value = paths.parse_datetime(value)
+        if value is not None:
+            keys.add(value)
+    return keys
+
+
+def _to_datetime(value):
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    result = paths.parse_datetime(value)
+    if result is None:
+        raise ValueError('Invalid date: {}'.format(value))
+    return result
+
+
+class _HashIndex(object):
+    def __init__(self):
+        self.ids = {}
+
+    def add(self, _id, keys):
+        for key in keys:
+            self.ids.setdefault(key, set()).add(_id)
+
+    def remove(self, _id, keys):
+        for key in keys:
+            ids = self.ids[key]
+            ids.discard(_id)
+            if not ids:
+                del self.ids[key]
+
+    def search(self, key):
+        return self.ids.get(key, ())
+
+
+class _SortedIndex(object):
+    def __init__(self):
+        self.entries = []
+
+    def add(self, _id, keys):
+        for key in keys:
+            bisect.insort(self.entries, (key, _id))
+
+    def remove(self, _id, keys):
+        for key in keys:
+            position = bisect.bisect_left(self.entries, (key, _id))
+            del self.entries[position]
+
+    def search_range(self, start, end):
+        entries = self.entries
+        first = 0 if start is None else bisect.bisect_left(
+            entries, (start, ''))
+        last = len(entries) if end is None else bisect.bisect_left(
+            entries, (end, ''))
+        seen = set()
+        for _, _id in entries[first:last]:
+            if _id not in seen:
+                seen.add(_id)
+                yield _id
+
+
+_INDEXES = {
+    REFERENCE: (_reference_keys, _HashIndex),
+    TOKEN: (_token_keys, _HashIndex),
+    DATE: (_date_keys, _SortedIndex),
+}
+
+
+class _IndexDefinition(object):
+    def __init__(self, name, compiled, kind):
+        self.name = name
+        self.compiled = compiled
+        self.kind = kind
+        keys, index_class = _INDEXES[kind]
+        self.get_keys = keys
+        self.index = index_class()
+
+    def keys(self, resource):
+        return self.get_keys(self.compiled(resource))
+
+
+class ResourceStore(object):
+    """In-memory store of resources.
+
+    Resources are stored by type and id. Secondary indexes are defined by
+    path expressions (see :class:`fhir_tools.paths.PathEngine`) and kept
+    up to date as resources are stored and deleted:
+
+    * :data:`REFERENCE` - references (`Observation.subject`)
+    * :data:`TOKEN` - identifiers, codings, codeable concepts and codes
+      (`Patient.identifier`, `Observation.code`)
+    * :data:`DATE` - dates, date-times, instants and periods (by start, by
+      end if a period has no start), searched by range
+      (`Observation.effective`)
+
+    Store is thread-safe. Stored resources must not be modified in place
+    (store them again instead), otherwise indexes get out of date.
+
+    :param resources: repository of FHIR classes
+                      (:class:`fhir_tools.resources.Resources`)
+    :param engine: :class:`fhir_tools.paths.PathEngine` used to compile
+                   index expressions (created if not provided)
+    """
+    def __init__(self, resources, engine=None):
+        self._repository = resources
+        if engine is None:
+            engine = paths.PathEngine(resources._definitions)
+        self._engine = engine
+        self._resources = {}  # type -> {id -> resource}
+        self._indexes = {}  # type -> {name -> index definition}
+        self._keys = {}  # (type, id) -> {name -> keys}
+        self._lock = threading.RLock()
+
+    def add_index(self, name, expression, kind):
+        """Add a secondary index
+
+        Resources already in the store are indexed immediately.
+
+        :param name: name of the index (unique for a resource type)
+        :param expression: path expression starting with a resource type
+                           (`Observation.subject`,
+                           `Patient.identifier.where(use='official')`)
+        :param kind: :data:`REFERENCE`, :data:`TOKEN` or :data:`DATE`
+        :raises ValueError: if index is not valid for the expression
+        """
+        if kind not in _INDEXES:
+            raise ValueError('Invalid kind of index: {}'.format(kind))
+        compiled = self._engine.compile(expression)
+        resource_type = compiled.root
+        if resource_type not in self._repository._definitions.res_defs:
+            raise ValueError('Expression has to start with a resource '
+                             'type: {}'.format(expression))
+        if not _INDEX_TYPES[kind].intersection(compiled.types):
+            raise ValueError('Values of {} can not be used in a {} '
+                             'index'.format(expression, kind))
+        definition = _IndexDefinition(name, compiled, kind)
+        with self._lock:
+            indexes = self._indexes.setdefault(resource_type, {})
+            if name in indexes:
+                raise ValueError('Index already exists: {}'.format(name))
+            indexes[name] = definition
+            for _id, resource in six.iteritems(
+                    self._resources.get(resource_type, {})):
+                keys = definition.keys(resource)
+                definition.index.add(_id, keys)
+                self._keys[(resource_type, _id)][name] = keys
+
+    def put(self, resource):
+        """Insert or replace a resource
+
+        :param resource: FHIR object or parsed JSON (converted to a FHIR
+                         object) with `id`
+        :return: stored FHIR object
+        :raises ValueError: if resource does not have an id
+        """
+        if not isinstance(resource, _resources.BaseFHIRObject):
+            resource = self._repository.from_json(resource)
+        resource_type = resource['resourceType']
+        _id = resource.get('id')
+        if _id is None:
+            raise ValueError('Resource does not have an id')
+        with self._lock:
+            indexes = self._indexes.get(resource_type, {})
+            self._unindex(resource_type, _id)
+            self._resources.setdefault(resource_type, {})[_id] = resource
+            all_keys = self._keys[(resource_type, _id)] = {}
+            for name, definition in six.iteritems(indexes):
+                keys = definition.keys(resource)
+                definition.index.add(_id, keys)
+                all_keys[name] = keys
+        return resource
+
+    def put_many(self, iterable):
+        """Insert or replace many resources
+
+        :param iterable: FHIR objects or parsed JSON
+        """
+        for resource in iterable:
+            self.put(resource)
+
+    def get(self, resource_type, _id, default=None):
+        """Get a resource
+
+        :param resource_type: resource type
+        :param _id: id of the resource
+        :param default: value returned if resource is not found
+        :return: FHIR object
+        """
+        return self._resources.get(resource_type, {}).get(_id, default)
+
+    def delete(self, resource_type, _id):
+        """Delete a resource
+
+        :param resource_type: resource type
+        :param _id: id of the resource
+        :return: deleted FHIR object
+        :raises KeyError: if resource is not found
+        """
+        with self._lock:
+            resource = self._resources.get(resource_type, {}).pop(_id)
+            self._unindex(resource_type, _id)
+            return resource
+
+    def _unindex(self, resource_type, _id):
+        all_keys = self._keys.pop((resource_type, _id), None)
+        if all_keys is None:
+            return
+        indexes = self._indexes[resource_type]
+        for name, keys in six.iteritems(all_keys):
+            indexes[name].index.remove(_id, keys)
+
+    def search(self, resource_type, name, value):
+        """Find resources by a reference or a token
+
+        :param resource_type: resource type
+        :param name: name of a :data:`REFERENCE` or :data:`TOKEN` index
+        :param value: reference (`Patient/1`, absolute URLs are accepted as
+                      well) or token (`code`, `system|code` or `|code`)
+        :return: list of FHIR objects (in no particular order)
+        :raises KeyError: if index does not exist
+        """
+        definition = self._indexes.get(resource_type, {})[name]
+        if definition.kind == REFERENCE:
+            key = _reference_key(*_resources.reference_target(
+                {'reference': value}))
+        elif definition.kind == TOKEN:
+            key = _token_key(value)
+        else:
+            raise ValueError('Use search_range for {} indexes'.format(DATE))
+        with self._lock:
+            stored = self._resources.get(resource_type, {})
+            return [stored[_id] for _id in definition.index.search(key)]
+
+    def search_range(self, resource_type, name, start=None, end=None):
+        """Find resources by a date range
+
+        :param resource_type: resource type
+        :param name: name of a :data:`DATE` index
+        :param start: beginning of the range, inclusive (`datetime` or a
+                      FHIR date string, `None` for unbounded)
+        :param end: end of the range, exclusive
+        :return: list of FHIR objects (ordered by date)
+        :raises KeyError: if index does not exist
+        """
+        definition = self._indexes.get(resource_type, {})[name]
+        if definition.kind != DATE:
+            raise ValueError('Use search for {} indexes'.format(
+                definition.kind))
+        start = _to_datetime(start)
+        end = _to_datetime(end)
+        with self._lock:
+            stored = self._resources.get(resource_type, {})
+            return [stored[_id]
+                    for _id in definition.index.search_range(start, end)]
+
+    def iter_resources(self, resource_type=None):
+        """Iterate over stored resources
+
+        :param resource_type: only resources of a type (all by default)
+        :return: generator object that will yield FHIR objects
+        """
+        with self._lock:
+            if resource_type is None:
+                stored = [r for by_id in six.itervalues(self._resources)
+                          for r in six.itervalues(by_id)]
+            else:
+                stored = list(six.itervalues(
+                    self._resources.get(resource_type, {})))
+        return iter(stored)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        """Check if resource is stored
+
+        :param key: pair (resource type, id)
+        """
+        return key in self._keys
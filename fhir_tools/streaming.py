@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""Helpers for reading FHIR data from streams"""
+from __future__ import unicode_literals
+import codecs
+import contextlib
+import io
+import json
+import re
+
+#: Default size of the read buffer (bytes)
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+# BundleParser states
+_START = 'start'  # expecting '{' of the Bundle
+_FIRST_KEY = 'first key'  # expecting a key or '}'
+_KEY = 'key'  # expecting a key
+_COLON = 'colon'  # expecting ':'
+_VALUE = 'value'  # expecting a value
+_AFTER_VALUE = 'after value'  # expecting ',' or '}'
+_FIRST_ENTRY = 'first entry'  # expecting an entry or ']'
+_ENTRY = 'entry'  # expecting an entry
+_AFTER_ENTRY = 'after entry'  # expecting ',' or ']'
+_END = 'end'  # Bundle is complete
+
+_INCOMPLETE = object()
+
+
+class ParseError(ValueError):
+    """Malformed input data.
+
+    :ivar line_number: number of the line (starting from 1), if available
+    :ivar line: raw content of the malformed line, if available
+    """
+    def __init__(self, message, line_number=None, line=None):
+        super(ParseError, self).__init__(message)
+        self.line_number = line_number
+        self.line = line
+
+
+@contextlib.contextmanager
+def open_source(source, buffer_size=DEFAULT_BUFFER_SIZE):
+    """Open source for reading in binary mode
+
+    :param source: path to a file or a file object (file objects are
+                   not closed)
+    :param buffer_size: size of the read buffer
+    :return: context manager that returns file object
+    """
+    if hasattr(source, 'read'):
+        yield source
+    else:
+        with io.open(source, 'rb', buffering=buffer_size) as fp:
+            yield fp
+
+
+def report_error(error, on_error):
+    """Raise an error or pass it to a callback
+
+    :param error: error (exception instance)
+    :param on_error: callback (`None` to raise)
+    """
+    if on_error is None:
+        raise error
+    on_error(error)
+
+
+def iter_ndjson(source, buffer_size=DEFAULT_BUFFER_SIZE, on_error=None):
+    """Read parsed JSON values from NDJSON
+
+    Lines are read one by one from a buffered stream, so memory
+    consumption does not depend on the size of the input. Empty lines
+    are ignored.
+
+    :param source: path to a file or a file object
+    :param buffer_size: size of the read buffer
+    :param on_error: callback for malformed lines, called with
+                     :class:`ParseError` (by default error is raised)
+    :return: generator object that will yield (line number, line, value)
+    """
+    with open_source(source, buffer_size) as fp:
+        for item in parse_ndjson_lines(enumerate(fp, 1), on_error):
+            yield item
+
+
+def parse_ndjson_lines(lines, on_error=None):
+    """Parse lines of NDJSON
+
+    Empty lines are ignored.
+
+    :param lines: pairs (line number, line), lines are bytes in UTF-8 or
+                  text
+    :param on_error: callback for malformed lines, called with
+                     :class:`ParseError` (by default error is raised)
+    :return: generator object that will yield (line number, line, value)
+    """
+    for line_number, line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            if isinstance(line, bytes):
+                value = json.loads(line.decode('utf-8'))
+            else:
+                value = json.loads(line)
+        except ValueError as exc:
+            report_error(
+                ParseError('Invalid JSON: {}'.format(exc), line_number,
+                           line), on_error)
+            continue
+        yield line_number, line, value
+
+
+class BundleParser(object):
+    """Incremental parser of a Bundle resource.
+
+    Data is pushed to the parser in chunks with :meth:`feed`, entries are
+    returned (as parsed JSON) as soon as they are complete, so only a
+    single entry has to be kept in memory at a time. Top-level elements of
+    the Bundle (other than `entry`) are collected into :attr:`metadata`.
+
+    :ivar metadata: top-level elements of the Bundle parsed so far
+    """
+    def __init__(self):
+        self.metadata = {}
+        self._decoder = json.JSONDecoder()
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buffer = ''
+        self._pos = 0
+        self._state = _START
+        self._key = None
+        # Size of the buffer required before the next attempt to decode an
+        # incomplete value (avoids re-parsing large entries on every chunk)
+        self._wait = 0
+
+    def feed(self, data):
+        """Push a chunk of data to the parser
+
+        :param data: chunk of data (bytes in UTF-8 or text)
+        :return: list of entries completed by this chunk
+        :raises ParseError: if data is not a valid Bundle
+        """
+        if isinstance(data, bytes):
+            data = self._text_decoder.decode(data)
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        if len(self._buffer) < self._wait:
+            return []
+        return self._parse(final=False)
+
+    def close(self):
+        """Signal end of the data
+
+        :return: list of remaining entries
+        :raises ParseError: if Bundle is incomplete
+        """
+        self._buffer = self._buffer[self._pos:] + self._text_decoder.decode(
+            b'', True)
+        self._pos = 0
+        entries = self._parse(final=True)
+        if self._state != _END:
+            raise ParseError('Unexpected end of data')
+        return entries
+
+    def _decode(self, pos, final):
+        buffer = self._buffer
+        try:
+            value, end = self._decoder.raw_decode(buffer, pos)
+        except ValueError as exc:
+            if final:
+                raise ParseError('Invalid JSON: {}'.format(exc))
+            return _INCOMPLETE, pos
+        if end == len(buffer) and not final:
+            # Numbers and literals can be cut at the end of the chunk
+            return _INCOMPLETE, pos
+        return value, end
+
+    def _expect(self, char, expected):
+        if char not in expected:
+            raise ParseError('Unexpected character {!r} (expected {})'.format(
+                char, ' or '.join(repr(e) for e in expected)))
+
+    def _parse(self, final):
+        entries = []
+        buffer = self._buffer
+        size = len(buffer)
+        self._wait = 0
+        while True:
+            pos = _WHITESPACE.match(buffer, self._pos).end()
+            self._pos = pos
+            if pos == size:
+                break
+            char = buffer[pos]
+            state = self._state
+            if state == _END:
+                raise ParseError('Unexpected data after the end of Bundle')
+            elif state == _START:
+                self._expect(char, '{')
+                self._state = _FIRST_KEY
+                self._pos = pos + 1
+            elif state == _FIRST_KEY and char == '}':
+                self._state = _END
+                self._pos = pos + 1
+            elif state == _FIRST_KEY or state == _KEY:
+                self._expect(char, '"')
+                key, end = self._decode(pos, final)
+                if key is _INCOMPLETE:
+                    break
+                self._key = key
+                self._state = _COLON
+                self._pos = end
+            elif state == _COLON:
+                self._expect(char, ':')
+                self._state = _VALUE
+                self._pos = pos + 1
+            elif state == _VALUE and self._key == 'entry':
+                self._expect(char, '[')
+                self._state = _FIRST_ENTRY
+                self._pos = pos + 1
+            elif state == _VALUE:
+                value, end = self._decode(pos, final)
+                if value is _INCOMPLETE:
+                    break
+                if self._key == 'resourceType' and value != 'Bundle':
+                    raise ParseError('Not a Bundle: {}'.format(value))
+                self.metadata[self._key] = value
+                self._state = _AFTER_VALUE
+                self._pos = end
+            elif state == _AFTER_VALUE:
+                self._expect(char, ',}')
+                self._state = _KEY if char == ',' else _END
+                self._pos = pos + 1
+            elif state == _FIRST_ENTRY and char == ']':
+                self._state = _AFTER_VALUE
+                self._pos = pos + 1
+            elif state == _FIRST_ENTRY or state == _ENTRY:
+                entry, end = self._decode(pos, final)
+                if entry is _INCOMPLETE:
+                    break
+                if not isinstance(entry, dict):
+                    raise ParseError('Bundle entry is not an object')
+                entries.append(entry)
+                self._state = _AFTER_ENTRY
+                self._pos = end
+            elif state == _AFTER_ENTRY:
+                self._expect(char, ',]')
+                self._state = _ENTRY if char == ',' else _AFTER_VALUE
+                self._pos = pos + 1
+        if self._pos < size:
+            # Incomplete value, wait until pending data doubles
+            self._wait = 2 * (size - self._pos)
+        return entries
+
+
+def iter_bundle_entries(source, buffer_size=DEFAULT_BUFFER_SIZE, parser=None):
+    """Read entries of a Bundle incrementally
+
+    :param source: path to a file or a file object
+    :param buffer_size: size of chunks read from the source
+    :param parser: :class:`BundleParser` to use (can be provided to access
+                   Bundle metadata)
+    :return: generator object that will yield entries (parsed JSON)
+    """
+    if parser is None:
+        parser = BundleParser()
+    with open_source(source, buffer_size) as fp:
+        while True:
+            data = fp.read(buffer_size)
+            if not data:
+                break
+            for entry in parser.feed(data):
+                yield entry
+        for entry in parser.close():
+            yield entry
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2019 Pavel 'Blane' Tuchin
 from __future__ import unicode_literals
+import collections
 import os
 import json
+import threading
 from six.moves.urllib.parse import urlsplit
 
 BASE_PATH = os.path.dirname(os.path.abspath(__file__))
@@ -39,8 +41,18 @@ def get_bundle_entries(bundle):
     return (e['resource'] for e in bundle['entry'])
 
 
+def official_definitions_path(input_file):
+    """Get path to a file with official definitions
+
+    :param input_file: file name (relative to the directory of official
+                       definitions) or an absolute path
+    :return: path to the file
+    """
+    return os.path.join(V4_DEF_PATH, 'official', input_file)
+
+
 def read_resource_definitions(input_file):
-    input_file = os.path.join(V4_DEF_PATH, 'official', input_file)
+    input_file = official_definitions_path(input_file)
     with open(input_file) as fp:
         return json.load(fp)
 
@@ -82,3 +94,56 @@ def strip_down_definitions():
     res_defs = filter_structure_definitions(res_defs)
     res_defs = (strip_keys(e) for e in res_defs)
     return res_defs
+
+
+def to_camel_case(name):
+    """Capitalize the first letter of a name (`dateTime` -> `DateTime`),
+    e.g. to get a variant of a choice element (`value` + `DateTime`)
+    """
+    return name[:1].capitalize() + name[1:]
+
+
+class LRUCache(object):
+    """Thread-safe mapping of limited size.
+
+    When the cache is full, least recently used entry is discarded.
+
+    :ivar maxsize: maximum number of entries
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Get value from the cache and mark it as recently used
+
+        :param key: key
+        :param default: value returned if key is not in the cache
+        :return: cached value or `default`
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""Validation of FHIR data (parsed JSON) against definitions"""
+from __future__ import unicode_literals
+import collections
+import numbers
+import threading
+
+import six
+
+from . import streaming
+from .resources import to_camel_case
+
+#: Required element is missing
+REQUIRED = 'required'
+#: Single value where an array is expected, or the other way round, or too
+#: many values
+CARDINALITY = 'cardinality'
+#: Value of a wrong type
+TYPE = 'type'
+#: More than one type of a polymorphic (choice) element
+CHOICE = 'choice'
+#: Element is not defined
+UNKNOWN = 'unknown'
+#: Malformed input (invalid JSON, missing or unknown resource type)
+INVALID = 'invalid'
+
+
+class Issue(collections.namedtuple('Issue', 'path code message')):
+    """Validation issue.
+
+    :ivar path: path to the element, with array indexes
+                (e.g. `Patient.name[0].given`)
+    :ivar code: kind of the issue (:data:`REQUIRED`, :data:`CARDINALITY`,
+                :data:`TYPE`, :data:`CHOICE`, :data:`UNKNOWN` or
+                :data:`INVALID`)
+    :ivar message: human readable description
+    """
+    __slots__ = ()
+
+
+def _is_string(value):
+    return isinstance(value, six.string_types)
+
+
+def _is_boolean(value):
+    return value is True or value is False
+
+
+def _is_integer(value):
+    return isinstance(value, six.integer_types) and not _is_boolean(value)
+
+
+def _is_decimal(value):
+    return isinstance(value, numbers.Number) and not _is_boolean(value)
+
+
+_PRIMITIVE_CHECKS = {
+    'boolean': _is_boolean,
+    'integer': _is_integer,
+    'positiveInt': _is_integer,
+    'unsignedInt': _is_integer,
+    'decimal': _is_decimal,
+}
+
+
+class Validator(object):
+    """Validator of resources and complex types.
+
+    Validation functions are compiled (once, on first use) for every
+    resource, complex type and backbone element: each of them has a table
+    of allowed elements with precomputed checks, so validation is a single
+    pass over the data.
+
+    Following is checked:
+
+    * required elements are present
+    * arrays are used for repeating elements only, number of values does
+      not exceed the maximum
+    * primitive values have a correct JSON type, complex values are
+      objects
+    * at most one type of a polymorphic element is present
+    * there are no unknown elements
+
+    :param definitions: resource and complex type definitions
+    """
+
+    def __init__(self, definitions):
+        self._definitions = definitions
+        self._validators = {}
+        self._lock = threading.RLock()
+
+    def validate(self, json):
+        """Validate a resource
+
+        :param json: parsed JSON of a resource
+        :return: list of issues (empty if resource is valid)
+        """
+        issues = []
+        self._validate_resource(json, None, issues)
+        return issues
+
+    def validate_type(self, name, json):
+        """Validate a complex type or a resource of a known type
+
+        :param name: name of a complex type or a resource
+        :param json: parsed JSON
+        :return: list of issues (empty if value is valid)
+        """
+        issues = []
+        self._validator(name)(json, name, issues)
+        return issues
+
+    def validate_many(self, iterable):
+        """Validate many resources
+
+        :param iterable: resources (parsed JSON)
+        :return: generator object that will yield pairs (index, issues)
+                 for invalid resources only
+        """
+        validate = self._validate_resource
+        for index, json in enumerate(iterable):
+            issues = []
+            validate(json, None, issues)
+            if issues:
+                yield index, issues
+
+    def validate_ndjson(self, source,
+                        buffer_size=streaming.DEFAULT_BUFFER_SIZE):
+        """Validate resources in NDJSON (e.g. FHIR Bulk Data export)
+
+        :param source: path to a file or a file object
+        :param buffer_size: size of the read buffer
+        :return: generator object that will yield pairs
+                 (line number, issues) for invalid lines only
+        """
+        errors = []
+        lines = streaming.iter_ndjson(source, buffer_size, errors.append)
+        validate = self._validate_resource
+        for line_number, _, json in lines:
+            while errors:
+                error = errors.pop(0)
+                yield error.line_number, [Issue('', INVALID, str(error))]
+            issues = []
+            validate(json, None, issues)
+            if issues:
+                yield line_number, issues
+        for error in errors:
+            yield error.line_number, [Issue('', INVALID, str(error))]
+
+    def _validate_resource(self, json, path, issues):
+        try:
+            resource_type = json['resourceType']
+        except (KeyError, TypeError):
+            issues.append(Issue(path or '', INVALID, 'Missing resourceType'))
+            return
+        if resource_type not in self._definitions.res_defs:
+            issues.append(Issue(path or '', INVALID,
+                                'Unknown resource type: {}'.format(
+                                    resource_type)))
+            return
+        self._validator(resource_type)(json, path or resource_type, issues)
+
+    def _validator(self, name):
+        """Get validation function for a class
+
+        :param name: name of a resource or a complex type, or path to a
+                     backbone element (e.g. `Patient.contact`)
+        :return: function (json, path, issues)
+        """
+        try:
+            return self._validators[name]
+        except KeyError:
+            pass
+        with self._lock:
+            if name not in self._validators:
+                checks = {}
+                required = []
+                choices = []
+                self._compile(name, checks, required, choices)
+                # Published only when complete, other threads never see a
+                # partially filled table
+                self._validators[name] = _make_validator(checks, required,
+                                                         choices)
+            return self._validators[name]
+
+    def _compile(self, name, checks, required, choices):
+        struct_name = name.split('.', 1)[0]
+        struct = self._definitions.get_def(struct_name)
+        if name == struct_name and struct_name in self._definitions.res_defs:
+            checks['resourceType'] = None
+        prefix = name + '.'
+        for path, element in six.iteritems(struct.elements):
+            if not path.startswith(prefix):
+                continue
+            field = path[len(prefix):]
+            if '.' in field:
+                continue  # Element of a nested backbone element
+            if field.endswith('[x]'):
+                field = field[:-3]
+                variants = []
+                for _type in element.types:
+                    variant = field + to_camel_case(_type.code)
+                    variants.append(variant)
+                    self._add_check(checks, variant, path, element, _type)
+                choices.append((field, tuple(variants)))
+                if element.is_required:
+                    required.append((field, tuple(variants)))
+                continue
+            _type = element.types[0] if len(element.types) == 1 else None
+            self._add_check(checks, field, path, element, _type)
+            if element.is_required:
+                required.append((field, (field,)))
+
+    def _add_check(self, checks, field, path, element, _type):
+        if _type is None:
+            # No type information (content reference), shape only
+            check = None
+        elif _type.is_resource:
+            check = self._validate_resource
+        elif _type.is_backbone:
+            check = self._lazy(path)
+        elif _type.is_complex:
+            check = self._lazy(_type.code)
+        else:
+            check = _PRIMITIVE_CHECKS.get(_type.code, _is_string)
+            checks['_' + field] = None  # Extensions of a primitive value
+            checks[field] = _make_primitive_check(element, _type.code, check)
+            return
+        checks[field] = _make_complex_check(element, check)
+
+    def _lazy(self, name):
+        # Nested validators are compiled on first use, so validating a
+        # resource does not compile all types it can reference
+        validators = self._validators
+        get = self._validator
+
+        def validate(json, path, issues):
+            try:
+                validator = validators[name]
+            except KeyError:
+                validator = get(name)
+            validator(json, path, issues)
+        return validate
+
+
+def _make_validator(checks, required, choices):
+    def validate(json, path, issues):
+        if not isinstance(json, dict):
+            issues.append(Issue(path, TYPE, 'Expected an object'))
+            return
+        for field, value in six.iteritems(json):
+            try:
+                check = checks[field]
+            except KeyError:
+                issues.append(Issue('{}.{}'.format(path, field), UNKNOWN,
+                                    'Unknown element'))
+                continue
+            if check is not None:
+                check(value, path, field, issues)
+        for field, names in required:
+            for name in names:
+                if name in json:
+                    break
+            else:
+                issues.append(Issue('{}.{}'.format(path, field), REQUIRED,
+                                    'Required element is missing'))
+        for field, names in choices:
+            present = [name for name in names if name in json]
+            if len(present) > 1:
+                issues.append(Issue(
+                    '{}.{}'.format(path, field), CHOICE,
+                    'Only one of {} is allowed'.format(', '.join(present))))
+    return validate
+
+
+def _check_cardinality(element, value, path, field, issues):
+    """Check shape of a value, get values to check
+
+    :return: list of values or `None` if value is malformed
+    """
+    if element.max == 0:
+        issues.append(Issue('{}.{}'.format(path, field), CARDINALITY,
+                            'Element is not allowed'))
+        return None
+    if element.is_array:
+        if not isinstance(value, list):
+            issues.append(Issue('{}.{}'.format(path, field), CARDINALITY,
+                                'Expected an array'))
+            return None
+        if element.max is not None and len(value) > element.max:
+            issues.append(Issue('{}.{}'.format(path, field), CARDINALITY,
+                                'Too many values (maximum {})'.format(
+                                    element.max)))
+        return value
+    if isinstance(value, list):
+        issues.append(Issue('{}.{}'.format(path, field), CARDINALITY,
+                            'Expected a single value'))
+        return None
+    return (value,)
+
+
+def _make_primitive_check(element, code, is_valid):
+    is_array = element.is_array
+    _max = element.max
+
+    def check(value, path, field, issues):
+        if is_array or _max == 0 or isinstance(value, list):
+            values = _check_cardinality(element, value, path, field, issues)
+            if values is None:
+                return
+        else:
+            values = (value,)
+        for index, value in enumerate(values):
+            # Arrays of primitives can contain nulls (paired with
+            # extensions in `_field`)
+            if not is_valid(value) and not (is_array and value is None):
+                issues.append(Issue(
+                    _item_path(path, field, index, is_array), TYPE,
+                    'Expected {}'.format(code)))
+    return check
+
+
+def _make_complex_check(element, validate):
+    is_array = element.is_array
+
+    def check(value, path, field, issues):
+        values = _check_cardinality(element, value, path, field, issues)
+        if values is None or validate is None:
+            return
+        for index, value in enumerate(values):
+            validate(value, _item_path(path, field, index, is_array), issues)
+    return check
+
+
+def _item_path(path, field, index, is_array):
+    if is_array:
+        return '{}.{}[{}]'.format(path, field, index)
+    return '{}.{}'.format(path, field)
@@ -1,5 +1,12 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2019 Pavel 'Blane' Tuchin
+"""Generate definitions from official FHIR profiles.
+
+Files are regenerated only if profiles have changed (use --force to
+regenerate anyway).
+"""
+from __future__ import print_function
+import argparse
 import os
 import sys
 
@@ -9,9 +16,37 @@ sys.path.append(os.path.join(PROJECT_PATH))
 
 
 def main():
-    from fhir_tools.generation import generate_resource_definitions_to_file, generate_type_definitions_to_file
-    generate_resource_definitions_to_file()
-    generate_type_definitions_to_file()
+    from fhir_tools import generation
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--resources', default='profiles-resources.json',
+                        help='official resource profiles')
+    parser.add_argument('--types', default='profiles-types.json',
+                        help='official type profiles')
+    parser.add_argument('--resources-output',
+                        default=generation.DEFAULT_RESOURCE_DEFS_FILE_NAME,
+                        help='generated resource definitions')
+    parser.add_argument('--types-output',
+                        default=generation.DEFAULT_TYPE_DEFS_FILE_NAME,
+                        help='generated type definitions')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes '
+                             '(default: number of CPUs)')
+    parser.add_argument('--force', action='store_true',
+                        help='regenerate even if profiles have not changed')
+    args = parser.parse_args()
+
+    jobs = [
+        (generation.generate_resource_definitions_to_file,
+         args.resources, args.resources_output),
+        (generation.generate_type_definitions_to_file,
+         args.types, args.types_output),
+    ]
+    for generate, input_file, output_file in jobs:
+        generated = generate(input_file, output_file, workers=args.workers,
+                             force=args.force)
+        print('{}: {}'.format(output_file,
+                              'generated' if generated else 'up to date'))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+from __future__ import unicode_literals
+import json
+import unittest
+
+import six
+
+from fhir_tools import readers
+from fhir_tools import resources
+from fhir_tools import streaming
+
+if six.PY3:
+    import asyncio
+    from concurrent import futures
+
+    from fhir_tools import aio
+
+
+def patient(index):
+    return {
+        'resourceType': 'Patient',
+        'id': 'patient-{}'.format(index),
+        'deceasedBoolean': False,
+        'generalPractitioner': [{
+            'reference': 'Practitioner/{}'.format(index)
+        }]
+    }
+
+
+class Chunks(object):
+    """Async iterable of chunks, counts chunks read so far"""
+    def __init__(self, loop, data, size):
+        self.loop = loop
+        self.chunks = [data[i:i + size] for i in range(0, len(data), size)]
+        self.consumed = 0
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        future = self.loop.create_future()
+        if self.consumed < len(self.chunks):
+            future.set_result(self.chunks[self.consumed])
+            self.consumed += 1
+        else:
+            future.set_exception(StopAsyncIteration())
+        return future
+
+
+@unittest.skipIf(six.PY2, 'asyncio is not available')
+class TestAsyncStreams(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.definitions = readers.defs_from_generated()
+        cls.resources = resources.Resources(cls.definitions, lazy=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.definitions = None
+        cls.resources = None
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.executor = futures.ThreadPoolExecutor(2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def collect(self, iterator, limit=None):
+        results = []
+        while limit is None or len(results) < limit:
+            try:
+                results.append(self.loop.run_until_complete(
+                    iterator.__anext__()))
+            except StopAsyncIteration:
+                break
+        return results
+
+    def reader(self, data):
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return reader
+
+    def ndjson(self, count):
+        return b'\n'.join(json.dumps(patient(i)).encode('utf-8')
+                          for i in range(count)) + b'\n'
+
+    def test_ndjson_reader(self):
+        result = self.collect(aio.iter_ndjson(
+            self.resources, self.reader(self.ndjson(250)),
+            executor=self.executor, batch_size=30, read_size=100))
+        self.assertEqual([r.id for r in result],
+                         ['patient-{}'.format(i) for i in range(250)])
+        self.assertIsInstance(result[0], self.resources.Patient)
+        self.assertEqual(result[0].generalPractitioner[0].reference,
+                         'Practitioner/0')
+
+    def test_ndjson_chunks(self):
+        # No newline at the end of the last line
+        data = self.ndjson(10).rstrip()
+        result = self.collect(aio.iter_ndjson(
+            self.resources, Chunks(self.loop, data, 7), batch_size=3))
+        self.assertEqual(len(result), 10)
+        self.assertEqual(result[-1].id, 'patient-9')
+
+    def test_ndjson_to_db(self):
+        result = self.collect(aio.iter_ndjson(
+            self.resources, self.reader(self.ndjson(3)), to_db=True,
+            executor=self.executor))
+        self.assertEqual(result[0].deceased, {'boolean': False})
+        self.assertEqual(result[0].generalPractitioner[0].id, '0')
+
+    def test_ndjson_errors(self):
+        data = b'\n'.join([
+            json.dumps(patient(0)).encode('utf-8'),
+            b'{"resourceType": ',
+            b'',
+            json.dumps({'resourceType': 'Unknown'}).encode('utf-8'),
+            json.dumps(patient(1)).encode('utf-8'),
+        ])
+        errors = []
+        result = self.collect(aio.iter_ndjson(
+            self.resources, self.reader(data), on_error=errors.append,
+            executor=self.executor, batch_size=2))
+        self.assertEqual(len(result), 2)
+        self.assertEqual([e.line_number for e in errors], [2, 4])
+
+        iterator = aio.iter_ndjson(self.resources, self.reader(data),
+                                   executor=self.executor)
+        with self.assertRaises(streaming.ParseError):
+            self.collect(iterator)
+
+    def test_backpressure(self):
+        chunks = Chunks(self.loop, self.ndjson(1000), 100)
+        iterator = aio.iter_ndjson(self.resources, chunks, batch_size=10,
+                                   max_pending=2, executor=self.executor)
+        self.collect(iterator, limit=1)
+        self.assertLess(chunks.consumed, len(chunks.chunks) // 2)
+        self.assertEqual(len(self.collect(iterator)), 999)
+        self.assertEqual(chunks.consumed, len(chunks.chunks))
+
+    def test_bundle(self):
+        bundle = {
+            'resourceType': 'Bundle',
+            'type': 'collection',
+            'entry': [{'resource': patient(i)} for i in range(50)]
+        }
+        parser = streaming.BundleParser()
+        data = json.dumps(bundle).encode('utf-8')
+        result = self.collect(aio.iter_bundle_entries(
+            self.resources, self.reader(data), executor=self.executor,
+            batch_size=7, read_size=64, parser=parser))
+        self.assertEqual([e.resource.id for e in result],
+                         ['patient-{}'.format(i) for i in range(50)])
+        self.assertIsInstance(result[0].resource, self.resources.Patient)
+        self.assertEqual(parser.metadata['type'], 'collection')
+
+    def test_bundle_malformed(self):
+        iterator = aio.iter_bundle_entries(
+            self.resources, self.reader(b'{"resourceType": "Bundle", '),
+            executor=self.executor)
+        with self.assertRaises(streaming.ParseError):
+            self.collect(iterator)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+from __future__ import unicode_literals
+import copy
+import unittest
+
+from fhir_tools import diff
+from fhir_tools import readers
+from fhir_tools import resources
+
+OBSERVATION = {
+    'resourceType': 'Observation',
+    'id': '1',
+    'meta': {'versionId': '1'},
+    'status': 'preliminary',
+    'code': {'coding': [{'system': 'http://loinc.org', 'code': '29463-7'}]},
+    'subject': {'reference': 'Patient/1'},
+    'valueQuantity': {'value': 1.5, 'unit': 'kg'},
+    'component': [{
+        'code': {'text': 'first'},
+        'valueString': 'a'
+    }, {
+        'code': {'text': 'second'},
+        'valueString': 'b'
+    }],
+    'contained': [{
+        'resourceType': 'Patient',
+        'id': 'p',
+        'name': [{'given': ['John', 'Jacob']}]
+    }],
+}
+
+
+class TestDiffer(unittest.TestCase):
+    def setUp(self):
+        self.definitions = readers.defs_from_generated()
+        self.differ = diff.Differ(self.definitions)
+
+    def tearDown(self):
+        self.definitions = None
+
+    def check(self, old, new, expected):
+        patch = self.differ.diff(old, new)
+        self.assertEqual(patch, expected)
+        self.assertEqual(diff.apply_patch(old, patch), new)
+
+    def test_equal(self):
+        self.assertEqual(self.differ.diff(OBSERVATION, OBSERVATION), [])
+        self.assertEqual(
+            self.differ.diff(OBSERVATION, copy.deepcopy(OBSERVATION)), [])
+
+    def test_fields(self):
+        new = copy.deepcopy(OBSERVATION)
+        new['status'] = 'final'
+        new['meta']['versionId'] = '2'
+        del new['subject']
+        new['issued'] = '2019-10-10T10:30:00Z'
+        patch = self.differ.diff(OBSERVATION, new)
+        self.assertEqual(sorted((op['op'], op['path']) for op in patch), [
+            ('add', '/issued'),
+            ('remove', '/subject'),
+            ('replace', '/meta/versionId'),
+            ('replace', '/status'),
+        ])
+        self.assertEqual(diff.apply_patch(OBSERVATION, patch), new)
+
+    def test_choice(self):
+        new = copy.deepcopy(OBSERVATION)
+        new['valueQuantity']['value'] = 2
+        self.check(OBSERVATION, new, [
+            {'op': 'replace', 'path': '/valueQuantity/value', 'value': 2}])
+        del new['valueQuantity']
+        new['valueString'] = 'text'
+        patch = self.differ.diff(OBSERVATION, new)
+        self.assertEqual(sorted(op['op'] for op in patch), ['add', 'remove'])
+        self.assertEqual(diff.apply_patch(OBSERVATION, patch), new)
+
+    def test_arrays(self):
+        new = copy.deepcopy(OBSERVATION)
+        new['component'][1]['valueString'] = 'c'
+        new['component'].append({'code': {'text': 'third'}})
+        self.check(OBSERVATION, new, [
+            {'op': 'replace', 'path': '/component/1/valueString',
+             'value': 'c'},
+            {'op': 'add', 'path': '/component/2',
+             'value': {'code': {'text': 'third'}}},
+        ])
+        new = copy.deepcopy(OBSERVATION)
+        new['component'] = new['component'][:1]
+        new['code']['coding'].append({'code': 'other'})
+        patch = self.differ.diff(OBSERVATION, new)
+        self.assertIn({'op': 'remove', 'path': '/component/1'}, patch)
+        self.assertIn({'op': 'add', 'path': '/code/coding/1',
+                       'value': {'code': 'other'}}, patch)
+        self.assertEqual(diff.apply_patch(OBSERVATION, patch), new)
+        # Arrays shrink from the end
+        new['component'] = []
+        patch = self.differ.diff(OBSERVATION, new)
+        self.assertEqual(
+            [op['path'] for op in patch if op['op'] == 'remove'],
+            ['/component/1', '/component/0'])
+        self.assertEqual(diff.apply_patch(OBSERVATION, patch), new)
+
+    def test_contained(self):
+        new = copy.deepcopy(OBSERVATION)
+        new['contained'][0]['name'][0]['given'][1] = 'Jack'
+        self.check(OBSERVATION, new, [
+            {'op': 'replace', 'path': '/contained/0/name/0/given/1',
+             'value': 'Jack'}])
+        new['contained'][0] = {'resourceType': 'Organization', 'id': 'p'}
+        self.check(OBSERVATION, new, [
+            {'op': 'replace', 'path': '/contained/0',
+             'value': new['contained'][0]}])
+
+    def test_shared_subtrees(self):
+        # Unchanged subtrees of a shallow copy are not compared
+        new = dict(OBSERVATION, status='final')
+        self.assertEqual(self.differ.diff(OBSERVATION, new), [
+            {'op': 'replace', 'path': '/status', 'value': 'final'}])
+
+    def test_objects(self):
+        for compact in (False, True):
+            repo = resources.Resources(self.definitions, compact=compact)
+            old = repo.from_json(copy.deepcopy(OBSERVATION))
+            new = repo.from_json(copy.deepcopy(OBSERVATION))
+            self.assertEqual(self.differ.diff(old, new), [])
+            new.status = 'final'
+            new.subject.reference = 'Patient/2'
+            patch = self.differ.diff(old, new)
+            self.assertEqual(sorted(op['path'] for op in patch),
+                             ['/status', '/subject/reference'])
+
+    def test_resource_type(self):
+        new = {'resourceType': 'Patient', 'id': '1'}
+        self.check(OBSERVATION, new, [
+            {'op': 'replace', 'path': '', 'value': new}])
+
+    def test_unknown_elements(self):
+        old = {'resourceType': 'Patient', 'birthDate': '2000',
+               '_birthDate': {'extension': [{'url': 'a'}]}}
+        new = {'resourceType': 'Patient', 'birthDate': '2000',
+               '_birthDate': {'extension': [{'url': 'b'}]}}
+        self.check(old, new, [
+            {'op': 'replace', 'path': '/_birthDate',
+             'value': new['_birthDate']}])
+
+
+class TestApplyPatch(unittest.TestCase):
+    def test_compact(self):
+        definitions = readers.defs_from_generated()
+        repo = resources.Resources(definitions, lazy=True, compact=True)
+        patient = repo.from_json({'resourceType': 'Patient', 'id': '1',
+                                  'name': [{'family': 'Doe'}]})
+        patched = diff.apply_patch(patient, [
+            {'op': 'add', 'path': '/active', 'value': True},
+            {'op': 'replace', 'path': '/name/0/family', 'value': 'Roe'},
+        ])
+        self.assertIsInstance(patched, repo.Patient)
+        self.assertEqual(patched.active, True)
+        self.assertEqual(patched.name[0].family, 'Roe')
+        self.assertEqual(patient.name[0].family, 'Doe')
+        for operation in ({'op': 'add', 'path': '/unknown', 'value': 1},
+                          {'op': 'remove', 'path': '/unknown'},
+                          {'op': 'remove', 'path': '/id/0'}):
+            with self.assertRaises(diff.PatchError):
+                diff.apply_patch(patient, [operation])
+
+    def test_operations(self):
+        document = {'a': {'b': [1, 2]}, 'c/d': 1}
+        patched = diff.apply_patch(document, [
+            {'op': 'add', 'path': '/a/b/-', 'value': 3},
+            {'op': 'add', 'path': '/a/b/0', 'value': 0},
+            {'op': 'test', 'path': '/c~1d', 'value': 1},
+            {'op': 'copy', 'from': '/a/b', 'path': '/e'},
+            {'op': 'move', 'from': '/c~1d', 'path': '/f'},
+            {'op': 'remove', 'path': '/e/1'},
+        ])
+        self.assertEqual(patched, {'a': {'b': [0, 1, 2, 3]}, 'e': [0, 2, 3],
+                                   'f': 1})
+        # Document is not modified
+        self.assertEqual(document, {'a': {'b': [1, 2]}, 'c/d': 1})
+
+    def test_test_types(self):
+        document = {'a': 1, 'b': [True, {'c': 0}], 'd': 'x'}
+        for path, value in (('/a', 1.0), ('/b', [True, {'c': 0.0}]),
+                            ('/d', 'x')):
+            diff.apply_patch(document, [
+                {'op': 'test', 'path': path, 'value': value}])
+        # Booleans are not numbers
+        for path, value in (('/a', True), ('/b', [1, {'c': 0}]),
+                            ('/b', [True, {'c': False}]), ('/a', '1'),
+                            ('/b', [True]), ('/b/1', {'c': 0, 'e': 1})):
+            with self.assertRaises(diff.PatchError):
+                diff.apply_patch(document, [
+                    {'op': 'test', 'path': path, 'value': value}])
+
+    def test_errors(self):
+        document = {'a': [1]}
+        for operation in ({'op': 'remove', 'path': '/b'},
+                          {'op': 'replace', 'path': '/a/1', 'value': 1},
+                          {'op': 'add', 'path': '/a/01', 'value': 1},
+                          {'op': 'add', 'path': 'a', 'value': 1},
+                          {'op': 'add', 'path': '/a'},
+                          {'op': 'test', 'path': '/a', 'value': [2]},
+                          {'op': 'move', 'from': '/a', 'path': '/a/0'},
+                          {'op': 'unknown', 'path': '/a'}):
+            with self.assertRaises(diff.PatchError):
+                diff.apply_patch(document, [operation])
+
+
+if __name__ == '__main__':
+    unittest.main()
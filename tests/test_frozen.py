@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+from __future__ import unicode_literals
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import six
+
+from fhir_tools import frozen
+from fhir_tools import readers
+from fhir_tools import resources
+from fhir_tools import validation
+
+
+class TestFrozenDefinitions(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.path = tempfile.mkdtemp()
+        cls.frozen_file = os.path.join(cls.path, 'definitions.frozen')
+        cls.definitions = readers.defs_from_generated()
+        frozen.freeze(cls.definitions, cls.frozen_file)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.path)
+        cls.definitions = None
+
+    def setUp(self):
+        self.frozen = frozen.FrozenDefinitions(self.frozen_file)
+
+    def tearDown(self):
+        self.frozen.close()
+        self.frozen = None
+
+    def test_same_definitions(self):
+        self.assertEqual(set(self.frozen.res_defs),
+                         set(self.definitions.res_defs))
+        self.assertEqual(set(self.frozen.type_defs),
+                         set(self.definitions.type_defs))
+        for name in list(self.definitions.res_defs) + list(
+                self.definitions.type_defs):
+            struct = self.definitions.get_def(name)
+            other = self.frozen.get_def(name)
+            self.assertTrue(other.is_struct_def)
+            self.assertEqual(other.name, name)
+            self.assertEqual(other.base, struct.base)
+            self.assertEqual(other.abstract, struct.abstract)
+            # Order of elements is preserved
+            self.assertEqual(list(other.elements), list(struct.elements))
+            for path, element in six.iteritems(struct.elements):
+                other_element = other.elements[path]
+                self.assertEqual(other_element.min, element.min)
+                self.assertEqual(other_element.max, element.max)
+                self.assertEqual(other_element.is_summary, element.is_summary)
+                self.assertEqual(other_element.is_array, element.is_array)
+                self.assertEqual([t.__dict__ for t in other_element.types],
+                                 [t.__dict__ for t in element.types])
+
+    def test_shared_elements(self):
+        patient = self.frozen.get_def('Patient')
+        self.assertIs(patient.elements['Patient.id'],
+                      self.frozen.get_def('Observation').elements[
+                          'Observation.id'])
+        self.assertIs(patient, self.frozen.res_defs['Patient'])
+
+    def test_mappings(self):
+        self.assertIn('Patient', self.frozen.res_defs)
+        self.assertNotIn('Patient', self.frozen.type_defs)
+        self.assertIn('HumanName', self.frozen.type_defs)
+        self.assertNotIn('Unknown', self.frozen.res_defs)
+        with self.assertRaises(KeyError):
+            self.frozen.get_def('Unknown')
+        elements = self.frozen.get_def('Observation').elements
+        self.assertIn('Observation.value[x]', elements)
+        # Single type variants are only resolved by `find`
+        self.assertNotIn('Observation.valueQuantity', elements)
+        self.assertEqual(len(elements), len(list(elements.items())))
+        self.assertEqual(len(elements), len(list(elements.values())))
+
+    def test_find(self):
+        for path in ('Patient', 'Patient.name.family',
+                     'Patient.contact.name.given',
+                     'Observation.valueQuantity.value',
+                     'Observation.subject'):
+            element = self.frozen.find(path)
+            expected = self.definitions.find(path)
+            self.assertEqual(element.is_struct_def, expected.is_struct_def)
+            if not element.is_struct_def:
+                self.assertEqual([t.code for t in element.types],
+                                 [t.code for t in expected.types])
+        self.assertEqual(
+            [t.code for t in self.frozen.types_from_path(
+                'Observation.valueQuantity')], ['Quantity'])
+        with self.assertRaises(KeyError):
+            self.frozen.find('Patient.unknown')
+        with self.assertRaises(ValueError):
+            self.frozen.types_from_path('Patient')
+
+    def test_resources(self):
+        repo = resources.Resources(self.frozen)
+        patient = repo.Patient.from_json({
+            'resourceType': 'Patient',
+            'id': 'example',
+            'name': [{'family': 'Doe'}],
+            'managingOrganization': {'reference': 'Organization/1'}
+        })
+        self.assertIsInstance(patient.name[0], repo.HumanName)
+        references = list(patient.iter_references())
+        self.assertEqual(len(references), 1)
+        self.assertEqual(references[0][0], 'managingOrganization')
+        validator = validation.Validator(self.frozen)
+        self.assertEqual(validator.validate({'resourceType': 'Patient'}), [])
+
+    def test_pickle(self):
+        other = pickle.loads(pickle.dumps(self.frozen))
+        self.assertEqual(other.find('Patient.name').max, None)
+        other.close()
+
+    def test_invalid_file(self):
+        invalid_file = os.path.join(self.path, 'invalid')
+        with open(invalid_file, 'wb') as fp:
+            fp.write(b'garbage' * 100)
+        with self.assertRaises(ValueError):
+            frozen.FrozenDefinitions(invalid_file)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+from __future__ import unicode_literals
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from fhir_tools import generation
+
+
+def structure_definition(name, base='DomainResource', status='active',
+                         kind='resource'):
+    return {
+        'resourceType': 'StructureDefinition',
+        'name': name,
+        'status': status,
+        'kind': kind,
+        'abstract': False,
+        'baseDefinition':
+            'http://hl7.org/fhir/StructureDefinition/{}'.format(base),
+        'snapshot': {
+            'element': [
+                {'path': name},
+                {'path': name + '.id', 'min': 0, 'max': '1',
+                 'type': [{'code': 'string'}]},
+                {'path': name + '.subject', 'min': 1, 'max': '1',
+                 'isSummary': True,
+                 'type': [{
+                     'code': 'Reference',
+                     'targetProfile': [
+                         'http://hl7.org/fhir/StructureDefinition/Patient'
+                     ]
+                 }]},
+            ]
+        }
+    }
+
+
+PROFILES = {
+    'resourceType': 'Bundle',
+    'id': 'resources',
+    'type': 'collection',
+    'entry': [
+        {'resource': structure_definition('Resource{}'.format(i))}
+        for i in range(20)
+    ] + [
+        {'resource': structure_definition('Retired', status='retired')},
+        {'resource': {'resourceType': 'SearchParameter', 'id': 'example'}},
+        {'resource': structure_definition('string', base='Element',
+                                          kind='primitive-type')},
+    ]
+}
+
+
+class TestGeneration(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.input_file = os.path.join(self.directory, 'profiles.json')
+        self.output_file = os.path.join(self.directory, 'generated.json')
+        with io.open(self.input_file, 'w', encoding='utf-8') as fp:
+            fp.write(json.dumps(PROFILES, indent=2))
+        definitions = [e['resource'] for e in PROFILES['entry']
+                       if e['resource']['resourceType'] ==
+                       'StructureDefinition']
+        self.expected = generation.transform_definitions(definitions)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_transform(self):
+        self.assertEqual(len(self.expected), 21)
+        self.assertNotIn('Retired', self.expected)
+        definition = self.expected['Resource0']
+        self.assertEqual(definition['base'], 'DomainResource')
+        self.assertEqual(definition['elements']['Resource0.subject'], {
+            'min': 1,
+            'max': '1',
+            'types': [{'code': 'Reference', 'targets': ['Patient']}],
+            'isSummary': True
+        })
+
+    def test_streaming(self):
+        result = generation.generate_resource_definitions(self.input_file)
+        self.assertEqual(result, self.expected)
+
+    def test_types(self):
+        result = generation.generate_type_definitions(self.input_file)
+        self.assertNotIn('string', result)
+        self.assertEqual(len(result), 20)
+
+    def test_parallel(self):
+        result = generation.generate_resource_definitions(self.input_file,
+                                                          workers=2)
+        self.assertEqual(result, self.expected)
+        self.assertEqual(list(result), list(self.expected))
+
+    def test_parallel_windows(self):
+        chunk_size = generation.CHUNK_SIZE
+        generation.CHUNK_SIZE = 1
+        try:
+            result = generation.generate_resource_definitions(
+                self.input_file, workers=2)
+        finally:
+            generation.CHUNK_SIZE = chunk_size
+        self.assertEqual(list(result), list(self.expected))
+
+    def test_to_file(self):
+        self.assertTrue(generation.generate_resource_definitions_to_file(
+            self.input_file, self.output_file))
+        with open(self.output_file) as fp:
+            self.assertEqual(json.load(fp), self.expected)
+
+    def test_skip_unchanged(self):
+        generate = generation.generate_resource_definitions_to_file
+        self.assertTrue(generate(self.input_file, self.output_file))
+        self.assertFalse(generate(self.input_file, self.output_file))
+        self.assertTrue(generate(self.input_file, self.output_file,
+                                 force=True))
+
+        with io.open(self.input_file, 'a', encoding='utf-8') as fp:
+            fp.write('\n')
+        self.assertTrue(generate(self.input_file, self.output_file))
+        self.assertFalse(generate(self.input_file, self.output_file))
+
+        os.remove(self.output_file)
+        self.assertTrue(generate(self.input_file, self.output_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+from __future__ import unicode_literals
+import unittest
+
+import six
+
+from fhir_tools import instrumentation
+from fhir_tools import readers
+from fhir_tools import resources
+
+PATIENT = {
+    'resourceType': 'Patient',
+    'id': 'example',
+    'deceasedBoolean': False,
+    'generalPractitioner': [{
+        'reference': 'Practitioner/1'
+    }],
+    'contained': [{
+        'resourceType': 'Organization',
+        'id': 'org'
+    }]
+}
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        self.definitions = readers.defs_from_generated()
+        self.resources = resources.Resources(self.definitions, lazy=True)
+        self.collector = instrumentation.Instrumentation()
+
+    def tearDown(self):
+        self.definitions = None
+        self.resources = None
+
+    def test_disabled(self):
+        self.resources.Patient  # Class created before instrumentation
+        self.assertIsNone(self.resources.instrumentation)
+        self.assertNotIn('from_json', self.resources.Patient.__dict__)
+        self.resources.instrument(self.collector)
+        self.assertIs(self.resources.instrumentation, self.collector)
+        self.assertIn('from_json', self.resources.Patient.__dict__)
+        self.resources.instrument(None)
+        self.assertNotIn('from_json', self.resources.Patient.__dict__)
+        self.resources.from_json(PATIENT)
+        self.assertEqual(self.collector.stats(), {})
+
+    def test_operations(self):
+        self.resources.instrument(self.collector)
+        patient = self.resources.from_json(PATIENT)
+        patient.to_db_format()
+        patient.to_fhir_format()
+        patient.replace_refs('Practitioner/1', 'Practitioner/2')
+        self.resources.Observation.from_db_json({
+            'resourceType': 'Observation',
+            'status': 'final'
+        })
+        stats = self.collector.stats()
+        self.assertEqual(sorted(stats), [
+            ('from_db_json', 'Observation'),
+            ('from_json', 'Patient'),
+            ('replace_refs', 'Patient'),
+            ('to_db_format', 'Patient'),
+            ('to_fhir_format', 'Patient'),
+        ])
+        for value in six.itervalues(stats):
+            self.assertEqual(value.calls, 1)
+            self.assertEqual(value.errors, 0)
+            self.assertGreater(value.time, 0)
+            self.assertIsNone(value.blocks)
+        # Instrumented methods still work
+        self.assertEqual(patient.generalPractitioner[0].reference,
+                         'Practitioner/2')
+        self.assertEqual(patient.deceasedBoolean, False)
+
+    def test_nested(self):
+        # Contained resources are part of the outer operation
+        self.resources.instrument(self.collector)
+        patient = self.resources.from_json(PATIENT)
+        patient.to_db_format()
+        self.assertNotIn(('to_db_format', 'Organization'),
+                         self.collector.stats())
+        self.assertEqual(
+            self.collector.totals()['to_db_format'].calls, 1)
+
+    def test_errors(self):
+        self.resources.instrument(self.collector)
+        with self.assertRaises(AttributeError):
+            self.resources.Patient.from_json(None)
+        stats = self.collector.stats()[('from_json', 'Patient')]
+        self.assertEqual((stats.calls, stats.errors), (1, 1))
+        # Operations are recorded after an error
+        self.resources.from_json(PATIENT)
+        stats = self.collector.stats()[('from_json', 'Patient')]
+        self.assertEqual((stats.calls, stats.errors), (2, 1))
+
+    def test_hooks(self):
+        calls = []
+
+        def hook(*args):
+            calls.append(args)
+
+        self.collector.add_hook(hook)
+        self.resources.instrument(self.collector)
+        self.resources.from_json(PATIENT)
+        self.assertEqual(len(calls), 1)
+        operation, resource_type, duration, blocks, error = calls[0]
+        self.assertEqual((operation, resource_type), ('from_json', 'Patient'))
+        self.assertIsNone(blocks)
+        self.assertIsNone(error)
+        self.collector.remove_hook(hook)
+        self.resources.from_json(PATIENT)
+        self.assertEqual(len(calls), 1)
+
+    def test_failing_hook(self):
+        def hook(*args):
+            raise RuntimeError('hook')
+
+        self.collector.add_hook(hook)
+        self.resources.instrument(self.collector)
+        patient = self.resources.from_json(PATIENT)
+        self.assertEqual(patient.id, 'example')
+        # Exception of the operation is not replaced
+        with self.assertRaises(AttributeError):
+            self.resources.Patient.from_json(None)
+        stats = self.collector.stats()[('from_json', 'Patient')]
+        self.assertEqual((stats.calls, stats.errors), (2, 1))
+
+    @unittest.skipIf(six.PY2, 'Allocations can not be tracked')
+    def test_allocations(self):
+        collector = instrumentation.Instrumentation(allocations=True)
+        self.resources.instrument(collector)
+        self.resources.from_json(PATIENT)
+        stats = collector.stats()[('from_json', 'Patient')]
+        self.assertIsNotNone(stats.blocks)
+
+    def test_reset(self):
+        self.resources.instrument(self.collector)
+        self.resources.from_json(PATIENT)
+        self.collector.reset()
+        self.assertEqual(self.collector.stats(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+from __future__ import unicode_literals
+import unittest
+
+from fhir_tools import parallel
+from fhir_tools import readers
+from fhir_tools import resources
+
+
+def patient(index):
+    return {
+        'resourceType': 'Patient',
+        'id': 'patient-{}'.format(index),
+        'deceasedBoolean': False,
+        'generalPractitioner': [{
+            'reference': 'Practitioner/{}'.format(index),
+            'display': 'Dr. Smith'
+        }]
+    }
+
+
+def db_patient(index):
+    return {
+        'resourceType': 'Patient',
+        'id': 'patient-{}'.format(index),
+        'deceased': {
+            'boolean': False
+        },
+        'generalPractitioner': [{
+            'resourceType': 'Practitioner',
+            'id': '{}'.format(index),
+            'display': 'Dr. Smith'
+        }]
+    }
+
+
+class TestConvertMany(unittest.TestCase):
+    def setUp(self):
+        self.definitions = readers.defs_from_generated()
+        self.resources = resources.Resources(self.definitions, lazy=True)
+
+    def tearDown(self):
+        self.definitions = None
+        self.resources = None
+
+    def test_to_db(self):
+        for workers in (1, 2):
+            result = list(self.resources.convert_many(
+                (patient(i) for i in range(50)), parallel.TO_DB,
+                workers=workers, chunk_size=7, max_pending=2))
+            self.assertEqual(result, [db_patient(i) for i in range(50)])
+            self.assertIs(type(result[0]), dict)
+
+    def test_to_fhir(self):
+        for workers in (1, 2):
+            result = list(self.resources.convert_many(
+                [db_patient(i) for i in range(50)], parallel.TO_FHIR,
+                workers=workers, chunk_size=5))
+            self.assertEqual(result, [patient(i) for i in range(50)])
+
+    def test_fhir_objects(self):
+        objects = [self.resources.from_json(patient(i)) for i in range(3)]
+        result = list(self.resources.convert_many(objects, parallel.TO_DB,
+                                                  workers=2))
+        self.assertEqual(result, [db_patient(i) for i in range(3)])
+
+    def test_close(self):
+        result = self.resources.convert_many(
+            (patient(i) for i in range(1000)), parallel.TO_DB, workers=2,
+            chunk_size=10)
+        self.assertEqual(next(result), db_patient(0))
+        result.close()
+
+    def test_invalid_direction(self):
+        self.assertRaises(ValueError, self.resources.convert_many, [],
+                          'unknown')
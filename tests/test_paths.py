@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+from __future__ import unicode_literals
+import datetime
+import io
+import json
+import unittest
+
+from fhir_tools import paths
+from fhir_tools import readers
+from fhir_tools import resources
+
+OBSERVATIONS = [{
+    'resourceType': 'Observation',
+    'id': '1',
+    'status': 'final',
+    'subject': {'reference': 'Patient/1'},
+    'effectiveDateTime': '2019-05-01T10:30:00+02:00',
+    'valueQuantity': {'value': 1.5, 'unit': 'kg'},
+    'performer': [{'reference': 'Practitioner/1'},
+                  {'reference': 'Practitioner/2'}],
+}, {
+    'resourceType': 'Patient',
+    'id': 'skipped',
+}, {
+    'resourceType': 'Observation',
+    'id': '2',
+    'status': 'final',
+    'effectiveDateTime': '2019-06',
+    'valueQuantity': {'value': 2},
+}, {
+    'resourceType': 'Observation',
+    'id': '3',
+    'status': 'final',
+    'valueQuantity': {'value': 'invalid'},
+}]
+
+PATHS = [
+    'Observation.valueQuantity.value',
+    'Observation.effectiveDateTime',
+    'Observation.subject.reference',
+    'Observation.performer.reference',
+]
+
+
+class TestColumnExtractor(unittest.TestCase):
+    def setUp(self):
+        self.definitions = readers.defs_from_generated()
+        self.extractor = paths.ColumnExtractor(self.definitions, PATHS)
+
+    def tearDown(self):
+        self.definitions = None
+
+    def test_lists(self):
+        columns = self.extractor.extract_lists(OBSERVATIONS)
+        self.assertEqual(sorted(columns), sorted(PATHS))
+        self.assertEqual(columns['Observation.valueQuantity.value'],
+                         [1.5, 2.0, None])
+        self.assertEqual(columns['Observation.effectiveDateTime'], [
+            datetime.datetime(2019, 5, 1, 8, 30),
+            datetime.datetime(2019, 6, 1),
+            None
+        ])
+        self.assertEqual(columns['Observation.subject.reference'],
+                         ['Patient/1', None, None])
+        # First value of an array
+        self.assertEqual(columns['Observation.performer.reference'],
+                         ['Practitioner/1', None, None])
+
+    def test_objects(self):
+        repo = resources.Resources(self.definitions, lazy=True)
+        objects = [repo.from_json(r) for r in OBSERVATIONS]
+        self.assertEqual(self.extractor.extract_lists(objects),
+                         self.extractor.extract_lists(OBSERVATIONS))
+
+    def test_invalid_paths(self):
+        with self.assertRaises(KeyError):
+            paths.ColumnExtractor(self.definitions,
+                                  ['Observation.unknown'])
+        with self.assertRaises(ValueError):
+            # Choice element without a type
+            paths.ColumnExtractor(self.definitions,
+                                  ['Observation.value[x]'])
+        with self.assertRaises(ValueError):
+            # Complex element
+            paths.ColumnExtractor(self.definitions, ['Observation.subject'])
+        with self.assertRaises(ValueError):
+            paths.ColumnExtractor(self.definitions,
+                                  ['Observation.status', 'Patient.id'])
+        with self.assertRaises(ValueError):
+            paths.ColumnExtractor(self.definitions, ['HumanName.family'])
+
+    def test_parse_datetime(self):
+        self.assertEqual(paths.parse_datetime('2019'),
+                         datetime.datetime(2019, 1, 1))
+        self.assertEqual(paths.parse_datetime('2019-10-10T10:30:00.5Z'),
+                         datetime.datetime(2019, 10, 10, 10, 30, 0, 500000))
+        self.assertEqual(paths.parse_datetime('2019-12-31T23:30:00-01:00'),
+                         datetime.datetime(2020, 1, 1, 0, 30))
+        self.assertIsNone(paths.parse_datetime('2019-13-01'))
+        self.assertIsNone(paths.parse_datetime('yesterday'))
+
+    @unittest.skipIf(paths.numpy is None, 'NumPy is not installed')
+    def test_numpy(self):
+        columns = self.extractor.extract(OBSERVATIONS)
+        values, mask = columns['Observation.valueQuantity.value']
+        self.assertEqual(values.dtype, paths.numpy.dtype('float64'))
+        self.assertEqual(mask.tolist(), [False, False, True])
+        self.assertEqual(values[:2].tolist(), [1.5, 2.0])
+        values, mask = columns['Observation.effectiveDateTime']
+        self.assertEqual(values.dtype.kind, 'M')
+        self.assertEqual(mask.tolist(), [False, False, True])
+        values, mask = columns['Observation.subject.reference']
+        self.assertEqual(values.tolist(), ['Patient/1', None, None])
+
+    @unittest.skipIf(paths.numpy is None, 'NumPy is not installed')
+    def test_numpy_large_integers(self):
+        extractor = paths.ColumnExtractor(self.definitions, [
+            'Observation.valueInteger',
+            'Observation.component.valueInteger',
+            'Observation.valueQuantity.value',
+        ])
+        observations = [{
+            'resourceType': 'Observation',
+            'valueInteger': 2 ** 70,
+            'component': [{'valueInteger': 1}],
+            'valueQuantity': {'value': 10 ** 400},
+        }, {
+            'resourceType': 'Observation',
+        }]
+        columns = extractor.extract(observations)
+        values, mask = columns['Observation.valueInteger']
+        self.assertEqual(values.dtype, paths.numpy.dtype('object'))
+        self.assertEqual(values.tolist(), [2 ** 70, None])
+        self.assertEqual(mask.tolist(), [False, True])
+        values, mask = columns['Observation.component.valueInteger']
+        self.assertEqual(values.dtype, paths.numpy.dtype('int64'))
+        self.assertEqual(values[:1].tolist(), [1])
+        self.assertEqual(mask.tolist(), [False, True])
+        values, _ = columns['Observation.valueQuantity.value']
+        self.assertEqual(values[0], float('inf'))
+
+    @unittest.skipIf(paths.numpy is None, 'NumPy is not installed')
+    def test_ndjson(self):
+        source = io.BytesIO('\n'.join(
+            json.dumps(r) for r in OBSERVATIONS).encode('utf-8'))
+        columns = self.extractor.extract_ndjson(source)
+        values, mask = columns['Observation.subject.reference']
+        self.assertEqual(mask.tolist(), [False, True, True])
+
+    @unittest.skipIf(paths.numpy is not None, 'NumPy is installed')
+    def test_no_numpy(self):
+        with self.assertRaises(ImportError):
+            self.extractor.extract(OBSERVATIONS)
+
+
+PATIENT = {
+    'resourceType': 'Patient',
+    'id': 'example',
+    'identifier': [{
+        'system': 'urn:oid:1',
+        'value': '12345'
+    }, {
+        'use': 'official',
+        'system': 'urn:oid:2',
+        'value': '67890'
+    }],
+    'name': [{
+        'given': ['John', 'Jacob']
+    }, {
+        'given': ['Johnny']
+    }]
+}
+
+
+class TestPathEngine(unittest.TestCase):
+    def setUp(self):
+        self.definitions = readers.defs_from_generated()
+        self.engine = paths.PathEngine(self.definitions)
+
+    def tearDown(self):
+        self.definitions = None
+
+    def test_paths(self):
+        evaluate = self.engine.evaluate
+        self.assertEqual(evaluate('Patient.id', PATIENT), ['example'])
+        self.assertEqual(evaluate('Patient.name.given', PATIENT),
+                         ['John', 'Jacob', 'Johnny'])
+        self.assertEqual(evaluate('Patient.name.given.first()', PATIENT),
+                         ['John'])
+        self.assertEqual(evaluate('Patient.gender', PATIENT), [])
+        # Resources of other types
+        self.assertEqual(evaluate('Patient.id', OBSERVATIONS[0]), [])
+
+    def test_where(self):
+        evaluate = self.engine.evaluate
+        self.assertEqual(evaluate(
+            "Patient.identifier.where(system='urn:oid:2').value", PATIENT),
+            ['67890'])
+        self.assertEqual(evaluate(
+            "Patient.identifier.where(system != 'urn:oid:2').value",
+            PATIENT), ['12345'])
+        self.assertEqual(evaluate(
+            "Patient.identifier.where(system='urn:oid:2' and "
+            "use='official').value", PATIENT), ['67890'])
+        self.assertEqual(evaluate(
+            "Patient.identifier.where(use='usual').value", PATIENT), [])
+        self.assertEqual(evaluate(
+            "Observation.performer.where(reference='Practitioner/2')"
+            ".reference", OBSERVATIONS[0]), ['Practitioner/2'])
+
+    def test_choice(self):
+        evaluate = self.engine.evaluate
+        observation = OBSERVATIONS[0]
+        self.assertEqual(evaluate('Observation.value', observation),
+                         [{'value': 1.5, 'unit': 'kg'}])
+        self.assertEqual(evaluate('Observation.value.ofType(Quantity).value',
+                                  observation), [1.5])
+        self.assertEqual(evaluate('Observation.valueQuantity.unit',
+                                  observation), ['kg'])
+        self.assertEqual(evaluate('Observation.value.ofType(string)',
+                                  observation), [])
+
+    def test_objects(self):
+        repo = resources.Resources(self.definitions, lazy=True)
+        patient = repo.from_json(PATIENT)
+        compiled = self.engine.compile(
+            "Patient.identifier.where(system='urn:oid:1').value")
+        self.assertEqual(compiled(patient), ['12345'])
+        self.assertEqual(
+            list(compiled.evaluate_many([PATIENT, OBSERVATIONS[0], patient])),
+            [['12345'], [], ['12345']])
+
+    def test_cache(self):
+        compiled = self.engine.compile('Patient.name.given')
+        self.assertIs(self.engine.compile('Patient.name.given'), compiled)
+        self.assertEqual(compiled.root, 'Patient')
+
+    def test_errors(self):
+        for expression in ('Unknown.id', 'Patient.unknown', 'Patient..id',
+                           'Patient.identifier.where(unknown=1)',
+                           "Patient.identifier.where(system=)",
+                           'Observation.value.value',
+                           'Observation.value.ofType(Unknown)',
+                           'Patient.name.ofType(HumanName)',
+                           'Patient.name.unknown()', 'Patient.id $'):
+            with self.assertRaises(paths.ExpressionError):
+                self.engine.compile(expression)
+
+
+if __name__ == '__main__':
+    unittest.main()
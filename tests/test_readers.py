@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+from __future__ import unicode_literals
+import os
+import shutil
+import tempfile
+import unittest
+
+from fhir_tools import readers
+
+
+class TestDefinitionsCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.resources_file = os.path.join(self.path, 'resources.json')
+        self.types_file = os.path.join(self.path, 'types.json')
+        shutil.copy(readers.RES_DEFS, self.resources_file)
+        shutil.copy(readers.TYPE_DEFS, self.types_file)
+        self.cache_file = readers.cache_path(self.resources_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def load(self, **kwargs):
+        return readers.defs_from_generated(self.resources_file,
+                                           self.types_file, **kwargs)
+
+    def assertSameDefinitions(self, first, second):
+        self.assertEqual(set(first.res_defs), set(second.res_defs))
+        self.assertEqual(set(first.type_defs), set(second.type_defs))
+        for name in ('Patient', 'Observation', 'HumanName', 'Reference'):
+            struct = first.get_def(name)
+            other = second.get_def(name)
+            self.assertEqual(struct.base, other.base)
+            self.assertEqual(struct.abstract, other.abstract)
+            self.assertEqual(set(struct.elements), set(other.elements))
+            for path, element in struct.elements.items():
+                other_element = other.elements[path]
+                self.assertEqual(element.min, other_element.min)
+                self.assertEqual(element.max, other_element.max)
+                self.assertEqual(element.is_array, other_element.is_array)
+                self.assertEqual([t.code for t in element.types],
+                                 [t.code for t in other_element.types])
+                self.assertEqual([t.to for t in element.types],
+                                 [t.to for t in other_element.types])
+
+    def test_cache_created(self):
+        self.assertFalse(os.path.exists(self.cache_file))
+        definitions = self.load()
+        self.assertTrue(os.path.exists(self.cache_file))
+        self.assertSameDefinitions(definitions, self.load(use_cache=False))
+
+    def test_cache_used(self):
+        self.load()
+        definitions = self.load()
+        self.assertSameDefinitions(definitions, self.load(use_cache=False))
+        element = definitions.get_def('Observation').elements[
+            'Observation.subject']
+        self.assertTrue(element.type.is_reference)
+        self.assertIn('Patient', element.type.to)
+
+    def test_no_cache(self):
+        self.load(use_cache=False)
+        self.assertFalse(os.path.exists(self.cache_file))
+
+    def test_stale_cache(self):
+        self.load()
+        with open(self.cache_file, 'rb') as fp:
+            cached = fp.read()
+        with open(self.types_file) as fp:
+            content = fp.read()
+        with open(self.types_file, 'w') as fp:
+            fp.write(content.replace('"HumanName"', '"PersonName"'))
+        definitions = self.load()
+        self.assertIn('PersonName', definitions.type_defs)
+        self.assertNotIn('HumanName', definitions.type_defs)
+        # Existing cache is replaced
+        with open(self.cache_file, 'rb') as fp:
+            self.assertNotEqual(fp.read(), cached)
+
+    def test_corrupted_cache(self):
+        with open(self.cache_file, 'wb') as fp:
+            fp.write(b'garbage')
+        definitions = self.load()
+        self.assertIn('Patient', definitions.res_defs)
+        self.assertSameDefinitions(definitions, self.load())
+
+
+class TestDefinitionsSharing(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.definitions = readers.defs_from_generated(use_cache=False)
+
+    def test_types_shared(self):
+        patient = self.definitions.get_def('Patient')
+        practitioner = self.definitions.get_def('Practitioner')
+        self.assertIs(patient.elements['Patient.active'].type,
+                      practitioner.elements['Practitioner.active'].type)
+        self.assertIs(patient.elements['Patient.name'],
+                      self.definitions.get_def('Person').elements[
+                          'Person.name'])
+
+    def test_single_type_cached(self):
+        element = self.definitions.get_def('Observation').elements[
+            'Observation.value[x]']
+        _type = element.types[0]
+        single = element.to_single_type(_type)
+        self.assertIs(single, element.to_single_type(_type))
+        self.assertEqual(single.types, [_type])
+
+    def test_memory_report(self):
+        report = self.definitions.memory_report()
+        self.assertEqual(report['structs'], len(self.definitions.res_defs) +
+                         len(self.definitions.type_defs))
+        self.assertLess(report['unique_elements'], report['elements'])
+        self.assertGreater(report['size'], 0)
+
+
+class TestFind(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.definitions = readers.defs_from_generated()
+
+    def codes(self, path):
+        return [t.code for t in self.definitions.types_from_path(path)]
+
+    def test_struct(self):
+        self.assertIs(self.definitions.find('Patient'),
+                      self.definitions.get_def('Patient'))
+        self.assertIs(self.definitions.find('HumanName'),
+                      self.definitions.get_def('HumanName'))
+
+    def test_element(self):
+        self.assertIs(self.definitions.find('Patient.name'),
+                      self.definitions.get_def('Patient').elements[
+                          'Patient.name'])
+        self.assertEqual(self.codes('Patient.contact.gender'), ['code'])
+
+    def test_complex_type(self):
+        self.assertEqual(self.codes('Patient.name.family'), ['string'])
+        self.assertEqual(self.codes('Patient.contact.name.given'), ['string'])
+        self.assertEqual(self.codes('Patient.name.period.start'),
+                         ['dateTime'])
+
+    def test_polymorphic(self):
+        self.assertEqual(len(self.codes('Observation.value[x]')), 11)
+        self.assertEqual(self.codes('Observation.valueQuantity'),
+                         ['Quantity'])
+        self.assertEqual(self.codes('Observation.valueQuantity.value'),
+                         ['decimal'])
+        self.assertEqual(self.codes('Observation.component.valueString'),
+                         ['string'])
+
+    def test_not_found(self):
+        for path in ('Unknown', 'Patient.unknown', 'Patient.active.value',
+                     'Observation.value.value', 'Observation.valueFoo'):
+            with self.assertRaises(KeyError):
+                self.definitions.find(path)
+
+    def test_cache_size(self):
+        index = readers.PathIndex(self.definitions, cache_size=2)
+        for path in ('Patient.name', 'Patient.name.family',
+                     'Patient.name.given'):
+            index.find(path)
+        self.assertEqual(len(index._cache), 2)
+        self.assertEqual(index.find('Patient.name.family').type.code,
+                         'string')
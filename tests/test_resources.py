@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2019 Pavel 'Blane' Tuchin
 from __future__ import unicode_literals
+import json
+import threading
 import unittest
 
 from fhir_tools import readers
@@ -273,3 +275,541 @@ class TestResources(unittest.TestCase):
         self.assertEqual(extension_key.value, 'test')
         self.assertEqual(extension_value.url, 'value')
         self.assertEqual(extension_value.value, 'testValue')
+
+    def test_compiled_decoder(self):
+        patient_class = self.resources.Patient
+        self.assertIsNone(patient_class._fhir_json_decoder)
+        patient = patient_class.from_json({
+            'id': 'example',
+            'active': None,
+            'name': [],
+            'unknown': 'value',
+            'contact': [{
+                'name': {
+                    'family': 'Doe'
+                }
+            }]
+        })
+        decoder = patient_class._fhir_json_decoder
+        self.assertIsNotNone(decoder)
+        self.assertIsNotNone(patient_class.Contact._fhir_json_decoder)
+        self.assertIsNone(patient_class._fhir_db_json_decoder)
+        self.assertEqual(dict(patient), {
+            'id': 'example',
+            'contact': [{
+                'name': {
+                    'family': 'Doe'
+                }
+            }],
+            'resourceType': 'Patient'
+        })
+        self.assertIsInstance(patient.contact[0].name,
+                              self.resources.HumanName)
+        patient_class.from_json({'id': 'other'})
+        self.assertIs(patient_class._fhir_json_decoder, decoder)
+
+    def test_content_reference(self):
+        questionnaire = self.resources.Questionnaire.from_json({
+            'item': [{
+                'linkId': '1',
+                'item': [{
+                    'linkId': '1.1'
+                }]
+            }]
+        })
+        self.assertEqual(questionnaire.item[0].item, [{'linkId': '1.1'}])
+
+    def test_traversal_plan(self):
+        self.assertEqual(self.resources.HumanName._fhir_plan, {
+            'extension': ('nested', True),
+            'period': ('nested', False),
+        })
+        plan = self.resources.Patient._fhir_plan
+        self.assertEqual(plan['generalPractitioner'], ('reference', True))
+        self.assertEqual(plan['contact'], ('nested', True))
+        self.assertEqual(plan['contained'], ('resource', True))
+        self.assertNotIn('birthDate', plan)
+        self.assertNotIn(
+            'item', self.resources.Questionnaire.Item._fhir_plan)
+
+    def test_to_db_format_content_reference(self):
+        questionnaire = self.resources.Questionnaire.from_json({
+            'item': [{
+                'linkId': '1',
+                'item': [{
+                    'linkId': '1.1'
+                }]
+            }]
+        })
+        questionnaire.to_db_format()
+        self.assertEqual(questionnaire.item[0].item, [{'linkId': '1.1'}])
+
+    def test_replace_refs(self):
+        patient = self.resources.Patient.from_json({
+            'generalPractitioner': [{'reference': 'Practitioner/1'},
+                                    {'reference': 'Practitioner/2'}],
+            'contact': [{'organization': {'reference': 'Organization/1'}}],
+            'resourceType': 'Patient'
+        })
+        patient.replace_refs('Practitioner/2', 'Practitioner/3')
+        self.assertEqual(
+            [r.reference for r in patient.generalPractitioner],
+            ['Practitioner/1', 'Practitioner/3'])
+
+    def test_replace_refs_many(self):
+        patient = self.resources.Patient.from_json({
+            'generalPractitioner': [{'reference': 'Practitioner/1'},
+                                    {'reference': 'Practitioner/2'}],
+            'contact': [{'organization': {'reference': 'Organization/1'}}],
+            'contained': [{
+                'resourceType': 'Organization',
+                'partOf': {'reference': 'Organization/1'}
+            }],
+            'resourceType': 'Patient'
+        })
+        replaced = patient.replace_refs_many({
+            'Practitioner/1': 'Practitioner/10',
+            'Organization/1': 'Organization/20',
+            'Encounter/1': 'Encounter/30',
+        })
+        self.assertEqual(replaced, 3)
+        self.assertEqual(
+            [r.reference for r in patient.generalPractitioner],
+            ['Practitioner/10', 'Practitioner/2'])
+        self.assertEqual(patient.contact[0].organization.reference,
+                         'Organization/20')
+        self.assertEqual(patient.contained[0].partOf.reference,
+                         'Organization/20')
+
+    def test_replace_refs_many_callable(self):
+        observation = self.resources.Observation.from_json({
+            'subject': {'reference': 'urn:uuid:1'},
+            'performer': [{'reference': 'Practitioner/1'}],
+            'resourceType': 'Observation'
+        })
+        replaced = observation.replace_refs_many(
+            lambda ref: 'Patient/1' if ref.startswith('urn:uuid:') else None)
+        self.assertEqual(replaced, 1)
+        self.assertEqual(observation.subject.reference, 'Patient/1')
+        self.assertEqual(observation.performer[0].reference,
+                         'Practitioner/1')
+
+    def test_iter_references(self):
+        patient = self.resources.Patient.from_json({
+            'generalPractitioner': [{'reference': 'Practitioner/1'}],
+            'contact': [{'organization': {'reference': 'Organization/1'}}],
+            'name': [{'family': 'Doe'}],
+            'resourceType': 'Patient'
+        })
+        self.assertEqual(
+            sorted((p, r.reference) for p, r in patient.iter_references()),
+            [('contact.organization', 'Organization/1'),
+             ('generalPractitioner', 'Practitioner/1')])
+
+    def test_extract_references(self):
+        observation = self.resources.Observation.from_json({
+            'id': 'o1',
+            'subject': {'reference': 'http://example.org/fhir/Patient/1'},
+            'performer': [{'reference': 'Practitioner/2/_history/3'}],
+            'encounter': {'reference': '#e1'},
+            'basedOn': [{'identifier': {'value': '1'}}],
+            'resourceType': 'Observation'
+        })
+        edges = self.resources.extract_references([observation, {
+            'resourceType': 'Patient',
+            'id': 'p1',
+            'managingOrganization': {'reference': 'urn:uuid:1'},
+            'contained': [{
+                'resourceType': 'Organization',
+                'partOf': {'reference': 'Organization/3'}
+            }]
+        }])
+        self.assertEqual(sorted(edges), [
+            ('Observation', 'o1', 'encounter', 'Encounter', '#e1'),
+            ('Observation', 'o1', 'performer', 'Practitioner', '2'),
+            ('Observation', 'o1', 'subject', 'Patient', '1'),
+            ('Patient', 'p1', 'contained.partOf', 'Organization', '3'),
+            ('Patient', 'p1', 'managingOrganization', 'Organization',
+             'urn:uuid:1'),
+        ])
+
+    def test_extract_references_db_format(self):
+        observation = self.resources.Observation.from_json({
+            'id': 'o1',
+            'subject': {'reference': 'Patient/1'},
+            'resourceType': 'Observation'
+        })
+        observation.to_db_format()
+        self.assertEqual(
+            list(self.resources.extract_references([observation])),
+            [('Observation', 'o1', 'subject', 'Patient', '1')])
+
+    def test_replace_bundle_refs(self):
+        bundle, replaced = self.resources.replace_bundle_refs({
+            'resourceType': 'Bundle',
+            'type': 'transaction',
+            'entry': [{
+                'fullUrl': 'urn:uuid:1',
+                'resource': {'resourceType': 'Patient'}
+            }, {
+                'fullUrl': 'urn:uuid:2',
+                'resource': {
+                    'resourceType': 'Observation',
+                    'subject': {'reference': 'urn:uuid:1'}
+                }
+            }]
+        }, {'urn:uuid:1': 'Patient/1'})
+        self.assertEqual(replaced, 1)
+        self.assertEqual(bundle.entry[1].resource.subject.reference,
+                         'Patient/1')
+
+
+class TestCompactResources(TestResources):
+    def setUp(self):
+        self.definitions = readers.defs_from_generated()
+        self.resources = resources.Resources(self.definitions, compact=True)
+
+    def test_type(self):
+        self.assertTrue(
+            issubclass(self.resources.Patient, resources.CompactResource))
+        self.assertTrue(
+            issubclass(self.resources.HumanName, resources.CompactType))
+        self.assertFalse(issubclass(self.resources.Patient, dict))
+        self.assertRaises(AttributeError, setattr, self.resources.Patient(),
+                          'unknown', 'value')
+
+    def test_backbone(self):
+        self.assertTrue(
+            issubclass(self.resources.Patient.Contact,
+                       resources.CompactBackbone))
+        contact = self.resources.Patient.Contact(gender='male')
+        self.assertEqual(contact.gender, 'male')
+
+    def test_backbone_in_backbone(self):
+        plan_class = self.resources.InsurancePlan.Plan
+        plan = plan_class(generalCost=[
+            plan_class.GeneralCost(comment='example')
+        ])
+        self.assertEqual(plan.generalCost[0].comment, 'example')
+
+    def test_mapping(self):
+        patient = self.resources.Patient(id='example', active=True)
+        self.assertEqual(list(patient), ['id', 'active', 'resourceType'])
+        self.assertEqual(patient, {
+            'id': 'example',
+            'active': True,
+            'resourceType': 'Patient'
+        })
+        self.assertEqual(patient.get('gender'), None)
+        self.assertRaises(AttributeError, lambda: patient.gender)
+        patient.gender = 'male'
+        self.assertEqual(patient['gender'], 'male')
+        del patient['active']
+        self.assertNotIn('active', patient)
+        self.assertRaises(AttributeError, lambda: patient.active)
+        self.assertRaises(KeyError, patient.__setitem__, 'unknown', 1)
+        self.assertEqual(len(patient), 3)
+
+    def test_polymorphic_slot(self):
+        observation = self.resources.Observation(valueString='example')
+        observation.valueBoolean = True
+        self.assertEqual(list(observation), ['resourceType', 'valueBoolean'])
+        self.assertEqual(observation.value, True)
+        self.assertRaises(AttributeError, lambda: observation.valueString)
+        self.assertNotIn('__dict__', dir(observation))
+
+    def test_shared_keys(self):
+        first = self.resources.Coding(system='http://loinc.org', code='1')
+        second = self.resources.Coding(system='http://loinc.org', code='2')
+        self.assertIs(first._fhir_keys, second._fhir_keys)
+
+    def test_to_db_format(self):
+        observation = self.resources.Observation.from_json({
+            'resourceType': 'Observation',
+            'subject': {
+                'reference': 'Patient/example'
+            },
+            'valueQuantity': {
+                'value': 1
+            }
+        })
+        observation.to_db_format()
+        self.assertEqual(observation['value'], {'Quantity': {'value': 1}})
+        self.assertEqual(observation.subject.id, 'example')
+        observation.to_fhir_format()
+        self.assertEqual(observation.valueQuantity.value, 1)
+        self.assertEqual(observation.subject.reference, 'Patient/example')
+        observation.replace_refs('Patient/example', 'Patient/other')
+        self.assertEqual(observation.subject.reference, 'Patient/other')
+
+
+class TestLazyResources(unittest.TestCase):
+    def setUp(self):
+        self.definitions = readers.defs_from_generated()
+        self.resources = resources.Resources(self.definitions, lazy=True)
+
+    def tearDown(self):
+        self.definitions = None
+        self.resources = None
+
+    def test_created_on_access(self):
+        self.assertNotIn('Patient', self.resources._resources)
+        patient_class = self.resources.Patient
+        self.assertTrue(issubclass(patient_class, resources.Resource))
+        self.assertTrue(
+            issubclass(patient_class.Contact, resources.Backbone))
+        self.assertIs(self.resources.get('Patient'), patient_class)
+        self.assertNotIn('Observation', self.resources._resources)
+
+    def test_from_json(self):
+        patient = self.resources.from_json({
+            'resourceType': 'Patient',
+            'id': 'example',
+            'name': [{
+                'family': 'Doe'
+            }]
+        })
+        self.assertIsInstance(patient.name[0], self.resources.HumanName)
+        self.assertEqual(patient.name[0].family, 'Doe')
+
+    def test_unknown(self):
+        self.assertRaises(KeyError, self.resources.get, 'Unknown')
+
+    def test_preload(self):
+        self.resources.preload(['Observation', 'Quantity'])
+        self.assertIn('Observation', self.resources._resources)
+        self.assertIn('Quantity', self.resources._types)
+        self.resources.preload()
+        self.assertEqual(len(self.resources._resources),
+                         len(self.definitions.res_defs))
+        self.assertEqual(len(self.resources._types),
+                         len(self.definitions.type_defs))
+
+    def test_thread_safe(self):
+        results = []
+
+        def worker():
+            results.append(self.resources.get('Encounter'))
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 8)
+        self.assertTrue(all(r is results[0] for r in results))
+
+
+class TestLazyViews(unittest.TestCase):
+    def setUp(self):
+        self.definitions = readers.defs_from_generated()
+        self.resources = resources.Resources(self.definitions, lazy=True)
+        self.json = {
+            'resourceType': 'Patient',
+            'id': 'example',
+            'unknown': 1,
+            'name': [{'family': 'Doe', 'given': ['John']}],
+            'contact': [{
+                'name': {'family': 'Doe'},
+                'organization': {'reference': 'Organization/1'}
+            }],
+            'managingOrganization': {'reference': 'Organization/1'},
+            'contained': [{'resourceType': 'Organization', 'name': 'Acme'}],
+        }
+
+    def tearDown(self):
+        self.definitions = None
+        self.resources = None
+
+    def test_wrap(self):
+        patient = self.resources.wrap(self.json)
+        self.assertIsInstance(patient, self.resources.Patient)
+        self.assertNotIn('unknown', patient)
+        self.assertEqual(patient.id, 'example')
+        self.assertIs(dict.__getitem__(patient, 'name'), self.json['name'])
+        self.assertEqual(patient, self.resources.from_json(self.json))
+
+    def test_materialize_on_access(self):
+        patient = self.resources.wrap(self.json)
+        name = patient.name[0]
+        self.assertIsInstance(name, self.resources.HumanName)
+        self.assertIs(patient.name[0], name)
+        self.assertIsInstance(patient.contact[0].name,
+                              self.resources.HumanName)
+        self.assertIsInstance(patient.contained[0],
+                              self.resources.Organization)
+        self.assertIsInstance(
+            dict.__getitem__(patient, 'managingOrganization'), dict)
+        self.assertNotIsInstance(
+            dict.__getitem__(patient, 'managingOrganization'),
+            self.resources.Reference)
+        # Input is not modified
+        self.assertNotIsInstance(self.json['name'][0],
+                                 self.resources.HumanName)
+
+    def test_raw_values(self):
+        # Unknown elements of nested objects are not visible
+        json = dict(self.json, name=[{'family': 'Doe', 'unknown': 1}])
+        expected = self.resources.from_json(json)
+        self.assertEqual(self.resources.wrap(json), expected)
+        self.assertEqual(expected, self.resources.wrap(json))
+        self.assertFalse(self.resources.wrap(json) != expected)
+        self.assertEqual(dict(self.resources.wrap(json))['name'],
+                         [{'family': 'Doe'}])
+
+    def test_items(self):
+        patient = self.resources.wrap(self.json)
+        values = dict(patient.items())
+        self.assertIsInstance(values['managingOrganization'],
+                              self.resources.Reference)
+        self.assertIsInstance(patient.get('contact')[0],
+                              self.resources.Patient.Contact)
+
+    def test_set(self):
+        patient = self.resources.wrap(self.json)
+        patient.name = [self.resources.HumanName(family='Other')]
+        self.assertEqual(patient.name[0].family, 'Other')
+        del patient['contact']
+        self.assertNotIn('contact', patient)
+        self.assertEqual(len(patient.values()), 5)
+
+    def test_to_db_format(self):
+        patient = self.resources.wrap(self.json)
+        patient.to_db_format()
+        expected = self.resources.from_json(self.json)
+        expected.to_db_format()
+        self.assertEqual(patient, expected)
+        self.assertEqual(patient.contact[0].organization.id, '1')
+
+    def test_replace_refs(self):
+        patient = self.resources.wrap(self.json)
+        patient.replace_refs('Organization/1', 'Organization/2')
+        self.assertEqual(patient.managingOrganization.reference,
+                         'Organization/2')
+        self.assertEqual(patient.contact[0].organization.reference,
+                         'Organization/2')
+
+    def test_compact(self):
+        compact = resources.Resources(self.definitions, lazy=True,
+                                      compact=True)
+        patient = compact.wrap(self.json)
+        self.assertIsInstance(patient, compact.Patient)
+        self.assertEqual(patient.name[0].family, 'Doe')
+
+
+class TestProjection(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with open(readers.RES_DEFS) as fp:
+            res_defs = json.load(fp)
+        with open(readers.TYPE_DEFS) as fp:
+            type_defs = json.load(fp)
+        # Generated definitions do not carry summary flags yet
+        elements = res_defs['Patient']['elements']
+        for path in ('Patient.name', 'Patient.deceased[x]', 'Patient.link',
+                     'Patient.link.other'):
+            elements[path]['isSummary'] = True
+        cls.definitions = readers.Definitions(res_defs, type_defs)
+
+    def setUp(self):
+        self.resources = resources.Resources(self.definitions, lazy=True)
+        self.json = {
+            'resourceType': 'Patient',
+            'id': 'example',
+            'meta': {'versionId': '1'},
+            'active': True,
+            'name': [{'family': 'Doe'}],
+            'deceasedBoolean': False,
+            'contact': [{
+                'name': {'family': 'Doe'},
+                'gender': 'female'
+            }],
+            'link': [{
+                'other': {'reference': 'Patient/other'},
+                'type': 'seealso',
+                'extension': [{'url': 'http://example.org'}]
+            }],
+        }
+
+    def test_summary(self):
+        patient = self.resources.from_json(self.json)
+        summary = patient.to_summary()
+        self.assertIsInstance(summary, self.resources.Patient)
+        self.assertEqual(sorted(summary), [
+            'deceasedBoolean', 'id', 'link', 'meta', 'name', 'resourceType'
+        ])
+        # Mandatory elements of backbone elements are kept
+        self.assertEqual(sorted(summary.link[0]), ['other', 'type'])
+        self.assertIs(summary.name, patient.name)
+        self.assertIn('active', patient)
+
+    def test_summary_unchanged(self):
+        name = self.resources.HumanName(family='Doe')
+        self.assertEqual(name.to_summary(), {})
+        patient = self.resources.Patient(id='example')
+        self.assertIs(patient.to_summary(), patient)
+
+    def test_summary_element(self):
+        # `ClinicalImpression.summary` is an element, not a method
+        for compact in (False, True):
+            repo = resources.Resources(self.definitions, lazy=True,
+                                       compact=compact)
+            impression = repo.from_json({
+                'resourceType': 'ClinicalImpression',
+                'id': 'example',
+                'status': 'completed',
+                'subject': {'reference': 'Patient/example'},
+                'summary': 'Stable',
+            })
+            self.assertEqual(impression.summary, 'Stable')
+            self.assertEqual(impression.to_summary().id, 'example')
+            del impression['summary']
+            with self.assertRaises(AttributeError):
+                impression.summary
+            self.assertEqual(impression.to_summary().status, 'completed')
+
+    def test_summary_without_flags(self):
+        repo = resources.Resources(readers.defs_from_generated(), lazy=True)
+        patient = repo.from_json(self.json)
+        # Would silently leave out every optional element
+        with self.assertRaises(ValueError):
+            patient.to_summary()
+        self.assertEqual(sorted(patient.project(['active'])),
+                         ['active', 'id', 'meta', 'resourceType'])
+
+    def test_project(self):
+        patient = self.resources.from_json(self.json)
+        projected = patient.project(['active', 'contact.gender', 'deceased'])
+        self.assertEqual(projected, {
+            'resourceType': 'Patient',
+            'id': 'example',
+            'meta': {'versionId': '1'},
+            'active': True,
+            'deceasedBoolean': False,
+            'contact': [{'gender': 'female'}],
+        })
+        self.assertIs(projected.meta, patient.meta)
+
+    def test_project_nested_type(self):
+        patient = self.resources.from_json(self.json)
+        projected = patient.project(['contact.name.given', 'unknown'])
+        self.assertEqual(projected.contact[0].name, {})
+        self.assertIsInstance(projected.contact[0].name,
+                              self.resources.HumanName)
+
+    def test_project_lazy(self):
+        patient = self.resources.wrap(self.json)
+        projected = patient.project(['name'])
+        self.assertEqual(projected.name[0].family, 'Doe')
+        self.assertIn('contact', patient._fhir_pending)
+
+    def test_project_compact(self):
+        compact = resources.Resources(self.definitions, lazy=True,
+                                      compact=True)
+        patient = compact.from_json(self.json)
+        self.assertEqual(dict(patient.project(['active'])), {
+            'resourceType': 'Patient',
+            'id': 'example',
+            'meta': {'versionId': '1'},
+            'active': True,
+        })
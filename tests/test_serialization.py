@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+from __future__ import unicode_literals
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from fhir_tools import readers
+from fhir_tools import resources
+from fhir_tools import serialization
+
+BACKENDS = [serialization.JSON]
+if serialization.orjson is not None:
+    BACKENDS.append(serialization.ORJSON)
+
+
+class TestSerialization(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.definitions = readers.defs_from_generated()
+
+    def setUp(self):
+        self.resources = resources.Resources(self.definitions, lazy=True)
+
+    def observation(self, value):
+        return self.resources.Observation.from_json({
+            'resourceType': 'Observation',
+            'id': 'example',
+            'status': 'final',
+            'code': {'text': 'Température   "quoted" \\ \x1f'},
+            'valueQuantity': {'value': value, 'unit': 'Cel'},
+        })
+
+    def test_to_json_bytes(self):
+        observation = self.observation(36.6)
+        for backend in BACKENDS:
+            data = observation.to_json_bytes(backend)
+            self.assertIsInstance(data, bytes)
+            self.assertEqual(json.loads(data.decode('utf-8')), observation)
+
+    def test_backends_identical(self):
+        values = [0, 1, -1, 36.6, 0.1 + 0.2, 1e16, 1.5e-7, 0.00001, 0.0001,
+                  -0.0, 2 ** 64, 123456789.125]
+        for value in values:
+            observation = self.observation(value)
+            expected = json.dumps(observation, ensure_ascii=False,
+                                  separators=(',', ':')).encode('utf-8')
+            for backend in BACKENDS:
+                self.assertEqual(
+                    serialization.to_json_bytes(observation, backend),
+                    expected)
+
+    def test_nan(self):
+        for backend in BACKENDS:
+            with self.assertRaises(ValueError):
+                serialization.to_json_bytes({'value': float('nan')}, backend)
+
+    def test_compact(self):
+        compact = resources.Resources(self.definitions, lazy=True,
+                                      compact=True)
+        observation = self.observation(36.6)
+        compact_observation = compact.Observation.from_json(
+            json.loads(observation.to_json_bytes().decode('utf-8')))
+        for backend in BACKENDS:
+            self.assertEqual(compact_observation.to_json_bytes(backend),
+                             observation.to_json_bytes(backend))
+
+    def test_lazy_view(self):
+        # Raw values of lazy views are not written as they are
+        raw = {
+            'resourceType': 'Patient',
+            'id': 'example',
+            'name': [{'family': 'Doe', 'unknown': 1}],
+            'contact': [{'name': {'family': 'Doe', 'unknown': 1}}],
+        }
+        expected = self.resources.from_json(raw)
+        for backend in BACKENDS:
+            view = self.resources.wrap(raw)
+            data = serialization.to_json_bytes(view, backend)
+            self.assertEqual(json.loads(data.decode('utf-8')), expected)
+            self.assertNotIn(b'unknown', data)
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            serialization.to_json_bytes({}, 'unknown')
+
+
+class TestNDJSONWriter(unittest.TestCase):
+    def test_write(self):
+        for backend in BACKENDS:
+            fp = io.BytesIO()
+            with serialization.NDJSONWriter(fp, buffer_size=64,
+                                            backend=backend) as writer:
+                writer.write({'resourceType': 'Patient', 'id': '1'})
+                writer.write_many({'resourceType': 'Patient', 'id': str(i)}
+                                  for i in range(2, 10))
+            self.assertEqual(writer.count, 9)
+            self.assertFalse(fp.closed)
+            lines = fp.getvalue().decode('utf-8').splitlines()
+            self.assertEqual([json.loads(l)['id'] for l in lines],
+                             [str(i) for i in range(1, 10)])
+
+    def test_buffered(self):
+        fp = io.BytesIO()
+        writer = serialization.NDJSONWriter(fp, buffer_size=1024)
+        writer.write({'resourceType': 'Patient'})
+        self.assertEqual(fp.getvalue(), b'')
+        writer.flush()
+        self.assertEqual(fp.getvalue(), b'{"resourceType":"Patient"}\n')
+
+    def test_path(self):
+        path = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(path, 'Patient.ndjson')
+            with serialization.NDJSONWriter(file_name) as writer:
+                writer.write({'resourceType': 'Patient'})
+            with open(file_name, 'rb') as fp:
+                self.assertEqual(fp.read(), b'{"resourceType":"Patient"}\n')
+        finally:
+            shutil.rmtree(path)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+from __future__ import unicode_literals
+import datetime
+import unittest
+
+from fhir_tools import readers
+from fhir_tools import resources
+from fhir_tools import store
+
+OBSERVATIONS = [{
+    'resourceType': 'Observation',
+    'id': '1',
+    'status': 'final',
+    'code': {'coding': [{'system': 'http://loinc.org', 'code': '29463-7'}]},
+    'subject': {'reference': 'Patient/1'},
+    'effectiveDateTime': '2019-05-01T10:30:00+02:00',
+}, {
+    'resourceType': 'Observation',
+    'id': '2',
+    'status': 'preliminary',
+    'code': {'coding': [{'system': 'http://loinc.org', 'code': '8302-2'}]},
+    'subject': {'reference': 'http://example.com/fhir/Patient/2'},
+    'effectivePeriod': {'start': '2019-06-01'},
+}, {
+    'resourceType': 'Observation',
+    'id': '3',
+    'status': 'final',
+    'code': {'text': 'No coding'},
+    'subject': {'reference': 'Patient/1/_history/2'},
+    'effectiveDateTime': '2019-04',
+}]
+
+
+def _ids(found):
+    return sorted(r.id for r in found)
+
+
+class TestResourceStore(unittest.TestCase):
+    def setUp(self):
+        self.definitions = readers.defs_from_generated()
+        self.resources = resources.Resources(self.definitions, lazy=True)
+        self.store = store.ResourceStore(self.resources)
+        self.store.add_index('subject', 'Observation.subject',
+                             store.REFERENCE)
+        self.store.add_index('code', 'Observation.code', store.TOKEN)
+        self.store.add_index('status', 'Observation.status', store.TOKEN)
+        self.store.add_index('date', 'Observation.effective', store.DATE)
+        self.store.put_many(OBSERVATIONS)
+
+    def tearDown(self):
+        self.definitions = None
+        self.resources = None
+        self.store = None
+
+    def test_get(self):
+        self.assertEqual(len(self.store), 3)
+        self.assertIn(('Observation', '1'), self.store)
+        observation = self.store.get('Observation', '1')
+        self.assertIsInstance(observation, resources.BaseFHIRObject)
+        self.assertEqual(observation.status, 'final')
+        self.assertIsNone(self.store.get('Patient', '1'))
+        self.assertEqual(_ids(self.store.iter_resources('Observation')),
+                         ['1', '2', '3'])
+        self.assertEqual(list(self.store.iter_resources('Patient')), [])
+
+    def test_references(self):
+        search = self.store.search
+        self.assertEqual(_ids(search('Observation', 'subject', 'Patient/1')),
+                         ['1', '3'])
+        self.assertEqual(_ids(search('Observation', 'subject', 'Patient/2')),
+                         ['2'])
+        self.assertEqual(_ids(search(
+            'Observation', 'subject', 'http://other.com/Patient/2')), ['2'])
+        self.assertEqual(search('Observation', 'subject', 'Patient/3'), [])
+
+    def test_tokens(self):
+        search = self.store.search
+        self.assertEqual(_ids(search('Observation', 'code', '29463-7')),
+                         ['1'])
+        self.assertEqual(_ids(search('Observation', 'code',
+                                     'http://loinc.org|8302-2')), ['2'])
+        self.assertEqual(search('Observation', 'code', 'other|8302-2'), [])
+        self.assertEqual(search('Observation', 'code', '|8302-2'), [])
+        self.assertEqual(_ids(search('Observation', 'status', 'final')),
+                         ['1', '3'])
+        self.assertEqual(_ids(search('Observation', 'status', '|final')),
+                         ['1', '3'])
+
+    def test_dates(self):
+        search_range = self.store.search_range
+        self.assertEqual(
+            [r.id for r in search_range('Observation', 'date')],
+            ['3', '1', '2'])
+        self.assertEqual(
+            [r.id for r in search_range('Observation', 'date',
+                                        '2019-05', '2019-06')], ['1'])
+        self.assertEqual(
+            [r.id for r in search_range(
+                'Observation', 'date',
+                start=datetime.datetime(2019, 5, 1, 8, 30))], ['1', '2'])
+        self.assertEqual(
+            [r.id for r in search_range('Observation', 'date',
+                                        end='2019-05-01T08:30:00Z')], ['3'])
+        with self.assertRaises(ValueError):
+            search_range('Observation', 'date', 'yesterday')
+
+    def test_period_end(self):
+        # Period without a start is indexed by its end
+        self.store.put({'resourceType': 'Observation', 'id': '4',
+                        'status': 'final',
+                        'code': {'text': 'Open start'},
+                        'effectivePeriod': {'end': '2019-04-15'}})
+        self.assertEqual(
+            [r.id for r in self.store.search_range(
+                'Observation', 'date', '2019-04-10', '2019-04-20')], ['4'])
+        self.assertEqual(
+            [r.id for r in self.store.search_range('Observation', 'date')],
+            ['3', '4', '1', '2'])
+
+    def test_update(self):
+        changed = dict(OBSERVATIONS[0], subject={'reference': 'Patient/2'},
+                       effectiveDateTime='2020')
+        self.store.put(changed)
+        self.assertEqual(len(self.store), 3)
+        self.assertEqual(_ids(self.store.search(
+            'Observation', 'subject', 'Patient/1')), ['3'])
+        self.assertEqual(_ids(self.store.search(
+            'Observation', 'subject', 'Patient/2')), ['1', '2'])
+        self.assertEqual(
+            [r.id for r in self.store.search_range(
+                'Observation', 'date', '2019-05', '2019-06')], [])
+        self.assertEqual(
+            [r.id for r in self.store.search_range(
+                'Observation', 'date', '2020')], ['1'])
+
+    def test_delete(self):
+        deleted = self.store.delete('Observation', '1')
+        self.assertEqual(deleted.id, '1')
+        self.assertNotIn(('Observation', '1'), self.store)
+        self.assertEqual(_ids(self.store.search(
+            'Observation', 'subject', 'Patient/1')), ['3'])
+        self.assertEqual(_ids(self.store.search(
+            'Observation', 'code', '29463-7')), [])
+        self.assertEqual(
+            [r.id for r in self.store.search_range('Observation', 'date')],
+            ['3', '2'])
+        with self.assertRaises(KeyError):
+            self.store.delete('Observation', '1')
+
+    def test_add_index(self):
+        # Existing resources are indexed
+        self.store.add_index('performer', 'Observation.performer',
+                             store.REFERENCE)
+        self.store.put(dict(OBSERVATIONS[0], id='4', performer=[
+            {'reference': 'Practitioner/1'}]))
+        self.assertEqual(_ids(self.store.search(
+            'Observation', 'performer', 'Practitioner/1')), ['4'])
+        self.store.put({'resourceType': 'Patient', 'id': '1',
+                        'identifier': [{'system': 'urn:oid:1',
+                                        'value': '123'}]})
+        self.store.add_index('identifier', 'Patient.identifier', store.TOKEN)
+        self.assertEqual(_ids(self.store.search(
+            'Patient', 'identifier', 'urn:oid:1|123')), ['1'])
+
+    def test_empty(self):
+        empty = store.ResourceStore(self.resources)
+        empty.add_index('subject', 'Observation.subject', store.REFERENCE)
+        empty.add_index('date', 'Observation.effective', store.DATE)
+        self.assertEqual(empty.search('Observation', 'subject', 'Patient/1'),
+                         [])
+        self.assertEqual(empty.search_range('Observation', 'date'), [])
+        self.assertEqual(len(empty), 0)
+
+    def test_errors(self):
+        add_index = self.store.add_index
+        with self.assertRaises(ValueError):
+            add_index('subject', 'Observation.subject', store.REFERENCE)
+        with self.assertRaises(ValueError):
+            add_index('invalid', 'Observation.status', store.DATE)
+        with self.assertRaises(ValueError):
+            add_index('invalid', 'Observation.subject', store.TOKEN)
+        with self.assertRaises(ValueError):
+            add_index('invalid', 'HumanName.family', store.TOKEN)
+        with self.assertRaises(ValueError):
+            add_index('invalid', 'Observation.status', 'unknown')
+        with self.assertRaises(ValueError):
+            self.store.put({'resourceType': 'Observation',
+                            'status': 'final'})
+        with self.assertRaises(KeyError):
+            self.store.search('Observation', 'unknown', 'final')
+        with self.assertRaises(ValueError):
+            self.store.search('Observation', 'date', '2019')
+        with self.assertRaises(ValueError):
+            self.store.search_range('Observation', 'code')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+from __future__ import unicode_literals
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import six
+
+from fhir_tools import readers
+from fhir_tools import resources
+from fhir_tools import streaming
+
+PATIENT = {
+    'resourceType': 'Patient',
+    'id': 'example',
+    'name': [{
+        'family': 'Doe'
+    }]
+}
+OBSERVATION = {
+    'resourceType': 'Observation',
+    'id': 'example',
+    'status': 'final',
+    'subject': {
+        'reference': 'Patient/example'
+    },
+    'valueQuantity': {
+        'value': 1.5
+    }
+}
+
+
+def ndjson(*lines):
+    return io.BytesIO('\n'.join(
+        l if isinstance(l, six.text_type) else json.dumps(l)
+        for l in lines).encode('utf-8'))
+
+
+class TestNDJSON(unittest.TestCase):
+    def setUp(self):
+        self.definitions = readers.defs_from_generated()
+        self.resources = resources.Resources(self.definitions)
+
+    def tearDown(self):
+        self.definitions = None
+        self.resources = None
+
+    def test_read(self):
+        result = list(self.resources.iter_ndjson(
+            ndjson(PATIENT, '', OBSERVATION)))
+        self.assertEqual(len(result), 2)
+        self.assertIsInstance(result[0], self.resources.Patient)
+        self.assertIsInstance(result[0].name[0], self.resources.HumanName)
+        self.assertIsInstance(result[1], self.resources.Observation)
+        self.assertEqual(result[1].valueQuantity.value, 1.5)
+
+    def test_read_file(self):
+        path = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(path, 'Patient.ndjson')
+            with open(file_name, 'wb') as fp:
+                fp.write(ndjson(PATIENT, PATIENT).getvalue())
+            result = list(self.resources.iter_ndjson(file_name))
+        finally:
+            shutil.rmtree(path)
+        self.assertEqual([r.id for r in result], ['example', 'example'])
+
+    def test_text_stream(self):
+        stream = io.StringIO(ndjson(PATIENT).getvalue().decode('utf-8'))
+        result = list(self.resources.iter_ndjson(stream))
+        self.assertEqual(result[0].name[0].family, 'Doe')
+
+    def test_db_format(self):
+        patient = self.resources.from_json({
+            'resourceType': 'Patient',
+            'id': 'example',
+            'deceasedBoolean': True,
+            'generalPractitioner': [{
+                'reference': 'Practitioner/example'
+            }]
+        })
+        patient.to_db_format()
+        result = list(self.resources.iter_ndjson(ndjson(patient),
+                                                 db_format=True))
+        self.assertEqual(result[0].generalPractitioner[0].reference,
+                         'Practitioner/example')
+        self.assertEqual(result[0].deceasedBoolean, True)
+
+    def test_filter(self):
+        result = list(self.resources.iter_ndjson(
+            ndjson(PATIENT, OBSERVATION, PATIENT),
+            resource_types=['Observation']))
+        self.assertEqual(len(result), 1)
+        self.assertIsInstance(result[0], self.resources.Observation)
+
+    def test_unknown(self):
+        stream = ndjson({'resourceType': 'Unknown'}, PATIENT)
+        self.assertRaises(streaming.ParseError, list,
+                          self.resources.iter_ndjson(stream))
+        stream.seek(0)
+        result = list(self.resources.iter_ndjson(stream, skip_unknown=True))
+        self.assertEqual(len(result), 1)
+
+    def test_malformed(self):
+        errors = []
+        stream = ndjson('{"resourceType": "Patient"', PATIENT, '[1, 2]',
+                        OBSERVATION)
+        result = list(self.resources.iter_ndjson(stream,
+                                                 on_error=errors.append))
+        self.assertEqual(len(result), 2)
+        self.assertEqual([e.line_number for e in errors], [1, 3])
+        self.assertTrue(all(isinstance(e, streaming.ParseError)
+                            for e in errors))
+        stream.seek(0)
+        self.assertRaises(ValueError, list,
+                          self.resources.iter_ndjson(stream))
+
+
+class TestBundleParser(unittest.TestCase):
+    def setUp(self):
+        self.bundle = {
+            'resourceType': 'Bundle',
+            'id': 'example',
+            'type': 'transaction',
+            'entry': [{
+                'fullUrl': 'urn:uuid:61ebe359-bfdc-4613-8bf2-c5e300945f0a',
+                'resource': PATIENT,
+                'request': {
+                    'method': 'POST',
+                    'url': 'Patient'
+                }
+            }, {
+                'fullUrl': 'urn:uuid:88f151c0-a954-468a-88bd-5ae15c08e059',
+                'resource': OBSERVATION,
+                'request': {
+                    'method': 'POST',
+                    'url': 'Observation'
+                }
+            }],
+            'total': 123456
+        }
+
+    def parse(self, data, chunk_size):
+        parser = streaming.BundleParser()
+        entries = []
+        for i in range(0, len(data), chunk_size):
+            entries.extend(parser.feed(data[i:i + chunk_size]))
+        entries.extend(parser.close())
+        return parser, entries
+
+    def test_chunks(self):
+        data = json.dumps(self.bundle, indent=2).encode('utf-8')
+        for chunk_size in (1, 2, 3, 7, 64, len(data)):
+            parser, entries = self.parse(data, chunk_size)
+            self.assertEqual(entries, self.bundle['entry'])
+            self.assertEqual(parser.metadata, {
+                'resourceType': 'Bundle',
+                'id': 'example',
+                'type': 'transaction',
+                'total': 123456
+            })
+
+    def test_unicode(self):
+        self.bundle['entry'][0]['resource'] = {
+            'resourceType': 'Patient',
+            'name': [{
+                'family': 'Иванов'
+            }]
+        }
+        data = json.dumps(self.bundle, ensure_ascii=False).encode('utf-8')
+        _, entries = self.parse(data, 1)
+        self.assertEqual(entries, self.bundle['entry'])
+
+    def test_empty(self):
+        _, entries = self.parse(b'{"resourceType": "Bundle", "entry": []}', 5)
+        self.assertEqual(entries, [])
+        _, entries = self.parse(b'{}', 1)
+        self.assertEqual(entries, [])
+
+    def test_errors(self):
+        self.assertRaises(streaming.ParseError, self.parse,
+                          b'{"resourceType": "Patient"}', 4)
+        self.assertRaises(streaming.ParseError, self.parse,
+                          b'{"entry": [{"resource": {}}', 4)
+        self.assertRaises(streaming.ParseError, self.parse,
+                          b'{"entry": [1]}', 4)
+        self.assertRaises(streaming.ParseError, self.parse, b'[]', 4)
+        self.assertRaises(streaming.ParseError, self.parse, b'{} {}', 4)
+
+    def test_iter_bundle_entries(self):
+        definitions = readers.defs_from_generated()
+        repo = resources.Resources(definitions)
+        stream = io.BytesIO(json.dumps(self.bundle).encode('utf-8'))
+        parser = streaming.BundleParser()
+        entries = list(repo.iter_bundle_entries(stream, buffer_size=16,
+                                                parser=parser))
+        self.assertEqual(len(entries), 2)
+        self.assertIsInstance(entries[0], repo.Bundle.Entry)
+        self.assertIsInstance(entries[0].resource, repo.Patient)
+        self.assertIsInstance(entries[0].resource.name[0], repo.HumanName)
+        self.assertEqual(entries[0].request.method, 'POST')
+        self.assertEqual(entries[1].fullUrl,
+                         'urn:uuid:88f151c0-a954-468a-88bd-5ae15c08e059')
+        self.assertIsInstance(entries[1].resource, repo.Observation)
+        self.assertEqual(parser.metadata['type'], 'transaction')
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+from __future__ import unicode_literals
+import unittest
+
+from fhir_tools import utils
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_get(self):
+        cache = utils.LRUCache(2)
+        cache['a'] = 1
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('b', 2), 2)
+
+    def test_evict_least_recent(self):
+        cache = utils.LRUCache(2)
+        cache['a'] = 1
+        cache['b'] = 2
+        cache.get('a')
+        cache['c'] = 3
+        self.assertEqual(len(cache), 2)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertIn('c', cache)
+
+    def test_clear(self):
+        cache = utils.LRUCache()
+        cache['a'] = 1
+        cache.clear()
+        self.assertEqual(len(cache), 0)
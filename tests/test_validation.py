@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2019 Pavel 'Blane' Tuchin
+from __future__ import unicode_literals
+import io
+import json
+import unittest
+
+from fhir_tools import readers
+from fhir_tools import validation
+
+
+class TestValidator(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.validator = validation.Validator(readers.defs_from_generated())
+
+    def issues(self, json):
+        return sorted((i.path, i.code)
+                      for i in self.validator.validate(json))
+
+    def test_valid(self):
+        self.assertEqual(self.issues({
+            'resourceType': 'Patient',
+            'id': 'example',
+            'name': [{'family': 'Doe', 'given': ['John']}],
+            'birthDate': '1970-01-01',
+            '_birthDate': {'extension': []},
+            'active': True,
+            'multipleBirthInteger': 2,
+            'contact': [{'name': {'family': 'Doe'}}],
+            'managingOrganization': {'reference': 'Organization/1'},
+            'contained': [{'resourceType': 'Organization', 'name': 'Acme'}],
+            'extension': [{
+                'url': 'http://example.org',
+                'extension': [{'url': 'nested', 'valueString': 'value'}]
+            }]
+        }), [])
+
+    def test_unknown(self):
+        self.assertEqual(self.issues({
+            'resourceType': 'Patient',
+            'foo': 1,
+            'name': [{'bar': 'Doe'}]
+        }), [('Patient.foo', validation.UNKNOWN),
+             ('Patient.name[0].bar', validation.UNKNOWN)])
+
+    def test_cardinality(self):
+        self.assertEqual(self.issues({
+            'resourceType': 'Patient',
+            'name': {'family': 'Doe'},
+            'gender': ['male'],
+        }), [('Patient.gender', validation.CARDINALITY),
+             ('Patient.name', validation.CARDINALITY)])
+
+    def test_required(self):
+        self.assertEqual(self.issues({
+            'resourceType': 'Patient',
+            'link': [{'type': 'seealso'}],
+        }), [('Patient.link[0].other', validation.REQUIRED)])
+
+    def test_type(self):
+        self.assertEqual(self.issues({
+            'resourceType': 'Observation',
+            'status': 'final',
+            'code': {'text': 'code'},
+            'valueQuantity': {'value': '1.0'},
+            'issued': 1,
+            'subject': 'Patient/1',
+        }), [('Observation.issued', validation.TYPE),
+             ('Observation.subject', validation.TYPE),
+             ('Observation.valueQuantity.value', validation.TYPE)])
+
+    def test_choice(self):
+        self.assertEqual(self.issues({
+            'resourceType': 'Patient',
+            'deceasedBoolean': True,
+            'deceasedDateTime': '2000-01-01',
+        }), [('Patient.deceased', validation.CHOICE)])
+
+    def test_resource_type(self):
+        self.assertEqual(self.issues({'id': 'example'}),
+                         [('', validation.INVALID)])
+        self.assertEqual(self.issues({'resourceType': 'Unknown'}),
+                         [('', validation.INVALID)])
+
+    def test_validate_type(self):
+        issues = self.validator.validate_type('HumanName', {'given': 'John'})
+        self.assertEqual(issues, [validation.Issue(
+            'HumanName.given', validation.CARDINALITY, 'Expected an array')])
+
+    def test_validate_many(self):
+        resources = [
+            {'resourceType': 'Patient'},
+            {'resourceType': 'Patient', 'foo': 1},
+            {'resourceType': 'Patient'},
+        ]
+        result = list(self.validator.validate_many(resources))
+        self.assertEqual(len(result), 1)
+        index, issues = result[0]
+        self.assertEqual(index, 1)
+        self.assertEqual(issues[0].code, validation.UNKNOWN)
+
+    def test_validate_ndjson(self):
+        lines = [
+            json.dumps({'resourceType': 'Patient'}),
+            '{invalid',
+            json.dumps({'resourceType': 'Patient', 'active': 'yes'}),
+        ]
+        source = io.BytesIO('\n'.join(lines).encode('utf-8'))
+        result = list(self.validator.validate_ndjson(source))
+        self.assertEqual([n for n, _ in result], [2, 3])
+        self.assertEqual(result[0][1][0].code, validation.INVALID)
+        self.assertEqual(result[1][1][0].path, 'Patient.active')